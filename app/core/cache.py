@@ -0,0 +1,221 @@
+# in-process and shared caches used by the handlers
+import time
+import threading
+from collections import OrderedDict
+
+import bson
+
+try:
+    import redis
+except ImportError:  # redis is only needed for the shared cache backend
+    redis = None
+
+
+# in-process cache with a time to live and least recently used eviction
+class TTLCache:
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        # every invalidation moves the generation of the cache, a key keeps the generation of its last invalidation,
+        # the keys not listed are at the floor, the generation of the last prune of the list
+        self._generations = {}
+        self._generation = 0
+        self._generation_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                # expired entries count as a miss
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (self._clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        # evict the least recently used entries
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # function to get the generation of a key, or of the whole cache without a key, read it before loading
+    # the value to store with set_if_generation
+    def generation(self, key=None):
+        with self._lock:
+            if key is None:
+                return self._generation
+            return self._generations.get(key, self._generation_floor)
+
+    # function to store a value only when the key was not invalidated since the generation was read
+    def set_if_generation(self, key, value, generation):
+        with self._lock:
+            if self._generations.get(key, self._generation_floor) > generation:
+                self.stale_sets += 1
+                return False
+            self._store(key, value)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                self._generation += 1
+                self._generations[key] = self._generation
+            # forget the generations of old keys, the keys which are not listed move to the latest generation
+            if len(self._generations) > self.max_size * 4:
+                self._generations.clear()
+                self._generation_floor = self._generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale_sets": self.stale_sets,
+            }
+
+
+# script which stores a value only when the key was not invalidated after the generation read by the loader
+_SET_IF_GENERATION = """
+if tonumber(redis.call('get', KEYS[2]) or '0') <= tonumber(ARGV[2]) then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# script which moves the generation of the cache and gives it to the invalidated keys before deleting them,
+# KEYS are the generation of the cache followed by the generation and value key of each invalidated key
+_INVALIDATE = """
+local generation = redis.call('incr', KEYS[1])
+local deleted = 0
+for i = 2, #KEYS, 2 do
+    redis.call('set', KEYS[i], generation, 'EX', ARGV[1])
+    deleted = deleted + redis.call('del', KEYS[i + 1])
+end
+return deleted
+"""
+
+
+# cache shared by all the workers through redis, values are stored as bson
+class RedisCache:
+    def __init__(self, url: str, prefix: str, ttl_seconds: float = 300):
+        if redis is None:
+            raise RuntimeError("the redis cache backend needs the redis package")
+        self._client = redis.Redis.from_url(url)
+        self._set_if_generation = self._client.register_script(_SET_IF_GENERATION)
+        self._invalidate = self._client.register_script(_INVALIDATE)
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        # the generation of a key outlives any load, the loaders read it before they query mongodb
+        self.generation_ttl_seconds = max(int(ttl_seconds) * 10, 3600)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _generation_key(self, key=None):
+        return f"{self.prefix}:generation" if key is None else f"{self.prefix}:generation:{key}"
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key, default=None):
+        data = self._client.get(self._key(key))
+        if data is None:
+            self._count("misses")
+            return default
+        self._count("hits")
+        return bson.decode(data)["value"]
+
+    def set(self, key, value):
+        # redis expires the keys itself and evicts with its own maxmemory policy
+        self._client.set(self._key(key), bson.encode({"value": value}), ex=int(self.ttl_seconds))
+
+    # function to get the generation of a key, or of the whole cache without a key, read it before loading
+    # the value to store with set_if_generation
+    def generation(self, key=None):
+        return int(self._client.get(self._generation_key(key)) or 0)
+
+    # function to store a value only when the key was not invalidated by any worker since its generation was read
+    def set_if_generation(self, key, value, generation):
+        stored = self._set_if_generation(
+            keys=[self._key(key), self._generation_key(key)],
+            args=[bson.encode({"value": value}), str(generation), int(self.ttl_seconds)],
+        )
+        if not stored:
+            self._count("stale_sets")
+        return bool(stored)
+
+    def delete(self, *keys):
+        if keys:
+            # the generations move with the delete, so that a loader which read an older one can not store its value
+            deleted = self._invalidate(
+                keys=[self._generation_key(), *[name for key in keys
+                                                for name in (self._generation_key(key), self._key(key))]],
+                args=[self.generation_ttl_seconds],
+            )
+            with self._lock:
+                self.invalidations += deleted
+
+    def clear(self):
+        for key in self._client.scan_iter(f"{self.prefix}:*"):
+            self._client.delete(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "redis",
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "stale_sets": self.stale_sets,
+            }
+
+
+# function to create a cache from the settings
+def create_cache(backend: str, prefix: str, max_size: int, ttl_seconds: float, redis_url: str = None):
+    if backend == "redis":
+        return RedisCache(redis_url, prefix, ttl_seconds)
+    return TTLCache(max_size, ttl_seconds)
@@ -1,6 +1,136 @@
+# startup warm-up and shutdown of a worker, each warm-up phase is timed and the worker is ready once all are done
+import time
+import asyncio
+from datetime import datetime
+from decimal import Decimal
 from typing import Callable
+import bson
+import numpy as np
+from bson import ObjectId, Decimal128
+from anyio import to_thread
 from fastapi import FastAPI
 from app.core.settings.app import AppSettings
+from app.core.mongo import create_mongo_client, open_pool_connections, set_database
+from app.core.metrics import MongoCommandMetrics, WARM_UP_PHASE_SECONDS
+from app.core.responses import dumps_bson
+from app.handlers.index_service import ensure_indexes, index_drift
+from app.handlers.destination_service import get_destination_dictionary
+from app.handlers.async_car_pool_service import close_status_queue
+from app.handlers.dist_calc_service import distances_from, select_nearest, detour_order
+from app.handlers.car_pool_service import (sync_ride_index, start_ride_change_stream, preload_ride_candidates,
+    preload_hot_users, candidate_columns, candidate_result
+)
+
+
+# state of the warm-up of a worker, reported by the /ready route
+class WarmUp:
+    def __init__(self):
+        self.ready = False
+        self.error = None
+        # phase -> duration in ms, in the order they ran
+        self.phases = {}
+        self.task = None
+
+    # function to run a phase and record its duration
+    def run_phase(self, name: str, phase: Callable, *args):
+        start = time.perf_counter()
+        result = phase(*args)
+        elapsed = time.perf_counter() - start
+        self.phases[name] = elapsed * 1000
+        WARM_UP_PHASE_SECONDS.set(name, value=elapsed)
+        print(f'warm-up {name}: {elapsed * 1000:.1f} ms {result if result is not None else ""}'.rstrip())
+        return result
+
+    def report(self):
+        return {"ready": self.ready, "error": self.error, "phases_ms": self.phases,
+                "total_ms": sum(self.phases.values())}
+
+
+# function to get the warm-up state of the app, created on first use
+def get_warm_up(app: FastAPI):
+    if getattr(app.state, "warm_up", None) is None:
+        app.state.warm_up = WarmUp()
+    return app.state.warm_up
+
+
+# function to open the minimum connections of the pool
+def _connect(client, settings: AppSettings):
+    count = open_pool_connections(client, settings.mongo_min_pool_size, settings.warm_up_pool_timeout_seconds)
+    return f'{count} connections open'
+
+
+# function to create the indexes used by the handlers and report the drift
+def _indexes(db):
+    ensure_indexes(db)
+    drift = index_drift(db)
+    if drift:
+        print(f'index drift: {drift}')
+    return f'{len(drift)} drifted' if drift else None
+
+
+# function to load the bookable rides in the ride index, else the next hours of rides in the search cache
+def _rides(db, settings: AppSettings):
+    index = sync_ride_index(db)
+    if index is not None:
+        # follow the writes of the other workers
+        if settings.ride_index_change_stream:
+            start_ride_change_stream(db)
+        return f'{len(index)} rides indexed'
+    return f'{preload_ride_candidates(settings.warm_up_search_hours, db=db)} rides cached'
+
+
+# function to build the openapi schema and run the first calls of the serializers
+def _serializers(app: FastAPI):
+    # the openapi schema is otherwise built by the first /docs or /openapi.json request
+    app.openapi()
+    document = bson.decode(bson.encode({"_id": ObjectId(), "date": datetime(2030, 1, 1), "fare": Decimal128("1.5"),
+                                        "riders": []}))
+    dumps_bson({**document, "tip": Decimal("0.5"), "distance_away": np.float64(1.0)})
+
+
+# function to run the first calls of the matching kernels, without recording them as searches
+def _matching():
+    candidates = [{"ride": {"_id": i, "mail_id": "driver", "latitude": 12.97 + i / 100, "longitude": 77.59,
+                            "seats_offered": 1, "riders": []}, "address": None} for i in range(3)]
+    keep, lats, lons = candidate_columns(candidates, "rider")
+    nearest, within = select_nearest(distances_from(12.97, 77.59, lats, lons))
+    detour_order(12.97, 77.59, 13.0, 77.6, lats, lons)
+    dumps_bson([candidate_result(candidates[keep[index]], 0.0) for index in [nearest, *within.tolist()]])
+
+
+# function to run the warm-up phases which need the database, skip names the phases to leave out
+def warm_up_app(app: FastAPI, db, settings: AppSettings, skip=()):
+    warm_up = get_warm_up(app)
+    phases = [
+        ("indexes", _indexes, db),
+        ("destinations", lambda: f'{len(get_destination_dictionary(db))} destinations'),
+        ("rides", _rides, db, settings),
+        ("users", lambda: f'{preload_hot_users(settings.warm_up_hot_users, db=db)} users cached'),
+        ("serializers", _serializers, app),
+        ("matching", _matching),
+    ]
+    for name, phase, *args in phases:
+        if name not in skip:
+            warm_up.run_phase(name, phase, *args)
+    warm_up.ready = True
+
+
+# function to run the warm-up phases in a thread, in the background when asked so that /ready answers meanwhile
+async def start_warm_up(app: FastAPI, db, settings: AppSettings, skip=()):
+    warm_up = get_warm_up(app)
+    if not settings.warm_up_background:
+        await to_thread.run_sync(warm_up_app, app, db, settings, skip)
+        return
+
+    async def run():
+        try:
+            await to_thread.run_sync(warm_up_app, app, db, settings, skip)
+        except Exception as e:
+            # the worker stays not ready
+            warm_up.error = str(e)
+            print(f'warm-up failed: {e}')
+
+    warm_up.task = asyncio.create_task(run())
 
 
 def create_start_app_handler(
@@ -8,15 +138,33 @@ def create_start_app_handler(
         settings: AppSettings,
 ) -> Callable:  # type: ignore
     async def start_app() -> None:
-        print('inside start app')
-        pass
+        warm_up = get_warm_up(app)
+        # create the pooled mongodb client from the settings, in the worker so that it is never shared by a fork
+        print(f'mongo_host: {settings.mongo_host}, mongo_port: {settings.mongo_port}')
+        client = create_mongo_client(settings, event_listeners=[MongoCommandMetrics()])
+        # open the minimum pool connections before the first request, in a thread since it blocks on the pings
+        await to_thread.run_sync(warm_up.run_phase, "connect", _connect, client, settings)
+        db = client[settings.mongo_db]
+        app.state.db = db
+        set_database(db)
+        await start_warm_up(app, db, settings)
 
     return start_app
 
 
 def create_stop_app_handler(app: FastAPI) -> Callable:  # type: ignore
     async def stop_app() -> None:
-        print('inside stop app')
-        pass
+        # stop a warm-up still running in the background
+        warm_up = get_warm_up(app)
+        if warm_up.task is not None and not warm_up.task.done():
+            warm_up.task.cancel()
+        # write the queued ride status updates before the client is closed
+        stats = await close_status_queue()
+        if stats is not None:
+            print(f'write-behind drained: {stats}')
+        # close mongodb connection
+        db = getattr(app.state, "db", None)
+        if db is not None:
+            db.client.close()
 
     return stop_app
@@ -0,0 +1,193 @@
+# prometheus metrics of the api, kept in process and rendered in the text format
+import time
+import bisect
+import threading
+from pymongo.monitoring import CommandListener
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# function to escape a label value of the text format
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# function to render the labels of a sample
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            lines.extend(self._samples(labelvalues, value))
+        return lines
+
+    def _samples(self, labelvalues, value):
+        return [f"{self.name}{_labels(self.labelnames, labelvalues)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, *labelvalues, value: float):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labelvalues, value: float):
+        # counts per bucket are kept non cumulative and summed when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, labelvalues, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            labels = _labels(self.labelnames, labelvalues, (("le", bucket),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route template, method and status.", ("method", "route", "status")))
+HTTP_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route")))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being served.", ("method",)))
+MONGO_COMMAND_LATENCY = registry.register(Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency by collection and command.",
+    ("collection", "command")))
+MONGO_COMMAND_FAILURES = registry.register(Counter(
+    "mongo_command_failures_total", "Failed MongoDB commands by collection and command.", ("collection", "command")))
+RIDE_SEARCH_CANDIDATES = registry.register(Histogram(
+    "ride_search_candidates", "Candidate rides per ride search.", (),
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)))
+RIDE_SEARCH_LAST_CANDIDATES = registry.register(Gauge(
+    "ride_search_last_candidates", "Candidate rides of the last ride search."))
+WARM_UP_PHASE_SECONDS = registry.register(Gauge(
+    "warm_up_phase_seconds", "Duration of each startup warm-up phase.", ("phase",)))
+
+
+# asgi middleware which records the count, latency and in-flight requests per route template
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec(method)
+            # the router stores the matched route in the scope, the template keeps the label cardinality low
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(method, template, status[0])
+            HTTP_LATENCY.observe(method, template, value=elapsed)
+
+
+# pymongo command listener which records the command latency per collection
+class MongoCommandMetrics(CommandListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # request id -> collection of the started commands
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event):
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_LATENCY.observe(collection, event.command_name, value=event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_LATENCY.observe(collection, event.command_name, value=event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.inc(collection, event.command_name)
@@ -0,0 +1,123 @@
+# mongodb client lifecycle, pool statistics and the db dependency
+import time
+import threading
+from fastapi import Request
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from app.core.settings.app import AppSettings
+
+# database used by the handlers when no db is injected
+_database = None
+
+
+# connection pool listener which counts the connections of the pool
+class PoolStats(ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.check_out_failed = 0
+        self.pool_cleared = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "created": self.created,
+                "closed": self.closed,
+                "open": self.created - self.closed,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "check_out_failed": self.check_out_failed,
+                "pool_cleared": self.pool_cleared,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(pool_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(closed=1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, check_out_failed=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+
+# function to create the pooled mongodb client from the settings
+def create_mongo_client(settings: AppSettings, event_listeners=None):
+    pool_stats = PoolStats()
+    client = MongoClient(
+        settings.mongo_url,
+        event_listeners=[pool_stats, *(event_listeners or [])],
+        **settings.mongo_client_kwargs
+    )
+    # keep the listener on the client to read the statistics later
+    client.pool_stats = pool_stats
+    return client
+
+
+# function to ping the server so that the first request does not pay for the connection
+def warm_up_client(client: MongoClient):
+    client.admin.command('ping')
+
+
+# function to wait until the pool holds count open connections, the pool opens up to minPoolSize in the
+# background once the server is known, returns the open connections when done or when the timeout expires
+def open_pool_connections(client: MongoClient, count: int, timeout: float = 5.0):
+    warm_up_client(client)
+    deadline = time.monotonic() + timeout
+    while client.pool_stats.snapshot()["open"] < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return client.pool_stats.snapshot()["open"]
+
+
+# function to set the database used by the handlers
+def set_database(db):
+    global _database
+    _database = db
+
+
+# function to get the database used by the handlers
+def get_database():
+    if _database is None:
+        raise RuntimeError("mongodb is not connected")
+    return _database
+
+
+# fastapi dependency which injects the database into the routes
+def get_db(request: Request):
+    return request.app.state.db
+
+
+# function to read the pool statistics of the client
+def get_pool_stats(client: MongoClient):
+    return client.pool_stats.snapshot()
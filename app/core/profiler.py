@@ -0,0 +1,152 @@
+# opt-in sampling profiler for live requests, the slowest profiles are kept
+# in memory and served as collapsed stacks for flamegraph tools
+import sys
+import time
+import heapq
+import random
+import itertools
+import threading
+
+# anyio names the threads which run the blocking db calls
+WORKER_THREAD_PREFIX = "AnyIO worker thread"
+
+
+# profile of one request, stacks are stored folded as "root;...;leaf" -> samples
+class Profile:
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.route = None
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks = {}
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "started_at": self.started_at,
+            "duration_ms": self.duration * 1000,
+            "samples": self.samples,
+        }
+
+    # function to render the profile in the collapsed stack format of flamegraph.pl and speedscope
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+# function to fold a frame into "root;...;leaf"
+def fold_stack(frame, root: str):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+
+# thread which samples the stacks of the event loop thread and the db worker threads,
+# the worker threads are shared by the requests so concurrent requests blend in
+class StackSampler(threading.Thread):
+    def __init__(self, profile: Profile, loop_thread_id: int, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.profile = profile
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        workers = {thread.ident for thread in threading.enumerate() if thread.name.startswith(WORKER_THREAD_PREFIX)}
+        stacks = self.profile.stacks
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.loop_thread_id:
+                stack = fold_stack(frame, "event-loop")
+            elif thread_id in workers:
+                stack = fold_stack(frame, "db-worker")
+            else:
+                continue
+            stacks[stack] = stacks.get(stack, 0) + 1
+        self.profile.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+# bounded store which keeps the slowest profiles
+class SlowestProfiles:
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        # min heap of (duration, id, profile), the fastest kept profile is evicted first
+        self._heap = []
+
+    def add(self, profile: Profile):
+        with self._lock:
+            entry = (profile.duration, profile.id, profile)
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, entry)
+            elif profile.duration > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def list(self):
+        with self._lock:
+            profiles = [entry[2] for entry in self._heap]
+        return sorted(profiles, key=lambda profile: profile.duration, reverse=True)
+
+    def get(self, profile_id: int):
+        with self._lock:
+            for _, entry_id, profile in self._heap:
+                if entry_id == profile_id:
+                    return profile
+        return None
+
+
+# asgi middleware which profiles a sample of the requests, or the requests with the profile header,
+# the header must carry the admin token, without a token the header is ignored
+class ProfilerMiddleware:
+    def __init__(self, app, store: SlowestProfiles, sample_rate: float = 0.0, header: str = "x-profile",
+                 interval: float = 0.001, token: str = None):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode()
+        self.interval = interval
+        self.token = token
+
+    def _wanted(self, scope):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if not self.token:
+            return False
+        return any(name == self.header and value.decode("latin-1") == self.token
+                   for name, value in scope.get("headers", ()))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"])
+        sampler = StackSampler(profile, threading.get_ident(), self.interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop()
+            profile.duration = time.perf_counter() - start
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None)
+            self.store.add(profile)
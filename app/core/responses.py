@@ -0,0 +1,37 @@
+# response classes for the api
+from datetime import date
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from bson import ObjectId, Decimal128
+from starlette.responses import JSONResponse
+
+# naive datetimes from mongodb are UTC
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+# function to serialize the bson types orjson does not know
+def bson_default(obj: Any):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# function to serialize mongodb documents to json bytes in one pass
+def dumps_bson(content: Any) -> bytes:
+    return orjson.dumps(content, default=bson_default, option=ORJSON_OPTIONS)
+
+
+# json response which serializes mongodb documents (ObjectId, datetime) straight to bytes
+class MongoJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps_bson(content)
@@ -0,0 +1,130 @@
+# production server, gunicorn forks the uvicorn workers from a master which imported the app once
+# mongodb clients are not fork safe, so the workers open their own client in the startup event
+import argparse
+from typing import Any, Dict
+import uvicorn
+from uvicorn.importer import import_from_string
+from app.core.config import get_app_settings
+from app.core.settings.app import AppSettings
+from app.core.mongo import set_database
+
+try:
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+except ImportError:  # gunicorn is only needed for the multi worker server
+    BaseApplication = None
+    UvicornWorker = None
+
+
+# function to get the uvicorn options of the settings which are not handled by gunicorn
+def uvicorn_options(settings: AppSettings) -> Dict[str, Any]:
+    return {
+        "loop": settings.server_loop,
+        "http": settings.server_http,
+        "limit_concurrency": settings.server_limit_concurrency,
+    }
+
+
+# function to get the gunicorn options of the settings
+def gunicorn_options(settings: AppSettings, host: str = None, port: int = None, workers: int = None):
+    return {
+        "bind": f"{host or settings.server_host}:{port or settings.server_port}",
+        "workers": workers or settings.server_worker_count,
+        "worker_class": "app.core.server.ServerWorker",
+        "preload_app": settings.server_preload,
+        "backlog": settings.server_backlog,
+        "keepalive": settings.server_keep_alive_seconds,
+        "timeout": settings.server_timeout_seconds,
+        "graceful_timeout": settings.server_graceful_timeout_seconds,
+        "max_requests": settings.server_max_requests,
+        "max_requests_jitter": settings.server_max_requests_jitter,
+        "accesslog": "-" if settings.server_access_log else None,
+        "post_fork": post_fork,
+    }
+
+
+# function to list the settings which can not be shared by many workers, each worker would keep its own
+# copy of the caches and of the ride index, and only see its own writes in them
+def worker_conflicts(settings: AppSettings):
+    conflicts = []
+    if settings.cache_backend == "memory":
+        if settings.user_cache_enabled:
+            conflicts.append("the user cache needs CACHE_BACKEND=redis, or USER_CACHE_ENABLED=false")
+        if settings.search_cache_enabled:
+            conflicts.append("the search cache needs CACHE_BACKEND=redis, or SEARCH_CACHE_ENABLED=false")
+        if settings.place_cache_enabled:
+            conflicts.append("the place cache needs CACHE_BACKEND=redis, or PLACE_CACHE_ENABLED=false")
+    # the ride index of a worker only sees the writes of the others through the change stream
+    if settings.ride_index_enabled and not settings.ride_index_change_stream:
+        conflicts.append("the ride index needs RIDE_INDEX_CHANGE_STREAM=true, or RIDE_INDEX_ENABLED=false")
+    return conflicts
+
+
+# function to drop any database inherited from the master, each worker connects in its startup event
+def post_fork(server, worker):
+    set_database(None)
+
+
+if UvicornWorker is not None:
+    # uvicorn worker with the event loop, http parser and concurrency limit of the settings
+    class ServerWorker(UvicornWorker):
+        def __init__(self, *args, **kwargs):
+            # read by UvicornWorker.__init__ on top of the gunicorn options
+            self.CONFIG_KWARGS = uvicorn_options(get_app_settings())
+            super().__init__(*args, **kwargs)
+
+if BaseApplication is not None:
+    # gunicorn application serving an asgi app given by its import string, e.g. "main:app"
+    class Server(BaseApplication):
+        def __init__(self, app_path: str, options: dict):
+            self.app_path = app_path
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return import_from_string(self.app_path)
+
+
+# function to run the app, with gunicorn when there are many workers else with a single uvicorn process
+def run_server(app_path: str = "main:app", host: str = None, port: int = None, workers: int = None,
+               settings: AppSettings = None):
+    settings = settings or get_app_settings()
+    workers = workers or settings.server_worker_count
+    conflicts = worker_conflicts(settings) if workers > 1 else []
+    if conflicts:
+        raise RuntimeError(f"can not run {workers} workers: {'; '.join(conflicts)}")
+    if workers > 1 and BaseApplication is not None:
+        Server(app_path, gunicorn_options(settings, host, port, workers)).run()
+        return
+
+    # without gunicorn uvicorn spawns the workers itself, each one imports the app
+    uvicorn.run(
+        app_path,
+        host=host or settings.server_host,
+        port=port or settings.server_port,
+        workers=workers,
+        backlog=settings.server_backlog,
+        timeout_keep_alive=settings.server_keep_alive_seconds,
+        limit_max_requests=settings.server_max_requests or None,
+        access_log=settings.server_access_log,
+        **uvicorn_options(settings),
+    )
+
+
+"""
+usage:
+python -m app.core.server --workers 4
+python -m app.core.server --app benchmarks.standin_app:app --port 8015 --workers 2
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", help="import string of the asgi app", default="main:app")
+    parser.add_argument("--host", help="application host", type=str)
+    parser.add_argument("--port", help="application port", type=int)
+    parser.add_argument("--workers", help="worker processes, one per cpu core by default", type=int)
+    args = vars(parser.parse_args())
+    run_server(args['app'], host=args['host'], port=args['port'], workers=args['workers'])
@@ -0,0 +1,181 @@
+import os
+from typing import Any, Dict, List, Optional, Union
+
+from app.core.settings.base import BaseAppSettings
+
+
+class AppSettings(BaseAppSettings):
+    debug: bool = False
+    docs_url: str = "/docs"
+    openapi_prefix: str = ""
+    openapi_url: str = "/openapi.json"
+    redoc_url: str = "/redoc"
+    title: str = "Car Pool Service"
+    version: str = "0.0.0"
+
+    allowed_hosts: List[str] = ["*"]
+
+    # mongodb connection
+    mongo_uri: Optional[str] = None
+    mongo_host: str = "localhost"
+    mongo_port: int = 27017
+    mongo_db: str = "carpooldb"
+
+    # mongodb connection pool
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 10
+    mongo_max_idle_time_ms: Optional[int] = None
+    mongo_wait_queue_timeout_ms: int = 1000
+
+    # maximum number of blocking db calls running in threads at the same time
+    db_threads: int = 40
+
+    # mongodb timeouts
+    mongo_server_selection_timeout_ms: int = 2000
+    mongo_connect_timeout_ms: int = 2000
+    mongo_socket_timeout_ms: int = 5000
+
+    # mongodb wire compression, e.g. "zstd,zlib", empty to disable
+    mongo_compressors: str = ""
+    mongo_zlib_compression_level: int = -1
+
+    # startup warm-up, the phases after connecting run in the background when warm_up_background is set,
+    # /ready answers 503 until all of them are done
+    warm_up_background: bool = False
+    warm_up_pool_timeout_seconds: float = 5.0
+    warm_up_hot_users: int = 1000
+    warm_up_search_hours: int = 2
+
+    # ride search, minutes before and after the requested date
+    ride_search_window_minutes: int = 60
+
+    # caches, the backend is "memory" per worker or "redis" shared by the workers
+    cache_backend: str = "memory"
+    redis_url: Optional[str] = None
+    user_cache_enabled: bool = True
+    user_cache_size: int = 10000
+    user_cache_ttl_seconds: int = 300
+    search_cache_enabled: bool = True
+    search_cache_size: int = 1000
+    search_cache_ttl_seconds: int = 60
+    search_cache_bucket_minutes: int = 60
+
+    # in-memory ride index, holds the bookable rides up to the horizon and is reloaded every resync interval,
+    # the change stream keeps it current with the writes of the other workers (needs a replica set)
+    ride_index_enabled: bool = False
+    ride_index_cell_km: float = 1.0
+    ride_index_bucket_minutes: int = 60
+    ride_index_horizon_hours: int = 24
+    ride_index_resync_minutes: int = 60
+    ride_index_change_stream: bool = False
+
+    # destination lookup, minimum trigram similarity of the destinations suggested for an unknown one
+    destination_suggestion_threshold: float = 0.6
+
+    # ride ranking, score = detour weight * added detour + pickup weight * pickup distance, in km
+    ranking_detour_weight: float = 1.0
+    ranking_pickup_weight: float = 0.0
+    ranking_max_detour_km: float = 5.0
+    place_cache_enabled: bool = True
+    place_cache_size: int = 1000
+    place_cache_ttl_seconds: int = 600
+
+    # ride history, maximum rides per page
+    ride_history_max_limit: int = 500
+
+    # bulk endpoints, documents per bulk write
+    bulk_chunk_size: int = 1000
+
+    # recurring rides, maximum rides created by one recurring offer
+    recurring_max_occurrences: int = 366
+
+    # write-behind of the ride status updates, off by default: the updates are queued, merged per ride and
+    # written as unordered bulk writes when a batch is full or when the oldest one is older than the interval
+    write_behind_enabled: bool = False
+    write_behind_batch_size: int = 500
+    write_behind_flush_interval_ms: int = 100
+    # queued rides above which the callers wait for a flush, and how long before they give up
+    write_behind_max_pending: int = 10000
+    write_behind_put_timeout_seconds: float = 1.0
+    # "acknowledged" waits until the update is written, "fire_and_forget" returns once it is queued
+    write_behind_durability: str = "acknowledged"
+    write_behind_ack_timeout_seconds: float = 10.0
+    # write concern of the bulk writes, w=0 does not wait for mongodb at all
+    write_behind_write_concern: Union[int, str] = 1
+    write_behind_journal: bool = False
+
+    # batch assignment, nearest rides per rider in the first greedy pass
+    assignment_candidates_per_rider: int = 10
+
+    # production server, one worker process per cpu core when workers is 0, the app is imported once by the
+    # master and each forked worker opens its own mongodb client at startup
+    server_host: str = "0.0.0.0"
+    server_port: int = 8005
+    server_workers: int = 0
+    server_preload: bool = True
+    server_loop: str = "uvloop"
+    server_http: str = "httptools"
+    server_backlog: int = 2048
+    server_keep_alive_seconds: int = 5
+    # maximum concurrent connections per worker before answering 503, None for no limit
+    server_limit_concurrency: Optional[int] = None
+    server_timeout_seconds: int = 30
+    server_graceful_timeout_seconds: int = 30
+    # recycle a worker after this many requests, 0 to never recycle
+    server_max_requests: int = 0
+    server_max_requests_jitter: int = 0
+    server_access_log: bool = True
+
+    # admin routes, disabled when no token is set
+    admin_token: Optional[str] = None
+
+    # request profiler, off by default, the profiler header profiles a request when it carries the admin token
+    profiler_enabled: bool = False
+    profiler_sample_rate: float = 0.0
+    profiler_header: str = "X-Profile"
+    profiler_interval_ms: float = 1.0
+    profiler_keep: int = 20
+
+    class Config:
+        validate_assignment = True
+
+    @property
+    def fastapi_kwargs(self) -> Dict[str, Any]:
+        return {
+            "debug": self.debug,
+            "docs_url": self.docs_url,
+            "openapi_prefix": self.openapi_prefix,
+            "openapi_url": self.openapi_url,
+            "redoc_url": self.redoc_url,
+            "title": self.title,
+            "version": self.version,
+        }
+
+    @property
+    def server_worker_count(self) -> int:
+        if self.server_workers > 0:
+            return self.server_workers
+        return os.cpu_count() or 1
+
+    @property
+    def mongo_url(self) -> str:
+        if self.mongo_uri:
+            return self.mongo_uri
+        return f"mongodb://{self.mongo_host}:{self.mongo_port}/?directConnection=true"
+
+    @property
+    def mongo_client_kwargs(self) -> Dict[str, Any]:
+        kwargs = {
+            "maxPoolSize": self.mongo_max_pool_size,
+            "minPoolSize": self.mongo_min_pool_size,
+            "maxIdleTimeMS": self.mongo_max_idle_time_ms,
+            "waitQueueTimeoutMS": self.mongo_wait_queue_timeout_ms,
+            "serverSelectionTimeoutMS": self.mongo_server_selection_timeout_ms,
+            "connectTimeoutMS": self.mongo_connect_timeout_ms,
+            "socketTimeoutMS": self.mongo_socket_timeout_ms,
+            "appName": self.title,
+        }
+        if self.mongo_compressors:
+            kwargs["compressors"] = self.mongo_compressors
+            kwargs["zlibCompressionLevel"] = self.mongo_zlib_compression_level
+        return kwargs
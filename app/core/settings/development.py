@@ -0,0 +1,10 @@
+from app.core.settings.app import AppSettings
+
+
+class DevAppSettings(AppSettings):
+    debug: bool = True
+
+    title: str = "Dev Car Pool Service"
+
+    class Config(AppSettings.Config):
+        env_file = ".env"
@@ -0,0 +1,6 @@
+from app.core.settings.app import AppSettings
+
+
+class ProdAppSettings(AppSettings):
+    class Config(AppSettings.Config):
+        env_file = "prod.env"
@@ -0,0 +1,177 @@
+# batch assignment of many riders to the offered rides of a destination, minimizing the total pickup distance
+from typing import List
+import numpy as np
+from app.core.config import get_app_settings
+from app.models.requestModels import JoinRequest
+from app.handlers.dist_calc_service import distance_matrix
+from app.handlers.car_pool_service import connect_mongo, ride_search_window, get_ride_candidates
+from app.handlers.bulk_service import bulk_join_rides_in_db
+from app.handlers.destination_service import resolve_destination
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # scipy is only needed for the optimal solver
+    linear_sum_assignment = None
+
+# rider index of the pairs which can not be assigned
+UNASSIGNED = -1
+
+
+# function to assign the pairs in ascending distance order while the rider is free and the ride has seats
+def _assign_pairs(rows, cols, pair_distances, assignment, remaining):
+    order = np.argsort(pair_distances, kind="stable")
+    free_riders = int(np.count_nonzero(assignment == UNASSIGNED))
+    free_seats = int(remaining.sum())
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if free_riders == 0 or free_seats == 0:
+            break
+        if assignment[row] != UNASSIGNED or remaining[col] == 0:
+            continue
+        assignment[row] = col
+        remaining[col] -= 1
+        free_riders -= 1
+        free_seats -= 1
+
+
+# function to assign riders to rides greedily, the closest pairs first
+def assign_greedy(distances, seats, max_distance: float = None, candidates_per_rider: int = None):
+    # distances has shape (riders, rides), forbidden pairs are inf
+    distances = np.asarray(distances, dtype=np.float64)
+    riders, rides = distances.shape
+    assignment = np.full(riders, UNASSIGNED, dtype=np.int64)
+    remaining = np.asarray(seats, dtype=np.int64).copy()
+    if riders == 0 or rides == 0:
+        return assignment
+
+    allowed = np.isfinite(distances)
+    if max_distance is not None:
+        allowed &= distances <= max_distance
+
+    # first pass over the k nearest rides of every rider, which keeps the sort small
+    if candidates_per_rider is not None and candidates_per_rider < rides:
+        nearest = np.argpartition(distances, candidates_per_rider - 1, axis=1)[:, :candidates_per_rider]
+        rows = np.repeat(np.arange(riders), candidates_per_rider)
+        cols = nearest.ravel()
+        keep = allowed[rows, cols]
+        _assign_pairs(rows[keep], cols[keep], distances[rows[keep], cols[keep]], assignment, remaining)
+
+    # second pass over all the pairs of the riders which are still free and the rides which still have seats
+    free = np.flatnonzero(assignment == UNASSIGNED)
+    open_rides = np.flatnonzero(remaining > 0)
+    if free.size and open_rides.size:
+        sub_allowed = allowed[np.ix_(free, open_rides)]
+        sub_rows, sub_cols = np.nonzero(sub_allowed)
+        rows = free[sub_rows]
+        cols = open_rides[sub_cols]
+        _assign_pairs(rows, cols, distances[rows, cols], assignment, remaining)
+    return assignment
+
+
+# function to assign riders to rides with the minimum total distance, every seat becomes a column
+def assign_optimal(distances, seats, max_distance: float = None):
+    if linear_sum_assignment is None:
+        raise RuntimeError("the optimal assignment needs the scipy package")
+
+    distances = np.asarray(distances, dtype=np.float64)
+    riders, rides = distances.shape
+    assignment = np.full(riders, UNASSIGNED, dtype=np.int64)
+    seat_rides = np.repeat(np.arange(rides), np.asarray(seats, dtype=np.int64))
+    if riders == 0 or seat_rides.size == 0:
+        return assignment
+
+    # forbidden pairs get a cost above any sum of allowed pairs so that they are only used when nothing else fits
+    cost = distances[:, seat_rides]
+    allowed = np.isfinite(cost)
+    if max_distance is not None:
+        allowed &= cost <= max_distance
+    forbidden = (cost[allowed].sum() + 1) if allowed.any() else 1.0
+    cost = np.where(allowed, cost, forbidden)
+
+    rows, cols = linear_sum_assignment(cost)
+    keep = allowed[rows, cols]
+    assignment[rows[keep]] = seat_rides[cols[keep]]
+    return assignment
+
+
+# function to assign riders to rides with the given method
+def assign(distances, seats, method: str = "greedy", max_distance: float = None, candidates_per_rider: int = None):
+    if method == "greedy":
+        return assign_greedy(distances, seats, max_distance, candidates_per_rider)
+    if method == "optimal":
+        return assign_optimal(distances, seats, max_distance)
+    raise ValueError(f"unknown assignment method {method}")
+
+
+# function to get the coordinates of many users with one query
+def get_user_coordinates(mail_ids, db=None):
+    db = connect_mongo(db)
+    users = db['users'].find(
+        {"mail_id": {"$in": list(set(mail_ids))}},
+        {"_id": 0, "mail_id": 1, "latitude": 1, "longitude": 1}
+    )
+    return {user['mail_id']: (user['latitude'], user['longitude']) for user in users}
+
+
+# function to assign many riders to the rides of a destination around a date, optionally joining them
+def assign_rides_in_db(destination: str, date: str, mail_ids: List[str], method: str = "greedy",
+                       max_distance_km: float = None, commit: bool = False, db=None):
+    db = connect_mongo(db)
+    from_date, to_date = ride_search_window(date)
+
+    # the scheduled rides which still have seats, the ones the join filter accepts, none when the destination
+    # is unknown
+    destination_id = resolve_destination(destination, db)
+    candidates = [] if destination_id is None else get_ride_candidates(destination_id, from_date, to_date, db=db)
+    rides = [
+        candidate['ride'] for candidate in candidates
+        if candidate['ride'].get('status') == "scheduled"
+        and candidate['ride']['seats_offered'] - len(candidate['ride']['riders']) > 0
+    ]
+    seats = [ride['seats_offered'] - len(ride['riders']) for ride in rides]
+
+    # the riders which exist, in the order of the request
+    coordinates = get_user_coordinates(mail_ids, db=db)
+    riders = [mail_id for mail_id in dict.fromkeys(mail_ids) if mail_id in coordinates]
+
+    distances = distance_matrix(
+        [coordinates[mail_id][0] for mail_id in riders], [coordinates[mail_id][1] for mail_id in riders],
+        [ride['latitude'] for ride in rides], [ride['longitude'] for ride in rides]
+    )
+
+    # drivers do not ride, and riders are not assigned twice to the same ride
+    rider_index = {mail_id: index for index, mail_id in enumerate(riders)}
+    for col, ride in enumerate(rides):
+        if ride['mail_id'] in rider_index:
+            distances[rider_index[ride['mail_id']], :] = np.inf
+        for rider in ride['riders']:
+            if rider in rider_index:
+                distances[rider_index[rider], col] = np.inf
+
+    assignment = assign(distances, seats, method, max_distance_km,
+                        get_app_settings().assignment_candidates_per_rider)
+
+    result = {"assigned": [], "unassigned": [], "total_distance_km": 0.0}
+    for row, col in enumerate(assignment.tolist()):
+        if col == UNASSIGNED:
+            result["unassigned"].append(riders[row])
+            continue
+        distance = float(distances[row, col])
+        result["assigned"].append({"mail_id": riders[row], "ride_id": str(rides[col]['_id']), "distance_away": distance})
+        result["total_distance_km"] += distance
+    # the unknown users can not be assigned
+    result["unassigned"].extend(mail_id for mail_id in dict.fromkeys(mail_ids) if mail_id not in coordinates)
+
+    # join the riders to their rides, the seats are checked again by the join filter
+    if commit and result["assigned"]:
+        joins = [JoinRequest(ride_id=item["ride_id"], mail_id=item["mail_id"]) for item in result["assigned"]]
+        result["joins"] = bulk_join_rides_in_db(joins, db=db)
+        # the riders whose join was rejected or failed, e.g. the ride filled up meanwhile, are not assigned
+        joined = set(result["joins"]["joined"])
+        assigned, result["assigned"] = result["assigned"], []
+        for index, item in enumerate(assigned):
+            if index in joined:
+                result["assigned"].append(item)
+            else:
+                result["unassigned"].append(item["mail_id"])
+        result["total_distance_km"] = sum(item["distance_away"] for item in result["assigned"])
+    return result
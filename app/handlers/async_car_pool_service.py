@@ -0,0 +1,86 @@
+# async facade over car_pool_service, the blocking pymongo calls run in a
+# bounded thread pool so that they never block the event loop
+import asyncio
+import itertools
+import functools
+from anyio import CapacityLimiter, to_thread
+from app.core.config import get_app_settings
+from app.handlers import car_pool_service, bulk_service, assignment_service, write_behind
+
+# created lazily so that it binds to the running event loop
+_limiter = None
+
+
+# function to get the limiter which bounds the db threads
+def get_db_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = CapacityLimiter(get_app_settings().db_threads)
+    return _limiter
+
+
+# function to run a blocking db function in the bounded thread pool
+async def run_db(func, *args, **kwargs):
+    return await to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=get_db_limiter())
+
+
+# function to iterate a blocking iterator, e.g. a mongodb cursor, in the bounded thread pool,
+# the items are read chunk_size at a time so that each thread call reads a batch of the cursor,
+# the first chunk is read before returning so that the errors of the query are raised to the caller
+async def iter_db(iterator, chunk_size: int = 100):
+    iterator = iter(iterator)
+
+    def read():
+        return list(itertools.islice(iterator, chunk_size))
+
+    first = await run_db(read)
+
+    async def items():
+        chunk = first
+        while chunk:
+            for item in chunk:
+                yield item
+            chunk = await run_db(read)
+
+    return items()
+
+
+# function to build an awaitable version of a service function
+def _offload(name, module=car_pool_service):
+    async def wrapper(*args, **kwargs):
+        # resolve the function at call time so that it can be patched
+        return await run_db(getattr(module, name), *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__qualname__ = name
+    return wrapper
+
+
+create_user_in_db = _offload('create_user_in_db')
+get_user_by_id = _offload('get_user_by_id')
+update_user_in_db = _offload('update_user_in_db')
+delete_user_in_db = _offload('delete_user_in_db')
+create_ride_in_db = _offload('create_ride_in_db')
+get_ride_by_id = _offload('get_ride_by_id')
+find_rides_by_lat_lon = _offload('find_rides_by_lat_lon')
+suggest_destinations_in_db = _offload('suggest_destinations_in_db')
+update_riders_in_db = _offload('update_riders_in_db')
+update_ride_status_in_db = _offload('update_ride_status_in_db')
+upsert_place_in_db = _offload('upsert_place_in_db')
+bulk_upsert_users_in_db = _offload('bulk_upsert_users_in_db', bulk_service)
+create_recurring_rides_in_db = _offload('create_recurring_rides_in_db', bulk_service)
+create_recurring_ride_offer_in_db = _offload('create_recurring_ride_offer_in_db', bulk_service)
+bulk_join_rides_in_db = _offload('bulk_join_rides_in_db', bulk_service)
+assign_rides_in_db = _offload('assign_rides_in_db', assignment_service)
+close_status_queue = _offload('close_status_queue', write_behind)
+
+
+# function to queue a ride status update, only the put runs in a db thread, the write of an acknowledged
+# update is awaited on the event loop so that no db thread is held until the flush
+async def queue_ride_status(ride_id: str, status: str, durability: str = None, db=None):
+    result, future = await run_db(write_behind.put_ride_status, ride_id, status, durability, db=db)
+    if future is not None:
+        # shielded, the future is shared by the merged updates of the ride and completed by the flusher
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                               get_app_settings().write_behind_ack_timeout_seconds)
+    return result
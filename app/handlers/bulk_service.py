@@ -0,0 +1,210 @@
+# batch variants of the user, ride and join handlers built on unordered bulk writes
+from datetime import timedelta
+from typing import List
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from app.core.config import get_app_settings
+from app.models.requestModels import User, JoinRequest, RecurringRide
+from app.handlers.car_pool_service import (connect_mongo, user_document, ride_document,
+    ride_join_filter, parse_ride_date, get_user_by_id, invalidate_users, invalidate_ride_buckets,
+    index_rides, update_indexed_ride, get_search_cache
+)
+from app.handlers.destination_service import intern_destination
+
+
+# function to split the items in chunks of the configured size
+def chunked(items, chunk_size: int = None):
+    if chunk_size is None:
+        chunk_size = get_app_settings().bulk_chunk_size
+    for start in range(0, len(items), chunk_size):
+        yield start, items[start:start + chunk_size]
+
+
+# function to convert the write errors of a chunk to per-item errors
+def write_errors(error: BulkWriteError, offset: int):
+    return [
+        {"index": offset + write_error["index"], "code": write_error.get("code"), "message": write_error.get("errmsg")}
+        for write_error in error.details.get("writeErrors", [])
+    ]
+
+
+# function to upsert many users by mail id
+def bulk_upsert_users_in_db(users: List[User], chunk_size: int = None, db=None):
+    db = connect_mongo(db)
+    collection = db['users']
+    result = {"upserted": 0, "modified": 0, "errors": []}
+
+    for offset, chunk in chunked(users, chunk_size):
+        operations = [
+            UpdateOne({"mail_id": user.mail_id}, {"$set": user_document(user)}, upsert=True)
+            for user in chunk
+        ]
+        try:
+            bulk_result = collection.bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as error:
+            # unordered writes keep going, the details hold the counts and the failed items
+            bulk_result = error.details
+            result["errors"].extend(write_errors(error, offset))
+        result["upserted"] += bulk_result.get("nUpserted", 0)
+        result["modified"] += bulk_result.get("nModified", 0)
+
+    invalidate_users(*[user.mail_id for user in users])
+    return result
+
+
+# function to expand a recurring ride to its dates
+def recurring_dates(date, occurrences: int, interval_days: int = 1, weekdays_only: bool = False):
+    maximum = get_app_settings().recurring_max_occurrences
+    if not 1 <= occurrences <= maximum:
+        raise ValueError(f"occurrences must be between 1 and {maximum}")
+    if interval_days < 1:
+        raise ValueError("interval_days must be at least 1")
+    date = parse_ride_date(date)
+    # a whole number of weeks keeps the weekday, a weekend start never reaches a weekday
+    if weekdays_only and interval_days % 7 == 0 and date.weekday() >= 5:
+        raise ValueError("a weekday only ride repeated every week can not start on a weekend")
+
+    dates = []
+    # any other interval reaches a weekday within 7 steps, so the loop is bounded
+    for _ in range(occurrences * 7):
+        if len(dates) == occurrences:
+            break
+        # saturday and sunday are skipped for weekday commutes
+        if not weekdays_only or date.weekday() < 5:
+            dates.append(date)
+        date += timedelta(days=interval_days)
+    return dates
+
+
+# function to create the rides of a recurring ride offer
+def create_recurring_rides_in_db(mail_id: str, dates: list, destination: str, seats_offered: int,
+                                 vehicle_type: str, chunk_size: int = None, db=None):
+    db = connect_mongo(db)
+    collection = db['rides']
+    # fetch lat long from user once for all the rides
+    user = get_user_by_id(mail_id, db=db)
+    destination_id = intern_destination(destination, db)
+    documents = [ride_document(user, mail_id, date, destination_id, seats_offered, vehicle_type) for date in dates]
+    result = {"inserted_ids": [], "errors": []}
+
+    for offset, chunk in chunked(documents, chunk_size):
+        try:
+            result["inserted_ids"].extend(collection.insert_many(chunk, ordered=False).inserted_ids)
+        except BulkWriteError as error:
+            errors = write_errors(error, offset)
+            failed = {item["index"] for item in errors}
+            # insert_many sets the _id of every document before sending them
+            result["inserted_ids"].extend(
+                document["_id"] for index, document in enumerate(chunk, offset) if index not in failed
+            )
+            result["errors"].extend(errors)
+
+    invalidate_ride_buckets(*documents)
+    inserted_ids = set(result["inserted_ids"])
+    index_rides(*[document for document in documents if document.get("_id") in inserted_ids],
+                address=user.get('address'), db=db)
+    return result
+
+
+# function to expand a recurring ride offer and create its rides
+def create_recurring_ride_offer_in_db(ride: RecurringRide, chunk_size: int = None, db=None):
+    dates = recurring_dates(ride.date, ride.occurrences, ride.interval_days, ride.weekdays_only)
+    return create_recurring_rides_in_db(ride.mail_id, dates, ride.destination, ride.seats_offered,
+                                        ride.vehicle_type, chunk_size, db=db)
+
+
+# function to join many riders to rides, each join keeps the seat checks of update_riders_in_db
+def bulk_join_rides_in_db(joins: List[JoinRequest], chunk_size: int = None, db=None):
+    db = connect_mongo(db)
+    collection = db['rides']
+    result = {"joined": [], "rejected": [], "errors": []}
+
+    for offset, chunk in chunked(joins, chunk_size):
+        filters = [ride_join_filter(join.ride_id, join.mail_id) for join in chunk]
+        ride_ids = list({join_filter["_id"] for join_filter in filters})
+
+        # riders of the rides before the write, a rider who is already on a ride is not joined again
+        riders_before = {
+            ride["_id"]: set(ride["riders"])
+            for ride in collection.find({"_id": {"$in": ride_ids}}, {"riders": 1})
+        }
+
+        # one write per (ride, rider) pair, the repeated pairs of the chunk are rejected
+        sent = {}
+        for index, (join, join_filter) in enumerate(zip(chunk, filters), offset):
+            pair = (join_filter["_id"], join.mail_id)
+            if pair not in sent and join.mail_id not in riders_before.get(pair[0], ()):
+                sent[pair] = index
+        operations = [UpdateOne(ride_join_filter(str(ride_id), mail_id), {"$push": {"riders": mail_id}})
+                      for ride_id, mail_id in sent]
+
+        failed = set()
+        if operations:
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as error:
+                # map the operation indexes back to the indexes of the joins
+                indexes = list(sent.values())
+                for item in write_errors(error, 0):
+                    item["index"] = indexes[item["index"]]
+                    failed.add(item["index"])
+                    result["errors"].append(item)
+
+        # read back the rides of the chunk once, a join succeeded when its rider was added by this write
+        rides = {
+            ride["_id"]: ride
+            for ride in collection.find({"_id": {"$in": ride_ids}},
+                                        {"riders": 1, "destination_id": 1, "date": 1})
+        }
+        joined = {
+            index for (ride_id, mail_id), index in sent.items()
+            if index not in failed and ride_id in rides and mail_id in rides[ride_id]["riders"]
+        }
+        for index in range(offset, offset + len(chunk)):
+            if index in joined:
+                result["joined"].append(index)
+            elif index not in failed:
+                # the ride is missing, full, not scheduled, offered by the rider or already joined by them
+                result["rejected"].append(index)
+        invalidate_ride_buckets(*rides.values())
+        for ride in rides.values():
+            update_indexed_ride(ride["_id"], {"riders": ride["riders"]})
+
+    return result
+
+
+# function to set the status of many rides, statuses maps the ride ids to their new status
+def bulk_update_ride_status_in_db(statuses: dict, write_concern=None, chunk_size: int = None, db=None):
+    db = connect_mongo(db)
+    collection = db['rides']
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    result = {"modified": 0, "errors": {}}
+
+    items = [(ObjectId(ride_id), status) for ride_id, status in statuses.items()]
+    for _, chunk in chunked(items, chunk_size):
+        operations = [
+            UpdateOne({"_id": ride_id, "status": {"$ne": status}}, {"$set": {"status": status}})
+            for ride_id, status in chunk
+        ]
+        try:
+            written = collection.bulk_write(operations, ordered=False)
+            # unacknowledged writes have no counts
+            if written.acknowledged:
+                result["modified"] += written.modified_count
+        except BulkWriteError as error:
+            result["modified"] += error.details.get("nModified", 0)
+            for item in write_errors(error, 0):
+                result["errors"][chunk[item["index"]][0]] = item["message"]
+
+        # read back the bucket fields of the chunk once to drop the cached searches
+        if get_search_cache() is not None:
+            rides = db['rides'].find({"_id": {"$in": [ride_id for ride_id, _ in chunk]}},
+                                     {"destination_id": 1, "date": 1})
+            invalidate_ride_buckets(*rides)
+        for ride_id, status in chunk:
+            if ride_id not in result["errors"]:
+                update_indexed_ride(ride_id, {"status": status})
+
+    return result
@@ -1,39 +1,332 @@
 # implementations
-import json
 from bson import ObjectId
-from datetime import datetime, timedelta
-from bson.json_util import dumps
-from app.models.requestModels import User, Ride
-from app.handlers.dist_calc_service import find_nearest
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+import threading
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from app.models.requestModels import User, Ride, Place
+from app.handlers.dist_calc_service import distances_from, select_nearest, detour_order, DEFAULT_RADIUS_KM
+from app.core.mongo import get_database
+from app.core.config import get_app_settings
+from app.core.cache import create_cache
+from app.core.metrics import RIDE_SEARCH_CANDIDATES, RIDE_SEARCH_LAST_CANDIDATES
+from app.handlers.ride_index import RideIndex
+from app.handlers.destination_service import (intern_destination, resolve_destination, destination_label,
+    decode_destination, normalize_destination, suggest_destinations
+)
+
+# name of the 2dsphere indexed GeoJSON field on users and rides
+LOCATION_FIELD = "location"
+
+
+# format of the ISO date strings accepted by the api
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+# cache of the user documents, created on first use
+_user_cache = None
+
+
+# function to get the user cache, None when it is disabled
+def get_user_cache():
+    global _user_cache
+    settings = get_app_settings()
+    if not settings.user_cache_enabled:
+        return None
+    if _user_cache is None:
+        _user_cache = create_cache(
+            settings.cache_backend,
+            "users",
+            settings.user_cache_size,
+            settings.user_cache_ttl_seconds,
+            settings.redis_url
+        )
+    return _user_cache
+
+
+# cache of the ride search candidates per destination and time bucket, created on first use
+_search_cache = None
+
+
+# function to get the search cache, None when it is disabled
+def get_search_cache():
+    global _search_cache
+    settings = get_app_settings()
+    if not settings.search_cache_enabled:
+        return None
+    if _search_cache is None:
+        _search_cache = create_cache(
+            settings.cache_backend,
+            "ride_candidates",
+            settings.search_cache_size,
+            settings.search_cache_ttl_seconds,
+            settings.redis_url
+        )
+    return _search_cache
+
+
+# cache of the destination coordinates, created on first use
+_place_cache = None
+
+
+# function to get the place cache, None when it is disabled
+def get_place_cache():
+    global _place_cache
+    settings = get_app_settings()
+    if not settings.place_cache_enabled:
+        return None
+    if _place_cache is None:
+        _place_cache = create_cache(
+            settings.cache_backend,
+            "places",
+            settings.place_cache_size,
+            settings.place_cache_ttl_seconds,
+            settings.redis_url
+        )
+    return _place_cache
+
+
+# in-memory index of the bookable rides, created on first use
+_ride_index = None
+# held by the reload of the ride index, one reload runs at a time
+_ride_index_lock = threading.Lock()
+# background reload of the ride index
+_ride_index_sync = None
+_ride_index_sync_lock = threading.Lock()
+
+
+# function to get the ride index, None when it is disabled
+def get_ride_index():
+    global _ride_index
+    settings = get_app_settings()
+    if not settings.ride_index_enabled:
+        return None
+    if _ride_index is None:
+        _ride_index = RideIndex(settings.ride_index_cell_km, settings.ride_index_bucket_minutes)
+    return _ride_index
+
+
+# function to reload the ride index from mongodb, it holds the bookable rides from the search window
+# before now to the horizon after now, the writes made during the query are replayed on the reloaded index
+def sync_ride_index(db=None):
+    index = get_ride_index()
+    if index is None:
+        return None
+    settings = get_app_settings()
+    with _ride_index_lock:
+        index.begin_reload()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        from_date = now - timedelta(minutes=settings.ride_search_window_minutes)
+        to_date = now + timedelta(hours=settings.ride_index_horizon_hours)
+        try:
+            candidates = load_ride_candidates(None, from_date, to_date, db=db)
+        except Exception:
+            index.cancel_reload()
+            raise
+        index.replace(candidates, from_date, to_date)
+    return index
+
+
+# function to reload the ride index in a background thread, unless a reload is running
+def start_ride_index_sync(db=None):
+    global _ride_index_sync
+
+    def sync():
+        try:
+            sync_ride_index(db)
+        except PyMongoError as error:
+            print(f'ride index reload failed: {error}')
+
+    with _ride_index_sync_lock:
+        if _ride_index_sync is not None and _ride_index_sync.is_alive():
+            return None
+        _ride_index_sync = threading.Thread(target=sync, name="ride-index-sync", daemon=True)
+        _ride_index_sync.start()
+        return _ride_index_sync
+
+
+# function to get the ride index, a reload starts in the background when it is older than the resync interval,
+# the searches meanwhile use the current index, or the search cache outside of its coverage
+def get_synced_ride_index(db=None):
+    index = get_ride_index()
+    if index is None:
+        return None
+    resync = timedelta(minutes=get_app_settings().ride_index_resync_minutes)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if index.loaded_at is None or now - index.loaded_at > resync:
+        start_ride_index_sync(db)
+    return index
+
+
+# function to add or replace rides in the ride index after a write
+def index_rides(*rides, address=None, db=None):
+    index = get_ride_index()
+    if index is not None and index.tracks_writes():
+        for ride in rides:
+            index.upsert(decode_destination(dict(ride), db), address)
+
+
+# function to change some fields of a ride in the ride index after a write
+def update_indexed_ride(ride_id, fields: dict):
+    index = get_ride_index()
+    if index is not None and index.tracks_writes():
+        index.update(ride_id, fields)
+
+
+# function to keep the ride index current with the writes of every worker through a change stream,
+# it runs until the stream fails, e.g. on a standalone mongodb which has no change streams
+def watch_ride_changes(db=None):
+    db = connect_mongo(db)
+    index = get_synced_ride_index(db)
+    try:
+        with db['rides'].watch(full_document="updateLookup") as stream:
+            for change in stream:
+                if change["operationType"] == "delete":
+                    index.remove(change["documentKey"]["_id"])
+                    continue
+                ride = change.get("fullDocument")
+                if ride is None:
+                    continue
+                # the address of the driver is only needed for a new ride, the index keeps it on updates
+                address = None
+                if change["operationType"] == "insert":
+                    address = get_user_addresses([ride['mail_id']], db=db).get(ride['mail_id'])
+                index_rides(ride, address=address, db=db)
+    except PyMongoError as error:
+        print(f'ride index change stream stopped: {error}')
+
+
+# function to follow the ride changes in a background thread
+def start_ride_change_stream(db=None):
+    thread = threading.Thread(target=watch_ride_changes, args=(db,), name="ride-change-stream", daemon=True)
+    thread.start()
+    return thread
+
+
+# function to get the start of the time bucket of a date
+def search_bucket_start(date: datetime):
+    bucket = timedelta(minutes=get_app_settings().search_cache_bucket_minutes)
+    return datetime.min + ((date - datetime.min) // bucket) * bucket
+
+
+# function to build the search cache key of a destination and time bucket
+def search_bucket_key(destination_id: int, bucket_start: datetime):
+    return f"{destination_id}|{bucket_start.isoformat()}"
+
+
+# function to drop the cached candidates of the buckets of the given rides
+def invalidate_ride_buckets(*rides):
+    cache = get_search_cache()
+    if cache is not None:
+        cache.delete(*[
+            search_bucket_key(ride['destination_id'], search_bucket_start(parse_ride_date(ride['date'])))
+            for ride in rides if ride is not None
+        ])
+
+
+# function to drop users from the cache after a write
+def invalidate_users(*mail_ids):
+    cache = get_user_cache()
+    if cache is not None:
+        cache.delete(*mail_ids)
 
 
 # function to connect the mongodb
-def connect_mongo():
-    # read the db from app state
-    from main import app
-    db = app.state.db
-    return db
+def connect_mongo(db=None):
+    # use the injected db, else the db opened at startup
+    if db is not None:
+        return db
+    return get_database()
+
+
+# function to build a GeoJSON point, GeoJSON stores longitude first
+def geo_point(latitude: float, longitude: float):
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+
+# function to build the users collection document of a user
+def user_document(user: User):
+    document = user.dict()
+    document[LOCATION_FIELD] = geo_point(user.latitude, user.longitude)
+    return document
 
 
 # function to create user in mongodb users collection
-def create_user_in_db(user: User):
-    db = connect_mongo()
+def create_user_in_db(user: User, db=None):
+    db = connect_mongo(db)
     collection = db['users']
-    result = collection.insert_one(user.dict())
+    result = collection.insert_one(user_document(user))
+    invalidate_users(user.mail_id)
     return result.inserted_id
 
 
 # function to get user by id from mongodb users collection
-def get_user_by_id(mail_id: str):
-    db = connect_mongo()
+def get_user_by_id(mail_id: str, db=None):
+    # read through the user cache
+    cache = get_user_cache()
+    if cache is not None:
+        user = cache.get(mail_id)
+        if user is not None:
+            return dict(user)
+        # a write of the user during the query invalidates it, the read user is then not cached
+        generation = cache.generation(mail_id)
+
+    db = connect_mongo(db)
     collection = db['users']
     result = collection.find_one({"mail_id": mail_id})
-    return dumps(result)
+
+    # unknown users are not cached, they may register any time
+    if cache is not None and result is not None:
+        cache.set_if_generation(mail_id, result, generation)
+        result = dict(result)
+    return result
+
+
+# function to load the drivers and riders of the upcoming rides into the user cache, up to limit users
+def preload_hot_users(limit: int, db=None):
+    cache = get_user_cache()
+    if cache is None or limit <= 0:
+        return 0
+    db = connect_mongo(db)
+    settings = get_app_settings()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    from_date = now - timedelta(minutes=settings.ride_search_window_minutes)
+    to_date = now + timedelta(hours=settings.ride_index_horizon_hours)
+    # the users written during the load are not cached
+    generation = cache.generation()
+
+    # the soonest rides first, until there are enough users
+    mail_ids = {}
+    rides = db['rides'].find(ride_candidates_filter(None, from_date, to_date), {"_id": 0, "mail_id": 1, "riders": 1})
+    for ride in rides.sort("date", 1):
+        for mail_id in [ride['mail_id'], *ride.get('riders', [])]:
+            mail_ids.setdefault(mail_id, None)
+        if len(mail_ids) >= limit:
+            break
+
+    users = db['users'].find({"mail_id": {"$in": list(mail_ids)[:limit]}})
+    count = 0
+    for user in users:
+        count += cache.set_if_generation(user['mail_id'], user, generation)
+    return count
+
+
+# function to get the addresses of many users with one query
+def get_user_addresses(mail_ids, db=None):
+    db = connect_mongo(db)
+    collection = db['users']
+    # fetch only the fields needed, for all the users at once
+    users = collection.find(
+        {"mail_id": {"$in": list(set(mail_ids))}},
+        {"_id": 0, "mail_id": 1, "address": 1}
+    )
+    return {user['mail_id']: user.get('address') for user in users}
 
 
 # function to update user by id in mongodb users collection
-def update_user_in_db(user: User, mail_id: str):
-    db = connect_mongo()
+def update_user_in_db(user: User, mail_id: str, db=None):
+    db = connect_mongo(db)
     collection = db['users']
 
     # iterate over the vehicle list and convert it to dict
@@ -53,169 +346,506 @@ def update_user_in_db(user: User, mail_id: str):
                     "address": user.address,
                     "latitude": float(user.latitude),
                     "longitude": float(user.longitude),
+                    LOCATION_FIELD: geo_point(user.latitude, user.longitude),
                     "vehicle": vehicles
                 }
         }
     )
+    invalidate_users(mail_id, user.mail_id)
     return result.modified_count
 
 
 # function to delete user by id from mongodb users collection
-def delete_user_in_db(mail_id: str):
-    db = connect_mongo()
+def delete_user_in_db(mail_id: str, db=None):
+    db = connect_mongo(db)
     collection = db['users']
     result = collection.delete_one({"mail_id": mail_id})
+    invalidate_users(mail_id)
     return result.deleted_count
 
 
+# function to create or update the coordinates of a destination in the places collection
+def upsert_place_in_db(place: Place, db=None):
+    db = connect_mongo(db)
+    collection = db['places']
+    name = normalize_destination(place.name)
+    result = collection.update_one({"name": name}, {"$set": {**place.dict(), "name": name}}, upsert=True)
+    cache = get_place_cache()
+    if cache is not None:
+        cache.delete(name)
+    return result.upserted_id or result.modified_count
+
+
+# function to get the coordinates of a destination, None when it is not in the places table
+def get_place(name: str, db=None):
+    name = normalize_destination(name)
+    cache = get_place_cache()
+    place = cache.get(name) if cache is not None else None
+    if place is None:
+        generation = cache.generation(name) if cache is not None else None
+        db = connect_mongo(db)
+        place = db['places'].find_one({"name": name}, {"_id": 0, "latitude": 1, "longitude": 1})
+        # unknown places are cached empty so that every search does not query them again
+        place = dict(place) if place else {}
+        if cache is not None:
+            cache.set_if_generation(name, place, generation)
+    return place or None
+
+
 # function to create offer ride in mongodb rides collection
-def create_ride_in_db(mail_id: str, date: str, destination: str, seats_offered: int, vehicle_type: str):
-    db = connect_mongo()
+def create_ride_in_db(mail_id: str, date: str, destination: str, seats_offered: int, vehicle_type: str, db=None):
+    db = connect_mongo(db)
     # fetch lat long from user
-    user = get_user_by_id(mail_id)
-    if isinstance(user, dict):  
-        user = json.dumps(user)
-    user_json = json.loads(user)
-    latitude = user_json.get('latitude')
-    longitude = user_json.get('longitude')
+    user = get_user_by_id(mail_id, db=db)
+
+    collection = db['rides']
+    destination_id = intern_destination(destination, db)
+    document = ride_document(user, mail_id, date, destination_id, seats_offered, vehicle_type)
+    result = collection.insert_one(document)
+    invalidate_ride_buckets(document)
+    index_rides(document, address=user.get('address'), db=db)
+    return result.inserted_id
+
+
+# function to build the rides collection document of a ride offered by a user
+def ride_document(user: dict, mail_id: str, date, destination_id: int, seats_offered: int, vehicle_type: str):
+    latitude = user.get('latitude')
+    longitude = user.get('longitude')
 
     # build the ride object
     ride = Ride(
         mail_id=mail_id, 
         latitude=latitude, 
         longitude=longitude, 
-        destination=destination,
+        destination_id=destination_id,
         seats_offered=seats_offered,
         riders=[],
-        date=date,
+        date=parse_ride_date(date),
         status="scheduled",
-        vehicle=vehicle_type
+        vehicle=vehicle_type,
+        location=geo_point(latitude, longitude)
     )
+    return ride.dict()
+
+
+# function to build the filter for the rides offered or joined by a user
+def ride_history_filter(mail_id: str, status: str):
+    return {
+                "$or": [
+                    {
+                        "mail_id": mail_id,
+                        "status": status
+                    },
+                    {
+                        "riders": mail_id,
+                        "status": status
+                    }
+                ]}
 
+
+# function to iterate the rides of a user straight from the mongodb cursor,
+# after is the _id of the last ride of the previous page, the query is checked and the cursor built on call
+def iter_rides_by_id(mail_id: str, status: str, after: str = None, limit: int = None, fields: list = None,
+                     db=None):
+    db = connect_mongo(db)
     collection = db['rides']
-    result = collection.insert_one(ride.dict())
-    return result.inserted_id
+
+    # keyset pagination, continue after the last ride of the previous page
+    query = ride_history_filter(mail_id, status)
+    if after is not None:
+        query = {"$and": [query, {"_id": {"$gt": ObjectId(after)}}]}
+
+    # riders is always read to compute is_rider, the destination name is decoded from its id
+    if fields:
+        projection = {("destination_id" if field == "destination" else field): 1 for field in fields}
+        projection["riders"] = 1
+        result = collection.find(query, projection)
+    else:
+        result = collection.find(query)
+
+    # pages are ordered by _id so that the keyset is stable
+    if limit is not None or after is not None:
+        result = result.sort("_id", 1)
+    if limit is not None:
+        result = result.limit(limit)
+
+    return (history_ride(ride, mail_id, fields, db) for ride in result)
+
+
+# function to shape a ride of the ride history
+def history_ride(ride: dict, mail_id: str, fields: list, db):
+    # find if mail_id is present in riders list
+    # and add is_rider key to each ride
+    ride['is_rider'] = mail_id in ride.get('riders', [])
+    if fields and 'riders' not in fields:
+        del ride['riders']
+    return decode_destination(ride, db)
 
 
 # function to get ride by id from mongodb rides collection
-def get_ride_by_id(mail_id: str, status: str):
-    db = connect_mongo()
+def get_ride_by_id(mail_id: str, status: str, after: str = None, limit: int = None, fields: list = None,
+                   db=None):
+    return list(iter_rides_by_id(mail_id, status, after, limit, fields, db=db))
+
+
+# function to convert an ISO date string to a naive UTC datetime, as stored by mongodb
+def parse_ride_date(date):
+    if not isinstance(date, datetime):
+        try:
+            date = datetime.strptime(date, DATE_FORMAT)
+        except ValueError:
+            # accept the other ISO formats, e.g. without milliseconds or with an offset
+            date = datetime.fromisoformat(date.replace('Z', '+00:00'))
+    # convert aware datetimes to UTC and drop the tzinfo
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+# function to build the search window around the given date
+def ride_search_window(date, window_minutes: int = None):
+    # read the window from the settings when not given
+    if window_minutes is None:
+        window_minutes = get_app_settings().ride_search_window_minutes
+    date = parse_ride_date(date)
+    window = timedelta(minutes=window_minutes)
+    return date - window, date + window
+
+
+# function to build the filter for bookable rides of other users
+def ride_search_filter(mail_id: str, destination_id: int, date):
+    from_date, to_date = ride_search_window(date)
+    # find the rides which are not completed and seats_offered is greater than 0
+    # and mail_id is not equal to the user mail_id
+    return {
+        "status": {"$ne": "completed"},
+        "seats_offered": {"$gt": 0},
+        "mail_id": {"$ne": mail_id},
+        "destination_id": destination_id,
+        "date": {"$gte": from_date, "$lte": to_date}
+    }
+
+
+# function to build the filter for the bookable rides of a destination in a date range, of every destination
+# when destination_id is None
+def ride_candidates_filter(destination_id: int, from_date: datetime, to_date: datetime):
+    query = {
+        "status": {"$ne": "completed"},
+        "seats_offered": {"$gt": 0},
+        "destination_id": destination_id,
+        "date": {"$gte": from_date, "$lte": to_date}
+    }
+    if destination_id is None:
+        del query["destination_id"]
+    return query
+
+
+# function to load the bookable rides of a destination in a date range, with the driver address
+def load_ride_candidates(destination_id: int, from_date: datetime, to_date: datetime, db=None):
+    db = connect_mongo(db)
     collection = db['rides']
-    result = collection.find({
-                                "$or": [
-                                    {
-                                        "mail_id": mail_id, 
-                                        "status": status
-                                    },
-                                    {
-                                        "riders": mail_id, 
-                                        "status": status
-                                    }
-                                ]})
-
-    # validate the result
-    if result is None:
-        return None
-    
-    # find if mail_id is present in riders list
-    # and add is_rider key to the result
-    rides = []
-    for ride in result:
-        if mail_id in ride['riders']:
-            ride['is_rider'] = True
+    rides = [
+        decode_destination(ride, db)
+        for ride in collection.find(ride_candidates_filter(destination_id, from_date, to_date))
+    ]
+
+    # resolve the driver addresses for all the rides in one query
+    addresses = get_user_addresses([ride['mail_id'] for ride in rides], db=db) if rides else {}
+    return [{"ride": ride, "address": addresses.get(ride['mail_id'])} for ride in rides]
+
+
+# function to get the ride candidates of a destination in a date range through the search cache
+def get_ride_candidates(destination_id: int, from_date: datetime, to_date: datetime, db=None):
+    cache = get_search_cache()
+    if cache is None:
+        return load_ride_candidates(destination_id, from_date, to_date, db=db)
+
+    # collect the cached buckets covering the date range
+    bucket_size = timedelta(minutes=get_app_settings().search_cache_bucket_minutes)
+    buckets = {}
+    # bucket start -> generation of the missing bucket before it is loaded
+    missing = {}
+    bucket_start = search_bucket_start(from_date)
+    while bucket_start <= to_date:
+        key = search_bucket_key(destination_id, bucket_start)
+        candidates = cache.get(key)
+        if candidates is None:
+            missing[bucket_start] = cache.generation(key)
         else:
-            ride['is_rider'] = False
-        
-        rides.append(ride)
+            buckets[bucket_start] = candidates
+        bucket_start += bucket_size
+
+    # load all the missing buckets with one query and cache them one by one, a bucket invalidated by a ride
+    # write during the query is returned to this search but not cached
+    if missing:
+        loaded = {bucket_start: [] for bucket_start in missing}
+        starts = list(missing)
+        range_end = starts[-1] + bucket_size - timedelta(microseconds=1)
+        for candidate in load_ride_candidates(destination_id, starts[0], range_end, db=db):
+            bucket_start = search_bucket_start(candidate['ride']['date'])
+            if bucket_start in loaded:
+                loaded[bucket_start].append(candidate)
+        for bucket_start, candidates in loaded.items():
+            cache.set_if_generation(search_bucket_key(destination_id, bucket_start), candidates,
+                                    missing[bucket_start])
+        buckets.update(loaded)
+
+    # keep only the rides within the date range
+    return [
+        candidate
+        for candidates in buckets.values()
+        for candidate in candidates
+        if from_date <= candidate['ride']['date'] <= to_date
+    ]
 
-    return dumps(rides)
+
+# function to load the bookable rides of the next hours into the search cache, every bucket of the range
+# is cached, empty ones included, so that the searches of the range do not query mongodb
+def preload_ride_candidates(hours: int, db=None):
+    cache = get_search_cache()
+    if cache is None or hours <= 0:
+        return 0
+    settings = get_app_settings()
+    bucket_size = timedelta(minutes=settings.search_cache_bucket_minutes)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    from_date = search_bucket_start(now - timedelta(minutes=settings.ride_search_window_minutes))
+    to_date = search_bucket_start(now + timedelta(hours=hours)) + bucket_size - timedelta(microseconds=1)
+    # the buckets are not known before the load, the buckets invalidated since the cache generation are skipped
+    generation = cache.generation()
+
+    buckets = {}
+    for candidate in load_ride_candidates(None, from_date, to_date, db=db):
+        ride = candidate['ride']
+        key = (ride['destination_id'], search_bucket_start(ride['date']))
+        buckets.setdefault(key, []).append(candidate)
+
+    # the destinations which have rides get an empty bucket for the hours without any
+    for destination_id in {destination_id for destination_id, _ in buckets}:
+        bucket_start = from_date
+        while bucket_start <= to_date:
+            buckets.setdefault((destination_id, bucket_start), [])
+            bucket_start += bucket_size
+    count = 0
+    for (destination_id, bucket_start), candidates in buckets.items():
+        if cache.set_if_generation(search_bucket_key(destination_id, bucket_start), candidates, generation):
+            count += len(candidates)
+    return count
+
+
+# function to suggest the known destinations close to a destination which has no rides
+def suggest_destinations_in_db(destination: str, db=None):
+    db = connect_mongo(db)
+    return suggest_destinations(destination, db)
 
 
 # function to find rides for user from mongodb rides collection
-def find_rides_by_lat_lon(lat: float, lon: float, mail_id: str, destination: str, date: str):
-    # convert string to ISODate
-    date = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ')
-    print('iam here')
-    # increase the datetime by 1 hour
-    to_date = date + timedelta(hours=1)
-    # convert the datetime to ISO format string
-    to_date = to_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-
-    # decrease the datetime by 1 hour
-    from_date = date - timedelta(hours=1)
-    # convert the datetime to ISO format string
-    from_date = from_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    db = connect_mongo()
-    collection = db['rides']
-    # find the rides which are not completed and seats_offered is greater than 0
-    # and mail_id is not equal to the user mail_id
-    rides = collection.find(
-            {
-                "status": {"$ne": "completed"}, 
-                "seats_offered": {"$gt": 0}, 
-                "mail_id": {"$ne": mail_id},
-                "destination": destination,
-                "date": {"$gte": from_date, "$lte": to_date}
-            }
+def find_rides_by_lat_lon(lat: float, lon: float, mail_id: str, destination: str, date: str,
+                          geo_search: bool = False, db=None):
+    # let mongodb do the distance filtering when geo search is enabled
+    if geo_search:
+        return find_rides_near(lat, lon, mail_id, destination, date, db=db)
+
+    # resolve the destination text to its id, nothing matches an unknown destination
+    db = connect_mongo(db)
+    destination_id = resolve_destination(destination, db)
+    if destination_id is None:
+        return None
+
+    from_date, to_date = ride_search_window(date)
+    # rank by the detour of the drivers when the destination has coordinates
+    place = get_place(destination_label(destination_id, db), db=db)
+
+    # answer from the ride index when it holds the search window, else from the search cache
+    index = get_synced_ride_index(db)
+    if index is not None and index.covers(from_date, to_date):
+        def bookable(candidate):
+            ride = candidate['ride']
+            return ride['mail_id'] != mail_id and ride['seats_offered'] - len(ride['riders']) > 0
+
+        # the detour ranking needs every candidate, the nearest ranking only the ones around the user
+        if place is not None:
+            candidates = index.candidates(destination_id, from_date, to_date, keep=bookable)
+        else:
+            candidates = index.candidates(destination_id, from_date, to_date, lat, lon, DEFAULT_RADIUS_KM,
+                                          keep=bookable)
+    else:
+        candidates = get_ride_candidates(destination_id, from_date, to_date, db=db)
+
+    return match_candidates(lat, lon, mail_id, candidates, place)
+
+
+# function to pick the rides of other users which have available seats, as an index into the candidates
+# with parallel latitude and longitude columns, the candidates themselves are not copied
+def candidate_columns(candidates, mail_id: str):
+    count = len(candidates)
+    lats = np.empty(count, dtype=np.float64)
+    lons = np.empty(count, dtype=np.float64)
+    bookable = np.empty(count, dtype=bool)
+    for position, candidate in enumerate(candidates):
+        ride = candidate['ride']
+        lats[position] = ride['latitude']
+        lons[position] = ride['longitude']
+        bookable[position] = ride['mail_id'] != mail_id and ride['seats_offered'] > len(ride['riders'])
+    keep = np.flatnonzero(bookable)
+    return keep, lats[keep], lons[keep]
+
+
+# function to build the result item of a candidate, only done for the rides which are returned
+def candidate_result(candidate, distance: float):
+    ride = candidate['ride']
+    return {"latitude": ride['latitude'], "longitude": ride['longitude'], "ride": ride,
+            "address": candidate['address'], "distance_away": distance}
+
+
+# function to rank the candidates of a search, by detour when the destination place is known else by distance
+def match_candidates(lat: float, lon: float, mail_id: str, candidates, place: dict = None):
+    keep, lats, lons = candidate_columns(candidates, mail_id)
+
+    # record the size of the candidate set
+    RIDE_SEARCH_CANDIDATES.observe(value=len(keep))
+    RIDE_SEARCH_LAST_CANDIDATES.set(value=len(keep))
+
+    # if no ride is bookable return message
+    if not len(keep):
+        return None
+
+    if place is not None:
+        settings = get_app_settings()
+        selected, pickup, detour, scores = detour_order(
+            lat, lon, place['latitude'], place['longitude'], lats, lons,
+            settings.ranking_detour_weight, settings.ranking_pickup_weight, settings.ranking_max_detour_km
         )
-    
-    # create a list to store the lat and lon of the rides
-    lat_lon = []
-    # iterate over the rides
-    for ride in rides:
-        # calculate the length of riders list
-        riders = len(ride['riders'])
-        # calculate the available seats
-        available_seats = ride['seats_offered'] - riders
-        # if available seats are greater than 0
-        if available_seats > 0:
-            address = json.loads(get_user_by_id(ride['mail_id'])).get('address')
-            # append the lat and lon to the list
-            lat_lon.append({"latitude": ride['latitude'], "longitude": ride['longitude'], "ride": ride,
-                            "address": address})
-
-    # if lat_lon is empty return message
-    if not lat_lon:
+        result = []
+        for index in selected.tolist():
+            item = candidate_result(candidates[keep[index]], float(pickup[index]))
+            item["detour_km"] = float(detour[index])
+            item["score"] = float(scores[index])
+            result.append(item)
+        return result
+
+    # find the nearest ride and the rides within radius, with the nearest ride on top
+    distances = distances_from(lat, lon, lats, lons)
+    nearest, within = select_nearest(distances)
+    return [candidate_result(candidates[keep[index]], float(distances[index])) for index in [nearest, *within.tolist()]]
+
+
+# function to build the $geoNear pipeline for the bookable rides around a point
+def geo_near_pipeline(lat: float, lon: float, query: dict, max_distance_km: float = None, limit: int = None):
+    geo_near = {
+        "near": geo_point(lat, lon),
+        "key": LOCATION_FIELD,
+        "distanceField": "distance_away",
+        # distances are returned in km instead of meters
+        "distanceMultiplier": 0.001,
+        "spherical": True,
+        "query": query
+    }
+    if max_distance_km is not None:
+        geo_near["maxDistance"] = max_distance_km * 1000
+
+    pipeline = [
+        {"$geoNear": geo_near},
+        # keep only the rides with available seats
+        {"$match": {"$expr": {"$lt": [{"$size": "$riders"}, "$seats_offered"]}}}
+    ]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    return pipeline
+
+
+# function to find rides for user with $geoNear, the rides come back sorted by distance
+def find_rides_near(lat: float, lon: float, mail_id: str, destination: str, date: str,
+                    max_distance_km: float = DEFAULT_RADIUS_KM, db=None):
+    db = connect_mongo(db)
+    collection = db['rides']
+    destination_id = resolve_destination(destination, db)
+    if destination_id is None:
         return None
-    # find the nearest ride
-    nearest_ride = find_nearest(lat, lon, lat_lon)
-    return dumps(nearest_ride)
+    query = ride_search_filter(mail_id, destination_id, date)
+    rides = list(collection.aggregate(geo_near_pipeline(lat, lon, query, max_distance_km)))
+
+    # fall back to the single nearest ride when nothing is within range
+    if not rides:
+        rides = list(collection.aggregate(geo_near_pipeline(lat, lon, query, limit=1)))
+
+    # record the size of the candidate set
+    RIDE_SEARCH_CANDIDATES.observe(value=len(rides))
+    RIDE_SEARCH_LAST_CANDIDATES.set(value=len(rides))
+
+    # if rides is empty return message
+    if not rides:
+        return None
+
+    # resolve the driver addresses for all the rides in one query
+    addresses = get_user_addresses([ride['mail_id'] for ride in rides], db=db)
+
+    # build the same result shape as find_nearest
+    nearest_rides = []
+    for ride in rides:
+        decode_destination(ride, db)
+        distance = ride.pop('distance_away')
+        nearest_rides.append({"latitude": ride['latitude'], "longitude": ride['longitude'], "ride": ride,
+                              "address": addresses.get(ride['mail_id']), "distance_away": distance})
+    return nearest_rides
+
+
+# function to build the filter of a ride which the user can join, it only matches
+# a scheduled ride with a free seat which the user has not joined yet, so
+# concurrent joins can not overbook it
+def ride_join_filter(ride_id: str, user_mail_id: str):
+    return {
+        "_id": ObjectId(ride_id),
+        "status": "scheduled",
+        "mail_id": {"$ne": user_mail_id},
+        "riders": {"$ne": user_mail_id},
+        "$expr": {"$lt": [{"$size": "$riders"}, "$seats_offered"]}
+    }
 
 
 # function to update ride by id in mongodb rides collection
-def update_riders_in_db(ride_id: str, user_mail_id: str):
-    db = connect_mongo()
+def update_riders_in_db(ride_id: str, user_mail_id: str, db=None):
+    db = connect_mongo(db)
     collection = db['rides']
 
-    # update riders info to the ride
-    result = collection.update_one(
-        {"_id": ObjectId(ride_id)},
+    # reserve the seat and read the ride back in one atomic round trip
+    ride = collection.find_one_and_update(
+        ride_join_filter(ride_id, user_mail_id),
         {
             "$push":
                 {
                     "riders": user_mail_id
                 }
-        }
+        },
+        return_document=ReturnDocument.AFTER
     )
 
-    # fetch updated ride info and return
-    ride_info = collection.find({
-        "_id": ObjectId(ride_id)
-    })
-    return result.modified_count, dumps(ride_info)
+    # no ride matched, the ride is full, not scheduled or already joined
+    if ride is None:
+        return 0, []
+    invalidate_ride_buckets(ride)
+    ride = decode_destination(ride, db)
+    index_rides(ride, db=db)
+    return 1, [ride]
 
 
 # function to update ride status by id in mongodb rides collection
-def update_ride_status_in_db(ride_id: str, status: str):
-    db = connect_mongo()
+def update_ride_status_in_db(ride_id: str, status: str, db=None):
+    db = connect_mongo(db)
     collection = db['rides']
-    result = collection.update_one(
+    # read the bucket fields of the ride in the same round trip
+    ride = collection.find_one_and_update(
         {"_id": ObjectId(ride_id)},
         {
             "$set":
                 {
                     "status": status
                 }
-        }
+        },
+        projection={"destination_id": 1, "date": 1, "status": 1},
+        return_document=ReturnDocument.BEFORE
     )
-    return result.modified_count
\ No newline at end of file
+    if ride is None or ride.get('status') == status:
+        return 0
+    invalidate_ride_buckets(ride)
+    update_indexed_ride(ride['_id'], {"status": status})
+    return 1
\ No newline at end of file
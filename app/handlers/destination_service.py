@@ -0,0 +1,166 @@
+# dictionary encoding of the ride destinations, rides reference a destination by a small integer id
+# and close spellings of an unknown destination are suggested through an in-memory trigram index
+import threading
+from collections import Counter
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.core.config import get_app_settings
+
+
+# function to normalize a destination so that "Office", "office " and "OFFICE" are the same
+def normalize_destination(name: str):
+    return " ".join(name.casefold().split())
+
+
+# function to get the trigrams of a normalized name, padded so that short names still have some
+def trigrams(name: str):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# in-memory dictionary of the destinations with a trigram index for fuzzy lookup
+class DestinationDictionary:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._labels = {}
+        self._trigram_counts = {}
+        # trigram -> ids of the destinations which contain it
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, destination_id: int, name: str, label: str = None):
+        with self._lock:
+            if name in self._ids:
+                return
+            grams = trigrams(name)
+            self._ids[name] = destination_id
+            self._labels[destination_id] = label or name
+            self._trigram_counts[destination_id] = len(grams)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(destination_id)
+
+    def load(self, documents):
+        for document in documents:
+            self.add(document["_id"], document["name"], document.get("label"))
+        return self
+
+    def id_of(self, name: str):
+        return self._ids.get(name)
+
+    def label_of(self, destination_id: int):
+        return self._labels.get(destination_id)
+
+    # function to find the destinations sharing the most trigrams with the name, by jaccard similarity
+    def search(self, name: str, limit: int = 5, threshold: float = 0.0):
+        grams = trigrams(name)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        matches = []
+        for destination_id, count in shared.items():
+            similarity = count / (len(grams) + self._trigram_counts[destination_id] - count)
+            if similarity >= threshold:
+                matches.append((destination_id, similarity))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit]
+
+
+# dictionary of the destinations, loaded on first use
+_dictionary = None
+_dictionary_lock = threading.Lock()
+
+
+# function to get the destination dictionary, loading it from the destinations collection once
+def get_destination_dictionary(db):
+    global _dictionary
+    if _dictionary is None:
+        with _dictionary_lock:
+            if _dictionary is None:
+                _dictionary = DestinationDictionary().load(db['destinations'].find({}))
+    return _dictionary
+
+
+# function to replace the destination dictionary, e.g. with one loaded at startup
+def set_destination_dictionary(dictionary):
+    global _dictionary
+    _dictionary = dictionary
+
+
+# function to drop the destination dictionary, it is loaded again on next use
+def reset_destination_dictionary():
+    set_destination_dictionary(None)
+
+
+# function to read a destination by its normalized name from the db, for the ones interned by other workers
+def _fetch_destination(name: str, db):
+    document = db['destinations'].find_one({"name": name})
+    if document is not None:
+        get_destination_dictionary(db).add(document["_id"], document["name"], document.get("label"))
+        return document["_id"]
+    return None
+
+
+# function to get the id of a destination, creating it when it is new
+def intern_destination(name: str, db):
+    normalized = normalize_destination(name)
+    destination_id = get_destination_dictionary(db).id_of(normalized)
+    if destination_id is None:
+        destination_id = _fetch_destination(normalized, db)
+    if destination_id is not None:
+        return destination_id
+
+    # allocate the next id from the counters collection
+    counter = db['counters'].find_one_and_update(
+        {"_id": "destinations"}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    try:
+        db['destinations'].insert_one({"_id": counter["seq"], "name": normalized, "label": name.strip()})
+    except DuplicateKeyError:
+        # another worker interned the same name first
+        return _fetch_destination(normalized, db)
+    get_destination_dictionary(db).add(counter["seq"], normalized, name.strip())
+    return counter["seq"]
+
+
+# function to resolve search text to a destination id, by its normalized name only, None when it is unknown,
+# a close spelling is never substituted since it may be another place ("building 3" and "building 1")
+def resolve_destination(text: str, db):
+    normalized = normalize_destination(text)
+    destination_id = get_destination_dictionary(db).id_of(normalized)
+    if destination_id is None:
+        destination_id = _fetch_destination(normalized, db)
+    return destination_id
+
+
+# function to suggest the known destinations close to an unknown search text, by trigram similarity
+def suggest_destinations(text: str, db, limit: int = 5):
+    normalized = normalize_destination(text)
+    dictionary = get_destination_dictionary(db)
+    threshold = get_app_settings().destination_suggestion_threshold
+    return [
+        dictionary.label_of(destination_id)
+        for destination_id, _ in dictionary.search(normalized, limit=limit, threshold=threshold)
+        if destination_id != dictionary.id_of(normalized)
+    ]
+
+
+# function to get the display name of a destination id
+def destination_label(destination_id: int, db):
+    dictionary = get_destination_dictionary(db)
+    label = dictionary.label_of(destination_id)
+    if label is None:
+        document = db['destinations'].find_one({"_id": destination_id})
+        if document is not None:
+            dictionary.add(document["_id"], document["name"], document.get("label"))
+            label = dictionary.label_of(destination_id)
+    return label
+
+
+# function to add the destination name to ride documents read from the db
+def decode_destination(ride, db):
+    if ride is not None and "destination_id" in ride:
+        ride["destination"] = destination_label(ride["destination_id"], db)
+    return ride
@@ -1,6 +1,13 @@
 # find the nearest pair of latitude and longitude from the given latitude and longitude using haversine formula
 
 from math import radians, sin, cos, sqrt, atan2
+import numpy as np
+
+# mean earth radius in km
+EARTH_RADIUS_KM = 6371
+
+# default search radius in km for rides around the nearest one
+DEFAULT_RADIUS_KM = 5
 
 
 # https://en.wikipedia.org/wiki/Haversine_formula
@@ -17,56 +24,135 @@ def haversine(lat1, lon1, lat2, lon2):
     a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
     # calculate the distance
-    distance = 6371 * c
+    distance = EARTH_RADIUS_KM * c
     return distance
 
 
-def find_nearest(lat, lon, users):
-    # create a list to store the distances and users with distances
-    distances = []
-    users_with_distances = []
+# vectorized haversine, works on scalars or numpy arrays with broadcasting
+def haversine_vector(lat1, lon1, lat2, lon2):
+    # convert latitude and longitude to radians
+    lat1 = np.radians(np.asarray(lat1, dtype=np.float64))
+    lon1 = np.radians(np.asarray(lon1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lat2, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lon2, dtype=np.float64))
+    # calculate the difference between the latitude and longitude
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    # calculate the haversine formula
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    # calculate the distance
+    return EARTH_RADIUS_KM * c
+
+
+# calculate distances from one origin to all the given points in one array pass
+def distances_from(lat, lon, lats, lons):
+    return haversine_vector(lat, lon, lats, lons)
+
 
-    # iterate over the users list
-    for user in users:
-        # calculate the distance using haversine formula
-        distance = haversine(lat, lon, user['latitude'], user['longitude'])
-        # add the distance to the user's dictionary
-        user_copy = user.copy()
-        user_copy["distance_away"] = distance
-        # append the user with distance to the list
-        users_with_distances.append(user_copy)
-        # append the distance to the list
-        distances.append(distance)
+# calculate the distance matrix of shape (origins, points)
+def distance_matrix(origin_lats, origin_lons, lats, lons):
+    # reshape origins into a column so that they broadcast against the points row
+    origin_lats = np.asarray(origin_lats, dtype=np.float64).reshape(-1, 1)
+    origin_lons = np.asarray(origin_lons, dtype=np.float64).reshape(-1, 1)
+    lats = np.asarray(lats, dtype=np.float64).reshape(1, -1)
+    lons = np.asarray(lons, dtype=np.float64).reshape(1, -1)
+    return haversine_vector(origin_lats, origin_lons, lats, lons)
 
-    # find the index of the minimum distance
-    index = distances.index(min(distances))
-    # get the nearest user
-    nearest_user = users_with_distances[index]
 
-    # create a list of users within 5 km range
-    users_within_5km = [user for user in users_with_distances if user["distance_away"] <= 5 and user != nearest_user]
+# extract the latitude and longitude columns from a list of users
+def coordinates_of(users):
+    lats = np.fromiter((user['latitude'] for user in users), dtype=np.float64, count=len(users))
+    lons = np.fromiter((user['longitude'] for user in users), dtype=np.float64, count=len(users))
+    return lats, lons
 
-    # combine the nearest user with users within 5 km range, with the nearest user on top
-    result = [nearest_user] + users_within_5km
 
-    # return the combined result
+# select the nearest index and the indexes within radius from a row of distances
+def select_nearest(distances, radius=DEFAULT_RADIUS_KM):
+    # argpartition with kth=0 places the minimum first without a full sort
+    nearest = int(np.argpartition(distances, 0)[0])
+    # boolean mask for the points within radius, excluding the nearest one
+    mask = distances <= radius
+    mask[nearest] = False
+    # flatnonzero keeps the original order of the users
+    return nearest, np.flatnonzero(mask)
+
+
+# build the result list, copying only the users which are returned
+def _build_result(users, distances, nearest, within):
+    result = []
+    for index in [nearest, *within.tolist()]:
+        user_copy = users[index].copy()
+        user_copy["distance_away"] = float(distances[index])
+        result.append(user_copy)
     return result
 
-# lat = 12.9715987
-# lon = 77.5945627
-# users = [
-#     {
-#         "latitude": 13.9715987,
-#         "longitude": 79.5945627
-#     },
-#     {
-#         "latitude": 14.9715987,
-#         "longitude": 77.5945627
-#     },
-#     {
-#         "latitude": 11.9715987,
-#         "longitude": 96.5945627
-#     }
-# ]
-# nearest_users = find_nearest(lat, lon, users)
-# print(nearest_users)
+
+def find_nearest(lat, lon, users, radius=DEFAULT_RADIUS_KM):
+    # calculate the distances to all the users in one pass
+    lats, lons = coordinates_of(users)
+    distances = distances_from(lat, lon, lats, lons)
+
+    # find the nearest user and the users within radius
+    nearest, within = select_nearest(distances, radius)
+
+    # combine the nearest user with users within radius, with the nearest user on top
+    return _build_result(users, distances, nearest, within)
+
+
+# find the nearest users for many origins at once using a distance matrix
+def find_nearest_many(origins, users, radius=DEFAULT_RADIUS_KM):
+    # origins is a list of (lat, lon) pairs
+    origin_lats = [float(origin[0]) for origin in origins]
+    origin_lons = [float(origin[1]) for origin in origins]
+    lats, lons = coordinates_of(users)
+    matrix = distance_matrix(origin_lats, origin_lons, lats, lons)
+
+    # build one result per origin, same shape as find_nearest
+    results = []
+    for row in matrix:
+        nearest, within = select_nearest(row, radius)
+        results.append(_build_result(users, row, nearest, within))
+    return results
+
+
+# calculate the pickup distance and the added detour of every driver picking up the rider on the way,
+# detour = driver -> pickup + pickup -> destination - driver -> destination
+def detour_distances(lats, lons, pickup_lat, pickup_lon, dest_lat, dest_lon):
+    pickup = distances_from(pickup_lat, pickup_lon, lats, lons)
+    direct = distances_from(dest_lat, dest_lon, lats, lons)
+    pickup_to_dest = haversine(pickup_lat, pickup_lon, dest_lat, dest_lon)
+    # the triangle inequality makes the detour positive, up to rounding
+    detour = np.maximum(pickup + pickup_to_dest - direct, 0)
+    return pickup, detour
+
+
+# order the points by their weighted detour, the best one on top followed by the others within the max detour,
+# returns the selected indexes with the pickup distance, detour and score arrays of all the points
+def detour_order(lat, lon, dest_lat, dest_lon, lats, lons, detour_weight=1.0, pickup_weight=0.0,
+                 max_detour=DEFAULT_RADIUS_KM):
+    pickup, detour = detour_distances(lats, lons, lat, lon, dest_lat, dest_lon)
+    scores = detour_weight * detour + pickup_weight * pickup
+
+    # keep the best point whatever its detour, like find_nearest keeps the nearest one
+    order = np.argsort(scores, kind="stable")
+    keep = detour[order] <= max_detour
+    keep[0] = True
+    return order[keep], pickup, detour, scores
+
+
+# rank the users by their weighted detour, the best one on top followed by the others within the max detour
+def rank_by_detour(lat, lon, dest_lat, dest_lon, users, detour_weight=1.0, pickup_weight=0.0,
+                   max_detour=DEFAULT_RADIUS_KM):
+    lats, lons = coordinates_of(users)
+    selected, pickup, detour, scores = detour_order(lat, lon, dest_lat, dest_lon, lats, lons, detour_weight,
+                                                    pickup_weight, max_detour)
+
+    result = []
+    for index in selected.tolist():
+        user_copy = users[index].copy()
+        user_copy["distance_away"] = float(pickup[index])
+        user_copy["detour_km"] = float(detour[index])
+        user_copy["score"] = float(scores[index])
+        result.append(user_copy)
+    return result
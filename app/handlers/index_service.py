@@ -0,0 +1,157 @@
+# declares the indexes needed by the handler queries, creates them and reports drift
+import sys
+import argparse
+from bson import ObjectId
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from app.handlers.car_pool_service import (LOCATION_FIELD, ride_history_filter,
+    ride_search_filter, ride_candidates_filter, ride_search_window
+)
+
+# indexes required by the handlers, per collection
+INDEXES = {
+    "users": [
+        # get_user_by_id and get_user_addresses
+        IndexModel([("mail_id", ASCENDING)], name="mail_id_unique", unique=True),
+        IndexModel([(LOCATION_FIELD, GEOSPHERE)], name="location_2dsphere"),
+    ],
+    "rides": [
+        # get_ride_by_id, rides offered by the user, _id for the keyset pagination
+        IndexModel([("mail_id", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)], name="mail_id_status_id"),
+        # get_ride_by_id, rides joined by the user (multikey on riders)
+        IndexModel([("riders", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)], name="riders_status_id"),
+        # find_rides_by_lat_lon, equality on the destination id then the date range
+        IndexModel([("destination_id", ASCENDING), ("date", ASCENDING), ("status", ASCENDING),
+                    ("seats_offered", ASCENDING)], name="destination_id_date_status_seats"),
+        # sync_ride_index, preload_ride_candidates and preload_hot_users, the date range of every destination,
+        # in date order for preload_hot_users
+        IndexModel([("date", ASCENDING), ("status", ASCENDING), ("seats_offered", ASCENDING)],
+                   name="date_status_seats"),
+        # find_rides_near
+        IndexModel([(LOCATION_FIELD, GEOSPHERE)], name="location_2dsphere"),
+    ],
+    "destinations": [
+        # intern_destination and resolve_destination
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+    "places": [
+        # get_place and upsert_place_in_db
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+}
+
+# options compared when looking for drift
+_COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+# function to create all the declared indexes, create_indexes is idempotent
+def ensure_indexes(db):
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        created[collection_name] = db[collection_name].create_indexes(indexes)
+    return created
+
+
+# function to normalize an index definition for comparison
+def _index_signature(key, options):
+    return list(key), {name: options.get(name) for name in _COMPARED_OPTIONS if options.get(name)}
+
+
+# function to compare the declared indexes with the indexes in the db
+def index_drift(db):
+    drift = {}
+    for collection_name, indexes in INDEXES.items():
+        existing = db[collection_name].index_information()
+        existing.pop("_id_", None)
+
+        missing, changed = [], []
+        for index in indexes:
+            document = index.document
+            name = document["name"]
+            if name not in existing:
+                missing.append(name)
+                continue
+            expected = _index_signature(document["key"].items(), document)
+            actual = _index_signature(existing[name]["key"], existing[name])
+            if expected != actual:
+                changed.append(name)
+
+        declared = {index.document["name"] for index in INDEXES[collection_name]}
+        extra = sorted(name for name in existing if name not in declared)
+
+        if missing or changed or extra:
+            drift[collection_name] = {"missing": missing, "changed": changed, "extra": extra}
+    return drift
+
+
+# function to collect the stages of a query plan
+def plan_stages(plan):
+    stages = []
+    if not isinstance(plan, dict):
+        return stages
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    # classic plans nest stages in inputStage(s), sbe plans in queryPlan
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        stages.extend(plan_stages(plan.get(key)))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+# function to get the winning plan stages of an explained query
+def winning_plan_stages(explain):
+    return plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+
+
+# handler queries checked by verify_query_plans, with sample values and the sort of the sorted ones
+def handler_queries():
+    mail_id = "index.check@example.com"
+    date = "2024-01-01T09:00:00.000000Z"
+    from_date, to_date = ride_search_window(date)
+    return [
+        ("get_user_by_id", "users", {"mail_id": mail_id}, None),
+        ("get_user_addresses", "users", {"mail_id": {"$in": [mail_id]}}, None),
+        ("get_ride_by_id", "rides", ride_history_filter(mail_id, "scheduled"), None),
+        ("find_rides_by_lat_lon", "rides", ride_candidates_filter(1, from_date, to_date), None),
+        ("find_rides_near", "rides", ride_search_filter(mail_id, 1, date), None),
+        ("update_riders_in_db", "rides", {"_id": ObjectId()}, None),
+        ("sync_ride_index", "rides", ride_candidates_filter(None, from_date, to_date), None),
+        ("preload_hot_users", "rides", ride_candidates_filter(None, from_date, to_date), [("date", ASCENDING)]),
+    ]
+
+
+# function to explain every handler query and return the ones doing a COLLSCAN, or sorting in memory
+def verify_query_plans(db):
+    failures = []
+    for name, collection_name, query, sort in handler_queries():
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = winning_plan_stages(cursor.explain())
+        if "COLLSCAN" in stages or (sort and "SORT" in stages):
+            failures.append({"query": name, "collection": collection_name, "stages": stages})
+    return failures
+
+
+"""
+usage:
+python -m app.handlers.index_service --create --check
+"""
+if __name__ == "__main__":
+    from app.migrations import get_migration_db
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--create", help="create the missing indexes", action="store_true")
+    parser.add_argument("--check", help="fail if a handler query does a COLLSCAN or an in-memory sort",
+                        action="store_true")
+    args = vars(parser.parse_args())
+
+    db = get_migration_db()
+    if args['create']:
+        print(ensure_indexes(db))
+    print({"drift": index_drift(db)})
+    if args['check']:
+        failures = verify_query_plans(db)
+        print({"collscan": failures})
+        if failures:
+            sys.exit(1)
@@ -0,0 +1,219 @@
+# in-memory spatio-temporal index of the bookable rides, mongodb stays the source of truth
+# rides are bucketed per destination and hour, and each bucket keeps a grid over the pickup points
+import math
+import threading
+from datetime import datetime, timedelta, timezone
+
+# km per degree of latitude
+KM_PER_DEGREE = 111.2
+
+# searches wider than this scan every cell of the buckets
+MAX_SEARCH_KM = 20000
+
+
+# one destination and hour of rides, candidates are {"ride": ride, "address": address} like the search cache
+class RideBucket:
+    def __init__(self):
+        self.candidates = {}
+        # grid cell -> ids of the rides picked up in it
+        self.cells = {}
+
+    def add(self, ride_id, candidate, cell):
+        self.candidates[ride_id] = candidate
+        self.cells.setdefault(cell, set()).add(ride_id)
+
+    def remove(self, ride_id, cell):
+        self.candidates.pop(ride_id, None)
+        ids = self.cells.get(cell)
+        if ids is not None:
+            ids.discard(ride_id)
+            if not ids:
+                del self.cells[cell]
+
+
+class RideIndex:
+    def __init__(self, cell_km: float = 1.0, bucket_minutes: int = 60):
+        self.cell_km = cell_km
+        self.cell_degrees = cell_km / KM_PER_DEGREE
+        self.bucket = timedelta(minutes=bucket_minutes)
+        self._lock = threading.RLock()
+        self._buckets = {}
+        # ride id -> (bucket key, cell) to move or remove a ride
+        self._locations = {}
+        # date range of the rides held by the index, None until it is loaded
+        self.coverage = None
+        self.loaded_at = None
+        # writes made while a reload queries mongodb, replayed on the reloaded index before the swap
+        self._journal = None
+
+    def __len__(self):
+        return len(self._locations)
+
+    # function to get the start of the hour bucket of a date
+    def bucket_start(self, date: datetime):
+        return datetime.min + ((date - datetime.min) // self.bucket) * self.bucket
+
+    # function to get the grid cell of a point
+    def cell(self, lat: float, lon: float):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    # function to record the writes from now on, call it before querying the rides given to replace
+    def begin_reload(self):
+        with self._lock:
+            self._journal = []
+
+    # function to stop recording the writes after a failed reload
+    def cancel_reload(self):
+        with self._lock:
+            self._journal = None
+
+    # function to check that the writes reach the index, once it is loaded or while it is loading
+    def tracks_writes(self):
+        return self.loaded_at is not None or self._journal is not None
+
+    # function to replace the content of the index, the new buckets are built before the swap and get
+    # the writes recorded since begin_reload, which the query of the candidates may have missed
+    def replace(self, candidates, from_date: datetime, to_date: datetime):
+        index = RideIndex(self.cell_km, int(self.bucket.total_seconds() // 60))
+        index.coverage = (from_date, to_date)
+        for candidate in candidates:
+            index._add(candidate)
+        with self._lock:
+            for write, *args in self._journal or ():
+                getattr(index, write)(*args)
+            self._journal = None
+            self._buckets = index._buckets
+            self._locations = index._locations
+            self.coverage = index.coverage
+            self.loaded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    # function to check that the index holds every ride of a date range
+    def covers(self, from_date: datetime, to_date: datetime):
+        coverage = self.coverage
+        return coverage is not None and coverage[0] <= from_date and to_date <= coverage[1]
+
+    def _add(self, candidate):
+        ride = candidate["ride"]
+        key = (ride["destination_id"], self.bucket_start(ride["date"]))
+        cell = self.cell(ride["latitude"], ride["longitude"])
+        self._buckets.setdefault(key, RideBucket()).add(ride["_id"], candidate, cell)
+        self._locations[ride["_id"]] = (key, cell)
+
+    def _remove(self, ride_id):
+        location = self._locations.pop(ride_id, None)
+        if location is None:
+            return None
+        key, cell = location
+        bucket = self._buckets[key]
+        candidate = bucket.candidates.get(ride_id)
+        bucket.remove(ride_id, cell)
+        if not bucket.candidates:
+            del self._buckets[key]
+        return candidate
+
+    # function to add or replace a ride, the address of the driver is kept when it is not given
+    def upsert(self, ride: dict, address=None):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(("upsert", ride, address))
+            self._upsert(ride, address)
+
+    def _upsert(self, ride: dict, address=None):
+        previous = self._remove(ride["_id"])
+        if ride.get("status") == "completed" or not self.covers(ride["date"], ride["date"]):
+            return
+        if address is None and previous is not None:
+            address = previous["address"]
+        self._add({"ride": ride, "address": address})
+
+    # function to change some fields of a ride, the ride dict is copied so that readers never see a partial write
+    def update(self, ride_id, fields: dict):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(("update", ride_id, fields))
+            location = self._locations.get(ride_id)
+            if location is None:
+                return
+            previous = self._buckets[location[0]].candidates[ride_id]
+            self._upsert({**previous["ride"], **fields}, previous["address"])
+
+    def remove(self, ride_id):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(("remove", ride_id))
+            self._remove(ride_id)
+
+    # function to get the candidates in the cells around a point, for the given buckets
+    def _near(self, buckets, lat: float, lon: float, radius_km: float, keep):
+        lat_cells = math.ceil(radius_km / self.cell_km)
+        lon_cells = math.ceil(radius_km / (self.cell_km * max(math.cos(math.radians(lat)), 1e-6)))
+        row, col = self.cell(lat, lon)
+        found = []
+        for bucket in buckets:
+            # scan the cells of the bucket when it has fewer cells than the search window
+            if len(bucket.cells) <= (2 * lat_cells + 1) * (2 * lon_cells + 1):
+                found.extend(
+                    bucket.candidates[ride_id]
+                    for (cell_row, cell_col), ids in bucket.cells.items()
+                    if abs(cell_row - row) <= lat_cells and abs(cell_col - col) <= lon_cells
+                    for ride_id in ids
+                )
+                continue
+            for cell_row in range(row - lat_cells, row + lat_cells + 1):
+                for cell_col in range(col - lon_cells, col + lon_cells + 1):
+                    for ride_id in bucket.cells.get((cell_row, cell_col), ()):
+                        found.append(bucket.candidates[ride_id])
+        return [candidate for candidate in found if keep(candidate)]
+
+    # function to get the candidates of a destination in a date range which pass the keep filter, all of them
+    # or only the ones around a point: the ones within radius, or the ones around the nearest ride when none is
+    # within radius
+    def candidates(self, destination_id: int, from_date: datetime, to_date: datetime, lat: float = None,
+                   lon: float = None, radius_km: float = None, keep=None):
+        def in_range(candidate):
+            return from_date <= candidate["ride"]["date"] <= to_date and (keep is None or keep(candidate))
+
+        with self._lock:
+            buckets = []
+            bucket_start = self.bucket_start(from_date)
+            while bucket_start <= to_date:
+                bucket = self._buckets.get((destination_id, bucket_start))
+                if bucket is not None:
+                    buckets.append(bucket)
+                bucket_start += self.bucket
+
+            if lat is None or radius_km is None:
+                found = [candidate for bucket in buckets for candidate in bucket.candidates.values()
+                         if in_range(candidate)]
+            else:
+                # widen the search until a ride is found
+                search_km = radius_km
+                found = self._near(buckets, lat, lon, search_km, in_range)
+                while not found and search_km < MAX_SEARCH_KM and buckets:
+                    search_km *= 2
+                    found = self._near(buckets, lat, lon, search_km, in_range)
+                # when the nearest ride found is beyond the radius, a closer one may sit in a cell
+                # which was not scanned, so rescan up to its distance with one more cell of margin
+                if found:
+                    nearest_km = min(
+                        _distance_km(lat, lon, candidate["ride"]["latitude"], candidate["ride"]["longitude"])
+                        for candidate in found
+                    )
+                    if nearest_km > radius_km:
+                        found = self._near(buckets, lat, lon, nearest_km + self.cell_km, in_range)
+        return found
+
+    def stats(self):
+        return {
+            "rides": len(self),
+            "buckets": len(self._buckets),
+            "coverage": self.coverage,
+            "loaded_at": self.loaded_at,
+        }
+
+
+# equirectangular distance, enough to pick the search radius
+def _distance_km(lat1, lon1, lat2, lon2):
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * KM_PER_DEGREE * 180 / math.pi
@@ -0,0 +1,216 @@
+# write-behind of the ride status updates, the updates are queued in memory, merged per ride and written
+# by a background thread as unordered bulk writes
+import time
+import threading
+from concurrent.futures import Future
+from bson import ObjectId
+from pymongo import WriteConcern
+from app.core.config import get_app_settings
+from app.handlers.car_pool_service import connect_mongo, update_ride_status_in_db
+from app.handlers.bulk_service import bulk_update_ride_status_in_db
+
+# "acknowledged" callers wait until their update is written, "fire_and_forget" callers return once it is queued
+DURABILITY = ("acknowledged", "fire_and_forget")
+
+
+# raised when the queue stays full for longer than the put timeout
+class WriteBehindQueueFull(RuntimeError):
+    pass
+
+
+# queue of pending writes keyed by document, a new value for a pending key replaces the queued one
+class WriteBehindQueue:
+    # write takes a {key: value} batch and returns the {key: error message} of the failed writes
+    def __init__(self, write, batch_size: int = 500, flush_interval: float = 0.1, max_pending: int = 10000,
+                 put_timeout: float = 1.0):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self._condition = threading.Condition()
+        # key -> (value, future of the write), in the order the keys were queued
+        self._pending = {}
+        # time the oldest pending write was queued
+        self._oldest = None
+        self._closed = False
+        self.queued = 0
+        self.merged = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    # function to queue a write, waiting while the queue is full, returns the future of the write
+    def put(self, key, value):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("the write-behind queue is closed")
+            pending = self._pending.get(key)
+            if pending is not None:
+                # merge with the queued write of the same key, the callers share its future
+                self._pending[key] = (value, pending[1])
+                self.merged += 1
+                return pending[1]
+
+            # backpressure, wait for the flusher to make room
+            deadline = time.monotonic() + self.put_timeout
+            while len(self._pending) >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    raise WriteBehindQueueFull(f"{len(self._pending)} writes are pending")
+                self._condition.wait(remaining)
+
+            future = Future()
+            self._pending[key] = (value, future)
+            self.queued += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            # wake the flusher on the first write and when a batch is full
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+            return future
+
+    # function to take the oldest pending writes, up to a batch
+    def _take(self):
+        keys = list(self._pending)[:self.batch_size]
+        batch = {key: self._pending.pop(key) for key in keys}
+        self._oldest = time.monotonic() if self._pending else None
+        # wake the callers waiting for room
+        self._condition.notify_all()
+        return batch
+
+    # function to write a batch and complete the futures of its callers
+    def _write(self, batch):
+        try:
+            errors = self.write({key: value for key, (value, _) in batch.items()})
+        except Exception as e:
+            errors = {key: str(e) for key in batch}
+        for key, (_, future) in batch.items():
+            if key in errors:
+                future.set_exception(RuntimeError(errors[key]))
+            else:
+                future.set_result(True)
+        self.batches += 1
+        self.written += len(batch) - len(errors)
+        self.failed += len(errors)
+        if errors:
+            # fire and forget callers do not read the futures
+            print(f'write-behind: {len(errors)} of {len(batch)} writes failed, e.g. {next(iter(errors.values()))}')
+
+    # flusher thread, writes a batch when it is full or when the oldest write is older than the flush interval
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if len(self._pending) >= self.batch_size:
+                        break
+                    if self._oldest is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._oldest + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+                batch = self._take()
+            self._write(batch)
+
+    # function to stop the flusher and write every pending write, new writes are refused
+    def close(self, timeout: float = None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        while True:
+            with self._condition:
+                if not self._pending:
+                    return
+                batch = self._take()
+            self._write(batch)
+
+    def stats(self):
+        return {
+            "pending": len(self),
+            "max_pending": self.max_pending,
+            "queued": self.queued,
+            "merged": self.merged,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "closed": self._closed,
+        }
+
+
+# queue of the ride status updates, created on first use
+_status_queue = None
+_status_queue_lock = threading.Lock()
+
+
+# function to get the write concern of the status bulk writes
+def status_write_concern():
+    settings = get_app_settings()
+    return WriteConcern(w=settings.write_behind_write_concern, j=settings.write_behind_journal or None)
+
+
+# function to get the ride status queue, None when write-behind is disabled
+def get_status_queue(db=None):
+    global _status_queue
+    settings = get_app_settings()
+    if not settings.write_behind_enabled:
+        return None
+    if _status_queue is None:
+        with _status_queue_lock:
+            if _status_queue is None:
+                db = connect_mongo(db)
+
+                def write(statuses):
+                    return bulk_update_ride_status_in_db(statuses, status_write_concern(), db=db)["errors"]
+
+                _status_queue = WriteBehindQueue(
+                    write,
+                    settings.write_behind_batch_size,
+                    settings.write_behind_flush_interval_ms / 1000,
+                    settings.write_behind_max_pending,
+                    settings.write_behind_put_timeout_seconds,
+                )
+    return _status_queue
+
+
+# function to write the pending status updates and drop the queue, e.g. on shutdown
+def close_status_queue():
+    global _status_queue
+    with _status_queue_lock:
+        queue, _status_queue = _status_queue, None
+    if queue is not None:
+        queue.close()
+        return queue.stats()
+    return None
+
+
+# function to queue a ride status update without waiting for its write, returns the updated count and
+# the future of the write to wait for with acknowledged durability, else None,
+# the update is written right away when write-behind is disabled
+def put_ride_status(ride_id: str, status: str, durability: str = None, db=None):
+    queue = get_status_queue(db)
+    if queue is None:
+        return update_ride_status_in_db(ride_id, status, db=db), None
+
+    durability = durability or get_app_settings().write_behind_durability
+    if durability not in DURABILITY:
+        raise ValueError(f"unknown durability {durability}, expected one of {', '.join(DURABILITY)}")
+    future = queue.put(ObjectId(ride_id), status)
+    return 1, future if durability == "acknowledged" else None
+
+
+# function to queue a ride status update, with acknowledged durability it returns once the update is written
+def queue_ride_status(ride_id: str, status: str, durability: str = None, db=None):
+    result, future = put_ride_status(ride_id, status, durability, db=db)
+    if future is not None:
+        future.result(get_app_settings().write_behind_ack_timeout_seconds)
+    return result
@@ -0,0 +1,11 @@
+# one-shot data migrations, run them as modules, e.g.
+# python -m app.migrations.backfill_locations
+from app.core.config import get_app_settings
+from app.core.mongo import create_mongo_client
+
+
+# function to connect the mongodb for the migrations, same settings as the app
+def get_migration_db():
+    settings = get_app_settings()
+    client = create_mongo_client(settings)
+    return client[settings.mongo_db]
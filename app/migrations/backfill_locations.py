@@ -0,0 +1,57 @@
+# backfill the GeoJSON location field on existing users and rides
+import argparse
+from pymongo import UpdateOne
+from app.handlers.car_pool_service import LOCATION_FIELD, geo_point
+from app.handlers.index_service import ensure_indexes
+from app.migrations import get_migration_db
+
+
+# function to backfill the location of one collection in bulk batches
+def backfill_collection(collection, batch_size: int = 1000):
+    # only the documents with coordinates and without a location
+    documents = collection.find(
+        {
+            LOCATION_FIELD: {"$exists": False},
+            "latitude": {"$ne": None},
+            "longitude": {"$ne": None}
+        },
+        {"latitude": 1, "longitude": 1}
+    )
+
+    updated = 0
+    operations = []
+    for document in documents:
+        operations.append(UpdateOne(
+            {"_id": document["_id"]},
+            {"$set": {LOCATION_FIELD: geo_point(document["latitude"], document["longitude"])}}
+        ))
+        # flush the batch when it is full
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    # flush the remaining operations
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+# function to backfill users and rides and create the indexes
+def backfill_locations(db, batch_size: int = 1000):
+    result = {
+        "users": backfill_collection(db['users'], batch_size),
+        "rides": backfill_collection(db['rides'], batch_size)
+    }
+    ensure_indexes(db)
+    return result
+
+
+"""
+usage:
+python -m app.migrations.backfill_locations --batch-size 1000
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", help="documents per bulk write", default=1000, type=int)
+    args = vars(parser.parse_args())
+    print(backfill_locations(get_migration_db(), args['batch_size']))
@@ -0,0 +1,44 @@
+# convert the string ride dates to native BSON datetimes
+import argparse
+from pymongo import UpdateOne
+from app.handlers.car_pool_service import parse_ride_date
+from app.migrations import get_migration_db
+
+
+# function to convert the ride dates in bulk batches
+def convert_ride_dates(db, batch_size: int = 1000):
+    collection = db['rides']
+    # only the rides which still store the date as a string
+    rides = collection.find({"date": {"$type": "string"}}, {"date": 1})
+
+    converted = 0
+    failed = []
+    operations = []
+    for ride in rides:
+        try:
+            date = parse_ride_date(ride["date"])
+        except ValueError:
+            failed.append(ride["_id"])
+            continue
+        # the date filter keeps the update safe if the ride changed meanwhile
+        operations.append(UpdateOne({"_id": ride["_id"], "date": ride["date"]}, {"$set": {"date": date}}))
+        # flush the batch when it is full
+        if len(operations) >= batch_size:
+            converted += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    # flush the remaining operations
+    if operations:
+        converted += collection.bulk_write(operations, ordered=False).modified_count
+    return {"converted": converted, "failed": failed}
+
+
+"""
+usage:
+python -m app.migrations.convert_ride_dates --batch-size 1000
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", help="documents per bulk write", default=1000, type=int)
+    args = vars(parser.parse_args())
+    print(convert_ride_dates(get_migration_db(), args['batch_size']))
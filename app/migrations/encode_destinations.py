@@ -0,0 +1,55 @@
+# replace the destination strings of the rides by the ids of the destinations collection
+import argparse
+from pymongo import UpdateOne
+from app.handlers.destination_service import intern_destination
+from app.handlers.index_service import ensure_indexes
+from app.migrations import get_migration_db
+
+# index on the destination strings, replaced by destination_id_date_status_seats
+OLD_INDEX = "destination_date_status_seats"
+
+
+# function to encode the ride destinations in bulk batches
+def encode_destinations(db, batch_size: int = 1000):
+    collection = db['rides']
+    # only the rides which still store the destination as a string
+    rides = collection.find({"destination": {"$type": "string"}}, {"destination": 1})
+
+    # every distinct spelling is interned once, "Office" and "office " get the same id
+    ids = {}
+    encoded = 0
+    operations = []
+    for ride in rides:
+        destination = ride["destination"]
+        if destination not in ids:
+            ids[destination] = intern_destination(destination, db)
+        # the destination filter keeps the update safe if the ride changed meanwhile
+        operations.append(UpdateOne(
+            {"_id": ride["_id"], "destination": destination},
+            {"$set": {"destination_id": ids[destination]}, "$unset": {"destination": ""}}
+        ))
+        # flush the batch when it is full
+        if len(operations) >= batch_size:
+            encoded += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    # flush the remaining operations
+    if operations:
+        encoded += collection.bulk_write(operations, ordered=False).modified_count
+
+    # the searches need the index on the ids, the one on the strings is dropped
+    ensure_indexes(db)
+    if OLD_INDEX in collection.index_information():
+        collection.drop_index(OLD_INDEX)
+    return {"encoded": encoded, "destinations": len(set(ids.values()))}
+
+
+"""
+usage:
+python -m app.migrations.encode_destinations --batch-size 1000
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", help="documents per bulk write", default=1000, type=int)
+    args = vars(parser.parse_args())
+    print(encode_destinations(get_migration_db(), args['batch_size']))
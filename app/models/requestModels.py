@@ -1,5 +1,7 @@
-from pydantic import BaseModel
-from typing import List
+from datetime import datetime
+from pydantic import BaseModel, Field, validator
+from typing import List, Optional
+from app.core.config import get_app_settings
 
 
 # Create model for vehicle request
@@ -25,9 +27,52 @@ class Ride(BaseModel):
     mail_id: str
     latitude: float
     longitude: float
-    destination: str
+    destination_id: int
     seats_offered: int
     riders: List[str]
-    date: str
+    date: datetime
     status: str
     vehicle: str
+    location: Optional[dict] = None
+
+
+# Create model for place request, the coordinates of a destination
+class Place(BaseModel):
+    name: str
+    latitude: float
+    longitude: float
+
+
+# Create model for recurring ride request
+class RecurringRide(BaseModel):
+    mail_id: str
+    date: str
+    destination: str
+    seats_offered: int
+    vehicle_type: str
+    occurrences: int = Field(..., ge=1)
+    interval_days: int = Field(1, ge=1)
+    weekdays_only: bool = False
+
+    @validator("occurrences")
+    def check_occurrences(cls, occurrences):
+        maximum = get_app_settings().recurring_max_occurrences
+        if occurrences > maximum:
+            raise ValueError(f"at most {maximum} occurrences")
+        return occurrences
+
+
+# Create model for batch assignment request
+class AssignmentRequest(BaseModel):
+    destination: str
+    date: str
+    mail_ids: List[str]
+    method: str = "greedy"
+    max_distance_km: Optional[float] = None
+    commit: bool = False
+
+
+# Create model for join ride request
+class JoinRequest(BaseModel):
+    ride_id: str
+    mail_id: str
@@ -0,0 +1,32 @@
+# This file contains the admin routes of the application
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Request
+from starlette.responses import PlainTextResponse
+from app.core.config import get_app_settings
+
+# create an instance of APIRouter
+router = APIRouter()
+
+
+# function to allow only the requests with the admin token
+def check_admin(token: Optional[str]):
+    admin_token = get_app_settings().admin_token
+    if not admin_token or token != admin_token:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# route to list the slowest profiled requests
+@router.get("/profiles")
+async def list_profiles(request: Request, x_admin_token: Optional[str] = Header(None)):
+    check_admin(x_admin_token)
+    return [profile.summary() for profile in request.app.state.profiles.list()]
+
+
+# route to get a profile as collapsed stacks, e.g. for flamegraph.pl or speedscope
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: int, request: Request, x_admin_token: Optional[str] = Header(None)):
+    check_admin(x_admin_token)
+    profile = request.app.state.profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(profile.collapsed())
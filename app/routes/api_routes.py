@@ -1,16 +1,30 @@
 # This file contains the API routes for the application
-import json
-from fastapi import APIRouter
-from app.models.requestModels import User
-from app.handlers.car_pool_service import create_user_in_db
-from app.handlers.car_pool_service import get_user_by_id
-from app.handlers.car_pool_service import update_user_in_db
-from app.handlers.car_pool_service import delete_user_in_db
-from app.handlers.car_pool_service import create_ride_in_db
-from app.handlers.car_pool_service import get_ride_by_id
-from app.handlers.car_pool_service import find_rides_by_lat_lon
-from app.handlers.car_pool_service import update_riders_in_db
-from app.handlers.car_pool_service import update_ride_status_in_db
+from fastapi import APIRouter, Depends
+from starlette.responses import StreamingResponse
+from app.core.config import get_app_settings
+from app.core.responses import MongoJSONResponse, dumps_bson
+from app.handlers.car_pool_service import get_user_cache, get_ride_index, iter_rides_by_id
+from app.handlers.write_behind import get_status_queue
+from app.core.mongo import get_db, get_pool_stats
+from typing import List
+from app.models.requestModels import User, Place, RecurringRide, JoinRequest, AssignmentRequest
+from app.handlers.async_car_pool_service import create_user_in_db
+from app.handlers.async_car_pool_service import get_user_by_id
+from app.handlers.async_car_pool_service import update_user_in_db
+from app.handlers.async_car_pool_service import delete_user_in_db
+from app.handlers.async_car_pool_service import create_ride_in_db
+from app.handlers.async_car_pool_service import get_ride_by_id
+from app.handlers.async_car_pool_service import find_rides_by_lat_lon
+from app.handlers.async_car_pool_service import suggest_destinations_in_db
+from app.handlers.async_car_pool_service import update_riders_in_db
+from app.handlers.async_car_pool_service import queue_ride_status
+from app.handlers.async_car_pool_service import upsert_place_in_db
+from app.handlers.async_car_pool_service import bulk_upsert_users_in_db
+from app.handlers.async_car_pool_service import create_recurring_ride_offer_in_db
+from app.handlers.async_car_pool_service import bulk_join_rides_in_db
+from app.handlers.async_car_pool_service import assign_rides_in_db
+from app.handlers.async_car_pool_service import iter_db
+from app.handlers.async_car_pool_service import run_db
 
 # create an instance of APIRouter
 router = APIRouter()
@@ -18,12 +32,12 @@ router = APIRouter()
 
 # route to create users
 @router.post("/users")
-async def create_user(user: User):
+async def create_user(user: User, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the create_user function from car_pool_service
         # to create a user
-        user_id = create_user_in_db(user)
+        user_id = await create_user_in_db(user, db=db)
 
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
@@ -33,33 +47,32 @@ async def create_user(user: User):
 
 # route to get user by mail id
 @router.get("/users/{mail_id}")
-async def get_user(mail_id: str):
+async def get_user(mail_id: str, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the get_user_by_id function from car_pool_service
         # to get a user by mail id
-        user = get_user_by_id(mail_id)
+        user = await get_user_by_id(mail_id, db=db)
 
         # if user is None, return a message
         if user is None:
             return {"message": "User not found"}
 
-        # convert the user string to json
-        user = json.loads(user)
-
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
-    return user
+
+    # serialize the mongodb document straight to the response body
+    return MongoJSONResponse(user)
 
 
 # route to update user by id
 @router.put("/users")
-async def update_user(user: User):
+async def update_user(user: User, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the update_user_in_db function from car_pool_service
         # to update a user by mail id
-        user_id = update_user_in_db(user, User.mail_id)
+        user_id = await update_user_in_db(user, User.mail_id, db=db)
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
 
@@ -68,12 +81,12 @@ async def update_user(user: User):
 
 # route to delete user by id
 @router.delete("/users/{mail_id}")
-async def delete_user(mail_id: str):
+async def delete_user(mail_id: str, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the delete_user_in_db function from car_pool_service
         # to delete a user by mail id
-        delete_user_in_db(mail_id)
+        await delete_user_in_db(mail_id, db=db)
 
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
@@ -82,12 +95,12 @@ async def delete_user(mail_id: str):
 
 # route to create rides
 @router.post("/rides")
-async def create_ride(mail_id: str, date: str, destination: str, seats_offered: int, vehicle_type: str):
+async def create_ride(mail_id: str, date: str, destination: str, seats_offered: int, vehicle_type: str, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the create_ride_in_db function from car_pool_service
         # to create a ride
-        create_ride_in_db(mail_id, date, destination, seats_offered, vehicle_type)
+        await create_ride_in_db(mail_id, date, destination, seats_offered, vehicle_type, db=db)
 
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
@@ -95,89 +108,215 @@ async def create_ride(mail_id: str, date: str, destination: str, seats_offered:
     return {"message": "Ride created successfully"}
 
 
-# route to get ride by id
+# route to get ride by id, limit and after page through the rides,
+# stream returns all the rides as NDJSON without loading them in memory
 @router.get("/rides/{mail_id}/{status}")
-async def get_ride(mail_id: str, status: str):
+async def get_ride(mail_id: str, status: str, limit: int = None, after: str = None, fields: str = None,
+                   stream: bool = False, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
+        # fields is a comma separated list of the fields to return
+        fields = [field for field in fields.split(',') if field] if fields else None
+        if limit is not None:
+            limit = max(1, min(limit, get_app_settings().ride_history_max_limit))
+
+        # stream the rides straight from the mongodb cursor, one json document per line,
+        # the cursor is read in the bounded db threads like the other db calls
+        if stream:
+            rides = await iter_db(await run_db(iter_rides_by_id, mail_id, status, after, limit, fields, db=db))
+            return StreamingResponse((dumps_bson(ride) + b"\n" async for ride in rides),
+                                     media_type="application/x-ndjson")
+
         # call the get_ride_by_id function from car_pool_service
         # to get a ride by mail id
-        ride = get_ride_by_id(mail_id, status)
+        ride = await get_ride_by_id(mail_id, status, after, limit, fields, db=db)
 
         if ride is None:
             return {"message": "Ride not found"}
 
-        ride = json.loads(ride)
-
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}
 
-    return ride
+    # a full page has a cursor to the next one
+    headers = {}
+    if limit is not None and len(ride) == limit:
+        headers["X-Next-After"] = str(ride[-1]["_id"])
+    return MongoJSONResponse(ride, headers=headers)
 
 
 # route to find ride for a user
 @router.get("/rides/find/{mail_id}/{destination}/{date}")
-async def find_ride(mail_id: str, destination: str, date: str):
+async def find_ride(mail_id: str, destination: str, date: str, geo_search: bool = False, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # fetch the user details with mail id
-        user = get_user_by_id(mail_id)
-        user_json = json.loads(user)
-        
+        user = await get_user_by_id(mail_id, db=db)
+
         # call the find_ride function from car_pool_service
         # to find a ride for a user
-        lat = user_json.get('latitude')
-        lon = user_json.get('longitude')
+        lat = user.get('latitude')
+        lon = user.get('longitude')
 
-        ride = find_rides_by_lat_lon(lat, lon, mail_id, destination, date)
+        ride = await find_rides_by_lat_lon(lat, lon, mail_id, destination, date, geo_search, db=db)
 
-        # if ride is None, return a message
+        # if ride is None, return a message with the known destinations close to the requested one
         if ride is None:
+            suggestions = await suggest_destinations_in_db(destination, db=db)
+            if suggestions:
+                return {"message": "Ride not found", "suggestions": suggestions}
             return {"message": "Ride not found"}
 
-        ride = json.loads(ride)
-
     except:
         return {"message": "An error occurred"}
 
-    return ride
+    return MongoJSONResponse(ride)
 
 
 # route to join a ride
 @router.post("/rides/join")
-async def join_ride(ride_id: str, mail_id: str):
+async def join_ride(ride_id: str, mail_id: str, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
         # call the join_ride function from car_pool_service
         # to join a ride
-        updated_count, ride_info = update_riders_in_db(ride_id, mail_id)
+        updated_count, ride_info = await update_riders_in_db(ride_id, mail_id, db=db)
 
         # if updated count is greater than 0 then return Rider joined successfully.
         if updated_count > 0:
-            return {
+            return MongoJSONResponse({
                         "message": "Ride joined successfully",
-                        "ride": json.loads(ride_info)
-                    }
+                        "ride": ride_info
+                    })
         else:
             return {
-                "message": "Ride not found"
+                "message": "Ride not found or no seats available"
             }
 
     except:
         return {"message": "An error occurred"}
     
 
-# route to update ride status
+# route to update ride status, durability is "acknowledged" or "fire_and_forget" when write-behind is enabled
 @router.put("/rides/status")
-async def update_ride_status(ride_id: str, status: str):
+async def update_ride_status(ride_id: str, status: str, durability: str = None, db=Depends(get_db)):
     # use try catch block to handle exceptions
     try:
-        # call the update_ride_status function from car_pool_service
-        # to update ride status
-        update_ride_status_in_db(ride_id, status)
+        # call the queue_ride_status function from write_behind
+        # to update ride status, through the write-behind queue when it is enabled
+        await queue_ride_status(ride_id, status, durability, db=db)
 
     except:
         return {"message": "An error occurred"}
 
     return {"message": "Ride status updated successfully"}
 
+
+# route to create or update the coordinates of a destination
+@router.put("/places")
+async def upsert_place(place: Place, db=Depends(get_db)):
+    # use try catch block to handle exceptions
+    try:
+        # call the upsert_place_in_db function from car_pool_service
+        # to save the place used to rank the rides by detour
+        await upsert_place_in_db(place, db=db)
+
+    except Exception as e:
+        return {"message": f"An error occurred: {str(e)}"}
+
+    return {"message": f"Place {place.name} saved successfully"}
+
+
+# route to create or update many users
+@router.post("/users/bulk")
+async def bulk_upsert_users(users: List[User], chunk_size: int = None, db=Depends(get_db)):
+    # use try catch block to handle exceptions
+    try:
+        # call the bulk_upsert_users_in_db function from bulk_service
+        # to upsert the users with unordered bulk writes
+        result = await bulk_upsert_users_in_db(users, chunk_size, db=db)
+
+    except Exception as e:
+        return {"message": f"An error occurred: {str(e)}"}
+
+    return {"message": f"{len(users) - len(result['errors'])} users saved", **result}
+
+
+# route to create the rides of a recurring ride offer
+@router.post("/rides/recurring")
+async def create_recurring_rides(ride: RecurringRide, chunk_size: int = None, db=Depends(get_db)):
+    # use try catch block to handle exceptions
+    try:
+        # call the create_recurring_ride_offer_in_db function from bulk_service
+        # to expand the ride to its dates and insert them with unordered bulk writes
+        result = await create_recurring_ride_offer_in_db(ride, chunk_size, db=db)
+
+    except Exception as e:
+        return {"message": f"An error occurred: {str(e)}"}
+
+    return MongoJSONResponse({"message": f"{len(result['inserted_ids'])} rides created successfully", **result})
+
+
+# route to join many riders to rides
+@router.post("/rides/join/bulk")
+async def bulk_join_rides(joins: List[JoinRequest], chunk_size: int = None, db=Depends(get_db)):
+    # use try catch block to handle exceptions
+    try:
+        # call the bulk_join_rides_in_db function from bulk_service
+        # to join the rides with unordered bulk writes
+        result = await bulk_join_rides_in_db(joins, chunk_size, db=db)
+
+    except Exception as e:
+        return {"message": f"An error occurred: {str(e)}"}
+
+    return {"message": f"{len(result['joined'])} rides joined successfully", **result}
+
+
+# route to assign many riders to the rides of a destination at once
+@router.post("/rides/assign")
+async def assign_rides(request: AssignmentRequest, db=Depends(get_db)):
+    # use try catch block to handle exceptions
+    try:
+        # call the assign_rides_in_db function from assignment_service
+        # to match the riders to the rides with the minimum total pickup distance
+        result = await assign_rides_in_db(
+            request.destination, request.date, request.mail_ids, request.method,
+            request.max_distance_km, request.commit, db=db
+        )
+
+    except Exception as e:
+        return {"message": f"An error occurred: {str(e)}"}
+
+    return {"message": f"{len(result['assigned'])} riders assigned", **result}
+
+
+# route to read the mongodb connection pool statistics
+@router.get("/db/pool")
+async def get_db_pool(db=Depends(get_db)):
+    return get_pool_stats(db.client)
+
+
+# route to read the user cache statistics
+@router.get("/cache/users")
+async def get_user_cache_stats():
+    cache = get_user_cache()
+    if cache is None:
+        return {"message": "User cache is disabled"}
+    return cache.stats()
+
+
+# route to read the ride index statistics
+@router.get("/cache/rides")
+async def get_ride_index_stats():
+    index = get_ride_index()
+    if index is None:
+        return {"message": "Ride index is disabled"}
+    return MongoJSONResponse(index.stats())
+
+
+# route to read the ride status write-behind queue statistics
+@router.get("/queue/status")
+async def get_status_queue_stats(db=Depends(get_db)):
+    queue = get_status_queue(db)
+    if queue is None:
+        return {"message": "Write-behind is disabled"}
+    return queue.stats()
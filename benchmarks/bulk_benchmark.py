@@ -0,0 +1,74 @@
+# compare the single-item handlers with the bulk handlers against a local mongodb
+import time
+import argparse
+from app.core.config import get_app_settings
+from app.core.mongo import create_mongo_client
+from app.models.requestModels import User, JoinRequest
+from app.handlers.car_pool_service import create_user_in_db, create_ride_in_db, update_riders_in_db
+from app.handlers.bulk_service import (bulk_upsert_users_in_db, create_recurring_rides_in_db,
+    bulk_join_rides_in_db, recurring_dates
+)
+
+
+# function to build n synthetic users
+def make_users(count: int, prefix: str):
+    return [
+        User(first_name='Bench', last_name=str(i), mail_id=f'{prefix}{i}@bench.local', mobile='0000000000',
+             address='bench', latitude=12.97 + i * 1e-5, longitude=77.59, vehicle=[])
+        for i in range(count)
+    ]
+
+
+# function to time a callable and return the items per second
+def timed(label: str, count: int, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28} {count:>7} items {elapsed:>8.3f} s {count / elapsed:>10.0f} items/s')
+    return elapsed
+
+
+def run(db, count: int, chunk_size: int):
+    # users, one insert_one per user against one bulk upsert
+    single_users = make_users(count, 'single')
+    bulk_users = make_users(count, 'bulk')
+    timed('create_user_in_db', count, lambda: [create_user_in_db(user, db=db) for user in single_users])
+    timed('bulk_upsert_users_in_db', count,
+          lambda: bulk_upsert_users_in_db(bulk_users, chunk_size, db=db))
+
+    # rides, one insert per date against one recurring offer
+    driver = single_users[0].mail_id
+    dates = recurring_dates('2030-01-01T09:00:00.000Z', count)
+    timed('create_ride_in_db', count,
+          lambda: [create_ride_in_db(driver, date, 'bench', 4, 'car', db=db) for date in dates])
+    result = {}
+    timed('create_recurring_rides_in_db', count,
+          lambda: result.update(create_recurring_rides_in_db(driver, dates, 'bench', 4, 'car', chunk_size, db=db)))
+
+    # joins, one find_one_and_update per join against batched joins
+    ride_ids = [str(ride_id) for ride_id in result['inserted_ids']]
+    riders = [user.mail_id for user in bulk_users]
+    timed('update_riders_in_db', count,
+          lambda: [update_riders_in_db(ride_id, rider, db=db) for ride_id, rider in zip(ride_ids, riders)])
+    joins = [JoinRequest(ride_id=ride_id, mail_id=rider) for ride_id, rider in zip(ride_ids, riders[1:] + riders[:1])]
+    timed('bulk_join_rides_in_db', count, lambda: bulk_join_rides_in_db(joins, chunk_size, db=db))
+
+
+"""
+usage:
+python -m benchmarks.bulk_benchmark --count 10000 --chunk-size 1000
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", help="items per benchmark", default=10000, type=int)
+    parser.add_argument("--chunk-size", help="documents per bulk write", default=1000, type=int)
+    parser.add_argument("--database", help="scratch database, dropped at the end", default="carpooldb_bench")
+    args = vars(parser.parse_args())
+
+    client = create_mongo_client(get_app_settings())
+    client.drop_database(args['database'])
+    try:
+        run(client[args['database']], args['count'], args['chunk_size'])
+    finally:
+        client.drop_database(args['database'])
+        client.close()
@@ -0,0 +1,111 @@
+# memory and allocation benchmark of the matching path over a large candidate set: the columnar
+# match_candidates against the dict wrappers which find_rides_by_lat_lon used to build
+import gc
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from app.handlers.dist_calc_service import find_nearest
+from app.handlers.car_pool_service import match_candidates
+from benchmarks.data_generator import DataGenerator
+
+
+# the previous matching path, one wrapper dict per candidate then a copy of every returned one
+def wrapped_match(lat, lon, mail_id, candidates):
+    lat_lon = []
+    for candidate in candidates:
+        ride = candidate['ride']
+        if ride['mail_id'] == mail_id or ride['seats_offered'] - len(ride['riders']) <= 0:
+            continue
+        lat_lon.append({"latitude": ride['latitude'], "longitude": ride['longitude'], "ride": ride,
+                        "address": candidate['address']})
+    if not lat_lon:
+        return None
+    return find_nearest(lat, lon, lat_lon)
+
+
+# function to trace one search: the peak memory, and the memory blocks allocated by it which were not freed
+# by its end, i.e. the result and any garbage
+def trace(search):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = search()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    return result, peak, blocks
+
+
+# function to measure the latency, peak memory and allocations of a search over the same candidates
+def measure(name: str, search, points: list):
+    result, peak, blocks = trace(lambda: search(*points[0]))
+    latencies = np.empty(len(points), dtype=np.float64)
+    for i, (lat, lon) in enumerate(points):
+        start = time.perf_counter()
+        search(lat, lon)
+        latencies[i] = time.perf_counter() - start
+
+    report = {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "peak_memory_kb": peak / 1024,
+        "allocated_blocks": blocks,
+        "returned": len(result or []),
+    }
+    print(f'{name:<16} p50 {report["p50_ms"]:>9.3f} ms  p99 {report["p99_ms"]:>9.3f} ms  '
+          f'peak {report["peak_memory_kb"]:>10.0f} KiB  blocks {report["allocated_blocks"]:>8}  '
+          f'returned {report["returned"]}')
+    return report
+
+
+def run(args):
+    # the candidates of one destination and time window, as held by the search cache or the ride index
+    generator = DataGenerator(users=args['users'], rides=args['candidates'], seed=args['seed'])
+    candidates = [
+        {"ride": {**ride, "_id": i}, "address": f"{i} Bench Road"}
+        for i, ride in enumerate(ride for chunk in generator.iter_rides() for ride in chunk)
+    ]
+    lat, lon = generator.center
+    rng = np.random.default_rng(args['seed'])
+    points = [(lat + dlat, lon + dlon) for dlat, dlon in rng.uniform(-0.05, 0.05, (args['operations'], 2))]
+    mail_id = generator.mail_id(0)
+
+    results = {
+        "columnar": measure("columnar", lambda lat, lon: match_candidates(lat, lon, mail_id, candidates), points),
+        "dict_wrappers": measure("dict_wrappers", lambda lat, lon: wrapped_match(lat, lon, mail_id, candidates),
+                                 points),
+    }
+    return {"params": args, "results": results}
+
+
+"""
+usage:
+python -m benchmarks.candidate_benchmark --candidates 100000
+python -m benchmarks.candidate_benchmark --candidates 100000 --check
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", help="rides in the candidate set", default=100000, type=int)
+    parser.add_argument("--users", help="number of drivers", default=10000, type=int)
+    parser.add_argument("--operations", help="searches per variant", default=20, type=int)
+    parser.add_argument("--seed", help="random seed", default=42, type=int)
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--check", help="fail when the columnar path uses more memory than the dict wrappers",
+                        action="store_true")
+    args = vars(parser.parse_args())
+    report = run(args)
+
+    if args['output']:
+        with open(args['output'], "w") as file:
+            json.dump(report, file, indent=2)
+
+    columnar, wrapped = report["results"]["columnar"], report["results"]["dict_wrappers"]
+    if args['check'] and (columnar["peak_memory_kb"] > wrapped["peak_memory_kb"]
+                          or columnar["allocated_blocks"] > wrapped["allocated_blocks"]):
+        print("the columnar matching path allocates more than the dict wrappers")
+        sys.exit(1)
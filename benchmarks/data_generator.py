@@ -0,0 +1,122 @@
+# synthetic users and rides spread over a city for the benchmarks
+from datetime import datetime, timedelta
+import numpy as np
+from app.handlers.car_pool_service import geo_point
+from app.handlers.destination_service import normalize_destination, reset_destination_dictionary
+
+# bengaluru city centre
+CITY_CENTER = (12.9715987, 77.5945627)
+
+# default destinations with their share of the rides
+DESTINATIONS = {
+    "Office": 0.5,
+    "Tech Park": 0.25,
+    "Airport": 0.1,
+    "Railway Station": 0.1,
+    "Mall": 0.05,
+}
+
+
+class DataGenerator:
+    def __init__(self, users: int = 1000, rides: int = 1000, city_radius_km: float = 15,
+                 destinations: dict = None, day: datetime = datetime(2030, 1, 7),
+                 peak_hour: float = 9.0, peak_spread_hours: float = 1.0, days: int = 1,
+                 center=CITY_CENTER, seed: int = 42):
+        self.users = users
+        self.rides = rides
+        self.city_radius_km = city_radius_km
+        self.destinations = destinations or DESTINATIONS
+        self.day = day
+        self.peak_hour = peak_hour
+        self.peak_spread_hours = peak_spread_hours
+        self.days = days
+        self.center = center
+        self.seed = seed
+
+    # function to draw points uniformly over a disc around the city centre
+    def points(self, rng, count: int):
+        # sqrt keeps the density uniform over the disc
+        distance = self.city_radius_km * np.sqrt(rng.random(count))
+        bearing = rng.random(count) * 2 * np.pi
+        lat = self.center[0] + (distance * np.cos(bearing)) / 111.32
+        lon = self.center[1] + (distance * np.sin(bearing)) / (111.32 * np.cos(np.radians(self.center[0])))
+        return lat, lon
+
+    # function to draw ride dates around the peak hour of each day
+    def dates(self, rng, count: int):
+        day = rng.integers(0, self.days, count)
+        hours = np.clip(rng.normal(self.peak_hour, self.peak_spread_hours, count), 0, 23.99)
+        minutes = np.round(day * 24 * 60 + hours * 60).astype(np.int64)
+        return [self.day + timedelta(minutes=int(minute)) for minute in minutes]
+
+    def mail_id(self, index: int):
+        return f"user{index}@bench.local"
+
+    # function to generate the users in chunks, so that millions of users fit in memory
+    def iter_users(self, chunk_size: int = 100000):
+        rng = np.random.default_rng(self.seed)
+        for start in range(0, self.users, chunk_size):
+            count = min(chunk_size, self.users - start)
+            lat, lon = self.points(rng, count)
+            yield [
+                {
+                    "first_name": "Bench",
+                    "last_name": str(start + i),
+                    "mail_id": self.mail_id(start + i),
+                    "mobile": "0000000000",
+                    "address": f"{start + i} Bench Road",
+                    "latitude": float(lat[i]),
+                    "longitude": float(lon[i]),
+                    "location": geo_point(lat[i], lon[i]),
+                    "vehicle": [{"type": "car", "seats_offered": "4"}],
+                }
+                for i in range(count)
+            ]
+
+    # function to generate the rides in chunks, each ride is offered by a random user
+    def iter_rides(self, chunk_size: int = 100000):
+        rng = np.random.default_rng(self.seed + 1)
+        names = list(self.destinations)
+        weights = np.array([self.destinations[name] for name in names], dtype=np.float64)
+        weights /= weights.sum()
+        for start in range(0, self.rides, chunk_size):
+            count = min(chunk_size, self.rides - start)
+            drivers = rng.integers(0, self.users, count)
+            lat, lon = self.points(rng, count)
+            destinations = rng.choice(len(names), count, p=weights)
+            seats = rng.integers(1, 5, count)
+            dates = self.dates(rng, count)
+            yield [
+                {
+                    "mail_id": self.mail_id(int(drivers[i])),
+                    "latitude": float(lat[i]),
+                    "longitude": float(lon[i]),
+                    "destination_id": int(destinations[i]) + 1,
+                    "seats_offered": int(seats[i]),
+                    "riders": [],
+                    "date": dates[i],
+                    "status": "scheduled",
+                    "vehicle": "car",
+                    "location": geo_point(lat[i], lon[i]),
+                }
+                for i in range(count)
+            ]
+
+    # function to generate the destinations dictionary, the ids follow the order of the destinations
+    def iter_destinations(self):
+        return [
+            {"_id": i + 1, "name": normalize_destination(name), "label": name}
+            for i, name in enumerate(self.destinations)
+        ]
+
+    # function to load the generated users and rides into a database
+    def load(self, db, chunk_size: int = 100000):
+        db['destinations'].insert_many(self.iter_destinations(), ordered=False)
+        db['counters'].update_one({"_id": "destinations"}, {"$set": {"seq": len(self.destinations)}}, upsert=True)
+        for users in self.iter_users(chunk_size):
+            db['users'].insert_many(users, ordered=False)
+        for rides in self.iter_rides(chunk_size):
+            db['rides'].insert_many(rides, ordered=False)
+        # the destinations of this db are loaded again on next use
+        reset_destination_dictionary()
+        return db
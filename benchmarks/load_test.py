@@ -0,0 +1,290 @@
+# async http load generator for the api, it drives a mix of the routes at a
+# target request rate, steps the rate up to find the saturation point and
+# reports per route latency histograms and error rates
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+from datetime import timedelta
+import httpx
+import numpy as np
+from benchmarks.data_generator import DataGenerator
+
+# latency histogram buckets in ms
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+
+# default mix of the routes, in percent
+DEFAULT_MIX = {"register": 5, "offer": 10, "find": 60, "join": 15, "status": 10}
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+# per route latencies and errors of one load step
+class StepStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.dropped = 0
+
+    def record(self, route: str, latency: float, ok: bool):
+        self.latencies[route].append(latency)
+        if not ok:
+            self.errors[route] += 1
+
+    def report(self, elapsed: float):
+        routes = {}
+        total = 0
+        for route, latencies in sorted(self.latencies.items()):
+            latencies_ms = np.array(latencies) * 1000
+            counts, _ = np.histogram(latencies_ms, bins=[0] + BUCKETS_MS)
+            total += len(latencies)
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors[route],
+                "error_rate": self.errors[route] / len(latencies),
+                "p50_ms": float(np.percentile(latencies_ms, 50)),
+                "p90_ms": float(np.percentile(latencies_ms, 90)),
+                "p99_ms": float(np.percentile(latencies_ms, 99)),
+                "histogram_ms": {f"<={bucket:g}": int(count) for bucket, count in zip(BUCKETS_MS, counts)},
+            }
+        all_latencies = np.concatenate([np.array(latencies) for latencies in self.latencies.values()]) * 1000 \
+            if self.latencies else np.array([0.0])
+        return {
+            "throughput_rps": total / elapsed,
+            "requests": total,
+            "dropped": self.dropped,
+            "errors": sum(self.errors.values()),
+            "p99_ms": float(np.percentile(all_latencies, 99)),
+            "routes": routes,
+        }
+
+
+# user and ride ids known to the load generator
+class Workload:
+    def __init__(self, generator: DataGenerator, mix: dict, seed: int):
+        self.generator = generator
+        self.rng = random.Random(seed)
+        self.routes = list(mix)
+        self.weights = [mix[route] for route in self.routes]
+        self.users = generator.users
+        self.ride_ids = []
+        self.destinations = list(generator.destinations)
+        self.date = generator.day.replace(hour=int(generator.peak_hour))
+
+    def user(self):
+        return self.generator.mail_id(self.rng.randrange(self.users))
+
+    # function to build the next request of the mix
+    def next_request(self):
+        route = self.rng.choices(self.routes, self.weights)[0]
+        if route == "register":
+            index = self.users
+            self.users += 1
+            lat, lon = self.generator.points(np.random.default_rng(index), 1)
+            return route, "POST", "/api/users", {"json": {
+                "first_name": "Load", "last_name": str(index), "mail_id": self.generator.mail_id(index),
+                "mobile": "0000000000", "address": f"{index} Load Road", "latitude": float(lat[0]),
+                "longitude": float(lon[0]), "vehicle": []}}
+        if route == "offer":
+            minutes = int(self.rng.gauss(0, 60))
+            date = self.date + timedelta(minutes=minutes)
+            return route, "POST", "/api/rides", {"params": {
+                "mail_id": self.user(), "date": date.strftime(DATE_FORMAT),
+                "destination": self.rng.choice(self.destinations), "seats_offered": self.rng.randint(1, 4),
+                "vehicle_type": "car"}}
+        if route == "find" or not self.ride_ids:
+            destination = self.rng.choice(self.destinations)
+            return "find", "GET", f"/api/rides/find/{self.user()}/{destination}/{self.date.strftime(DATE_FORMAT)}", {}
+        if route == "join":
+            return route, "POST", "/api/rides/join", {"params": {
+                "ride_id": self.rng.choice(self.ride_ids), "mail_id": self.user()}}
+        # most rides are started, a few are completed
+        status = "completed" if self.rng.random() < 0.2 else "scheduled"
+        return route, "PUT", "/api/rides/status", {"params": {"ride_id": self.rng.choice(self.ride_ids),
+                                                              "status": status}}
+
+    # function to learn the ride ids from the search results
+    def observe(self, route: str, response: httpx.Response):
+        if route != "find" or response.status_code != 200:
+            return
+        body = response.json()
+        if isinstance(body, list):
+            for item in body[:5]:
+                self.ride_ids.append(item["ride"]["_id"])
+            # keep the known rides bounded
+            del self.ride_ids[:-10000]
+
+
+# function to check if a response is a success, the routes return errors as messages
+def is_ok(response: httpx.Response):
+    if response.status_code >= 400:
+        return False
+    body = response.json()
+    return not (isinstance(body, dict) and str(body.get("message", "")).startswith("An error occurred"))
+
+
+# function to seed the users and rides through the bulk routes
+async def seed(client: httpx.AsyncClient, generator: DataGenerator):
+    for users in generator.iter_users(chunk_size=1000):
+        for user in users:
+            user.pop("location")
+        response = await client.post("/api/users/bulk", json=users, timeout=120)
+        if not is_ok(response):
+            raise RuntimeError(f"seeding the users failed: {response.text}")
+    rng = random.Random(0)
+    day = generator.day.replace(hour=int(generator.peak_hour)).strftime(DATE_FORMAT)
+    for index in range(0, generator.rides, 10):
+        # each seeded driver offers 10 weekday commutes
+        response = await client.post("/api/rides/recurring", json={
+            "mail_id": generator.mail_id(rng.randrange(generator.users)), "date": day,
+            "destination": rng.choice(list(generator.destinations)), "seats_offered": rng.randint(1, 4),
+            "vehicle_type": "car", "occurrences": min(10, generator.rides - index), "weekdays_only": True
+        }, timeout=120)
+        if not is_ok(response):
+            raise RuntimeError(f"seeding the rides failed: {response.text}")
+
+
+# function to send the requests of the mix at a fixed rate for a duration, open loop
+async def run_step(client: httpx.AsyncClient, workload: Workload, rate: float, duration: float,
+                   max_in_flight: int):
+    stats = StepStats()
+    in_flight = set()
+
+    async def send(route, method, path, kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+            ok = is_ok(response)
+            workload.observe(route, response)
+        except (httpx.HTTPError, ValueError):
+            ok = False
+        stats.record(route, time.perf_counter() - start, ok)
+
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        # the requests are scheduled on a fixed timeline, whatever the response times
+        due = start + sent / rate
+        now = time.perf_counter()
+        if due - start >= duration:
+            break
+        if due > now:
+            await asyncio.sleep(due - now)
+        sent += 1
+        if len(in_flight) >= max_in_flight:
+            # the client can not keep up, count the request as dropped
+            stats.dropped += 1
+            continue
+        task = asyncio.create_task(send(*workload.next_request()))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.wait(in_flight)
+    return stats.report(time.perf_counter() - start)
+
+
+# function to step the rate up and find the knee of the throughput curve
+async def run_load(args):
+    generator = DataGenerator(users=args['users'], rides=args['rides'], seed=args['seed'])
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, (args['mix'] or "").split(",")):
+        route, weight = item.split("=")
+        mix[route] = float(weight)
+    workload = Workload(generator, mix, args['seed'])
+
+    limits = httpx.Limits(max_connections=args['connections'], max_keepalive_connections=args['connections'])
+    async with httpx.AsyncClient(base_url=args['url'], limits=limits, timeout=args['timeout']) as client:
+        await seed(client, generator)
+
+        steps = []
+        saturation = None
+        rate = args['start_rate']
+        while rate <= args['max_rate']:
+            report = await run_step(client, workload, rate, args['step_seconds'], args['connections'] * 4)
+            report["target_rps"] = rate
+            steps.append(report)
+            print(f'target {rate:>7.0f} rps  achieved {report["throughput_rps"]:>7.0f} rps  '
+                  f'p99 {report["p99_ms"]:>8.1f} ms  errors {report["errors"]:>5}  dropped {report["dropped"]:>5}')
+
+            # saturated once the server falls behind the target or the p99 leaves the slo
+            saturated = (report["throughput_rps"] < rate * 0.95 or report["p99_ms"] > args['slo_p99_ms']
+                         or report["dropped"] > 0)
+            if saturated:
+                saturation = rate
+                break
+            rate += args['rate_step']
+
+    # the knee is the last step which kept up with its target
+    sustained = [step for step in steps if step["target_rps"] != saturation]
+    return {
+        "params": args,
+        "mix": mix,
+        "max_sustained_rps": sustained[-1]["throughput_rps"] if sustained else 0,
+        "saturation_target_rps": saturation,
+        "steps": steps,
+    }
+
+
+# function to start the app in a subprocess and wait for it to answer
+def start_app(args):
+    target = "benchmarks.standin_app:app" if args['backend'] == "standin" else "main:app"
+    host, port = "127.0.0.1", args['port']
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", target, "--host", host, "--port", str(port),
+                                "--workers", str(args['workers']), "--log-level", "warning"])
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://{host}:{port}/openapi.json", timeout=1)
+            return process, f"http://{host}:{port}"
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("the app did not start")
+
+
+"""
+usage:
+python -m benchmarks.load_test --backend standin --start-rate 50 --rate-step 50 --max-rate 2000
+python -m benchmarks.load_test --url http://127.0.0.1:8005 --output capacity.json
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="target an app which is already running")
+    parser.add_argument("--backend", help="app to start when no url is given", choices=["standin", "mongo"],
+                        default="standin")
+    parser.add_argument("--port", help="port of the started app", default=8015, type=int)
+    parser.add_argument("--workers", help="workers of the started app", default=1, type=int)
+    parser.add_argument("--users", help="users to seed", default=2000, type=int)
+    parser.add_argument("--rides", help="rides to seed", default=5000, type=int)
+    parser.add_argument("--mix", help="route weights, e.g. find=60,join=15")
+    parser.add_argument("--start-rate", help="first target rate, requests per second", default=50, type=float)
+    parser.add_argument("--rate-step", help="rate increase per step", default=50, type=float)
+    parser.add_argument("--max-rate", help="last target rate", default=2000, type=float)
+    parser.add_argument("--step-seconds", help="duration of each step", default=10, type=float)
+    parser.add_argument("--slo-p99-ms", help="p99 latency above which the app is saturated", default=500,
+                        type=float)
+    parser.add_argument("--connections", help="http connections of the client", default=100, type=int)
+    parser.add_argument("--timeout", help="request timeout in seconds", default=10, type=float)
+    parser.add_argument("--seed", help="random seed", default=42, type=int)
+    parser.add_argument("--output", help="save the capacity report to this json file")
+    args = vars(parser.parse_args())
+
+    process = None
+    if not args['url']:
+        process, args['url'] = start_app(args)
+    try:
+        result = asyncio.run(run_load(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(f'max sustained {result["max_sustained_rps"]:.0f} rps, saturated at {result["saturation_target_rps"]} rps')
+    if args['output']:
+        with open(args['output'], 'w') as output:
+            json.dump(result, output, indent=2)
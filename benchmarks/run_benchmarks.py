@@ -0,0 +1,217 @@
+# benchmark suite for the matching and persistence hot paths, the results are
+# saved as json so that two commits can be compared
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+from app.core.config import get_app_settings
+from app.handlers.dist_calc_service import haversine, find_nearest
+from app.handlers.car_pool_service import (find_rides_by_lat_lon, get_ride_by_id, update_riders_in_db,
+    get_search_cache, get_user_cache, sync_ride_index, DATE_FORMAT
+)
+from benchmarks.data_generator import DataGenerator
+from benchmarks import standin
+
+# operations traced with tracemalloc to measure the peak memory
+MEMORY_SAMPLE = 50
+
+
+# function to measure the latency of each operation, the throughput and the peak memory
+def measure(name: str, operations: list):
+    # peak memory on a sample, tracemalloc slows down the calls it traces
+    gc.collect()
+    tracemalloc.start()
+    for operation in operations[:MEMORY_SAMPLE]:
+        operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # latency of every operation
+    latencies = np.empty(len(operations), dtype=np.float64)
+    start = time.perf_counter()
+    for i, operation in enumerate(operations):
+        operation_start = time.perf_counter()
+        operation()
+        latencies[i] = time.perf_counter() - operation_start
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "operations": len(operations),
+        "throughput_ops": len(operations) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "mean_ms": float(latencies.mean() * 1000),
+        "peak_memory_kb": peak / 1024,
+    }
+    print(f'{name:<24} {result["throughput_ops"]:>12.0f} ops/s  p50 {result["p50_ms"]:>9.3f} ms  '
+          f'p99 {result["p99_ms"]:>9.3f} ms  peak {result["peak_memory_kb"]:>10.0f} KiB')
+    return result
+
+
+# function to build the benchmark operations over the generated data
+def benchmarks(db, generator: DataGenerator, operations: int, candidates: int, rng: random.Random):
+    lat, lon = generator.center
+    points = [(lat + rng.uniform(-0.1, 0.1), lon + rng.uniform(-0.1, 0.1)) for _ in range(operations)]
+
+    # haversine on random pairs
+    yield "haversine", [
+        (lambda a=a, b=b: haversine(a[0], a[1], b[0], b[1])) for a, b in zip(points, reversed(points))
+    ]
+
+    # find_nearest over a fixed candidate list
+    users = [{"latitude": point[0], "longitude": point[1]} for point in points[:candidates]]
+    yield "find_nearest", [(lambda point=point: find_nearest(point[0], point[1], users)) for point in points]
+
+    # ride search of random riders around the peak hour
+    destinations = list(generator.destinations)
+    searches = [
+        (rng.randrange(generator.users), rng.choice(destinations),
+         (generator.day.replace(hour=int(generator.peak_hour))).strftime(DATE_FORMAT))
+        for _ in range(operations)
+    ]
+    yield "find_rides_by_lat_lon", [
+        (lambda search=search, point=point: find_rides_by_lat_lon(
+            point[0], point[1], generator.mail_id(search[0]), search[1], search[2], db=db))
+        for search, point in zip(searches, points)
+    ]
+
+    # ride history of random users
+    yield "get_ride_by_id", [
+        (lambda user=rng.randrange(generator.users): get_ride_by_id(generator.mail_id(user), "scheduled", db=db))
+        for _ in range(operations)
+    ]
+
+    # joins of random riders to random rides
+    ride_ids = [str(ride["_id"]) for ride in db['rides'].find({"destination_id": 1}, {"_id": 1})]
+    yield "update_riders_in_db", [
+        (lambda ride_id=rng.choice(ride_ids), user=rng.randrange(generator.users):
+            update_riders_in_db(ride_id, generator.mail_id(user), db=db))
+        for _ in range(operations)
+    ]
+
+
+# function to get the current commit, if any
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# function to compare two result files, a regression is a throughput drop or a p99 rise above the threshold
+def compare(baseline: dict, current: dict, threshold: float):
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        throughput = result["throughput_ops"] / before["throughput_ops"] - 1
+        p99 = result["p99_ms"] / before["p99_ms"] - 1 if before["p99_ms"] else 0
+        print(f'{name:<24} throughput {throughput:>+8.1%}  p99 {p99:>+8.1%}')
+        if throughput < -threshold or p99 > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def run(args):
+    # configure the caches of the handlers
+    settings = get_app_settings()
+    settings.search_cache_enabled = args['search_cache']
+    settings.user_cache_enabled = args['user_cache']
+    settings.ride_index_enabled = args['ride_index']
+    if args['search_cache']:
+        get_search_cache().clear()
+    if args['user_cache']:
+        get_user_cache().clear()
+
+    generator = DataGenerator(users=args['users'], rides=args['rides'], days=args['days'],
+                              peak_spread_hours=args['spread_hours'], seed=args['seed'])
+
+    # load the data into the stand-in or a scratch mongodb database
+    client = None
+    if args['backend'] == 'mongo':
+        from app.core.mongo import create_mongo_client
+        from app.handlers.index_service import ensure_indexes
+        client = create_mongo_client(settings)
+        client.drop_database(args['database'])
+        db = client[args['database']]
+        ensure_indexes(db)
+    else:
+        db = standin.Database()
+    start = time.perf_counter()
+    generator.load(db)
+    print(f'loaded {args["users"]} users and {args["rides"]} rides in {time.perf_counter() - start:.1f} s')
+    if args['ride_index']:
+        # the generated rides are in the future, stretch the horizon up to their last day
+        last_day = generator.day + timedelta(days=generator.days + 1)
+        settings.ride_index_horizon_hours = int((last_day - datetime.utcnow()).total_seconds() // 3600) + 1
+        start = time.perf_counter()
+        sync_ride_index(db)
+        print(f'loaded the ride index in {time.perf_counter() - start:.1f} s')
+
+    try:
+        results = {}
+        rng = random.Random(args['seed'])
+        for name, operations in benchmarks(db, generator, args['operations'], args['candidates'], rng):
+            results[name] = measure(name, operations)
+    finally:
+        if client is not None:
+            client.drop_database(args['database'])
+            client.close()
+
+    return {
+        "commit": current_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": args,
+        "results": results,
+    }
+
+
+"""
+usage:
+python -m benchmarks.run_benchmarks --rides 100000 --output results.json
+python -m benchmarks.run_benchmarks --rides 100000 --compare results.json
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", help="stand-in or a local mongodb", choices=["standin", "mongo"],
+                        default="standin")
+    parser.add_argument("--database", help="scratch mongodb database, dropped at the end",
+                        default="carpooldb_bench")
+    parser.add_argument("--users", help="number of users", default=10000, type=int)
+    parser.add_argument("--rides", help="number of rides, from 1k to 10M", default=100000, type=int)
+    parser.add_argument("--days", help="days the rides are spread over", default=1, type=int)
+    parser.add_argument("--spread-hours", help="standard deviation around the peak hour", default=1.0,
+                        type=float)
+    parser.add_argument("--operations", help="operations per benchmark", default=1000, type=int)
+    parser.add_argument("--candidates", help="candidates of the find_nearest benchmark", default=1000,
+                        type=int)
+    parser.add_argument("--search-cache", help="enable the search cache", action="store_true")
+    parser.add_argument("--user-cache", help="enable the user cache", action="store_true")
+    parser.add_argument("--ride-index", help="enable the in-memory ride index", action="store_true")
+    parser.add_argument("--seed", help="random seed", default=42, type=int)
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--compare", help="compare with the results of this json file")
+    parser.add_argument("--threshold", help="allowed regression, 0.1 is 10%%", default=0.1, type=float)
+    args = vars(parser.parse_args())
+
+    current = run(args)
+    if args['output']:
+        with open(args['output'], 'w') as output:
+            json.dump(current, output, indent=2)
+    if args['compare']:
+        with open(args['compare']) as baseline_file:
+            regressions = compare(json.load(baseline_file), current, args['threshold'])
+        if regressions:
+            print(f'regressions: {", ".join(regressions)}')
+            sys.exit(1)
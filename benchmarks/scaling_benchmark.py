@@ -0,0 +1,143 @@
+# throughput of the production server for a growing number of workers, on the cpu bound ride search
+# every worker of the stand-in app is seeded with the same data, so the searches find the same rides
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+from multiprocessing import Pool
+import httpx
+import numpy as np
+from benchmarks.data_generator import DataGenerator
+from benchmarks.load_test import Workload, is_ok
+
+
+# function to start the server with the given workers and wait for it to be ready
+def start_server(args, workers: int):
+    host, port = "127.0.0.1", args['port']
+    # the memory caches can not be shared by the workers, the searches run without them at every step
+    env = {**os.environ, "STANDIN_USERS": str(args['users']), "STANDIN_RIDES": str(args['rides']),
+           "STANDIN_SEED": str(args['seed']), "SERVER_ACCESS_LOG": "false", "USER_CACHE_ENABLED": "false",
+           "SEARCH_CACHE_ENABLED": "false", "PLACE_CACHE_ENABLED": "false"}
+    process = subprocess.Popen([sys.executable, "-m", "app.core.server", "--app", "benchmarks.standin_app:app",
+                                "--host", host, "--port", str(port), "--workers", str(workers)], env=env)
+    url = f"http://{host}:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("the server did not start")
+
+
+# function to send searches back to back on each connection until the deadline, in one client process
+def drive(url: str, args: dict, seed: int, deadline: float):
+    workload = Workload(DataGenerator(users=args['users'], rides=args['rides'], seed=args['seed']),
+                        {"find": 100}, seed)
+    latencies = []
+    errors = 0
+
+    async def connection(client):
+        nonlocal errors
+        while time.time() < deadline:
+            _, method, path, kwargs = workload.next_request()
+            start = time.perf_counter()
+            try:
+                ok = is_ok(await client.request(method, path, **kwargs))
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    async def run():
+        limits = httpx.Limits(max_connections=args['connections'], max_keepalive_connections=args['connections'])
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args['timeout']) as client:
+            await asyncio.gather(*(connection(client) for _ in range(args['connections'])))
+
+    asyncio.run(run())
+    return latencies, errors
+
+
+# function to measure the throughput of the server with the given workers
+def measure(args, workers: int):
+    process, url = start_server(args, workers)
+    try:
+        with Pool(args['clients']) as pool:
+            # warm up the workers before the measured run
+            warm_up = time.time() + args['warm_up_seconds']
+            pool.starmap(drive, [(url, args, seed, warm_up) for seed in range(args['clients'])])
+            start = time.time()
+            results = pool.starmap(drive, [(url, args, seed, start + args['seconds'])
+                                           for seed in range(args['clients'])])
+            elapsed = time.time() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = np.array([latency for result in results for latency in result[0]]) * 1000
+    return {
+        "workers": workers,
+        "requests": int(latencies.size),
+        "errors": sum(result[1] for result in results),
+        "throughput_rps": latencies.size / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)) if latencies.size else 0.0,
+        "p99_ms": float(np.percentile(latencies, 99)) if latencies.size else 0.0,
+    }
+
+
+def run(args):
+    steps = []
+    for workers in args['workers']:
+        step = measure(args, workers)
+        # speedup over the first step, efficiency is the speedup per added worker
+        base = steps[0] if steps else step
+        step["speedup"] = step["throughput_rps"] / base["throughput_rps"] if base["throughput_rps"] else 0.0
+        step["efficiency"] = step["speedup"] / (workers / base["workers"])
+        steps.append(step)
+        print(f'workers {workers:>3}  {step["throughput_rps"]:>8.0f} rps  p50 {step["p50_ms"]:>8.1f} ms  '
+              f'p99 {step["p99_ms"]:>8.1f} ms  speedup {step["speedup"]:>5.2f}  '
+              f'efficiency {step["efficiency"]:>5.2f}  errors {step["errors"]}')
+    return {"params": args, "cpu_count": os.cpu_count(), "steps": steps}
+
+
+"""
+usage:
+python -m benchmarks.scaling_benchmark --workers 1,2,4 --clients 4
+python -m benchmarks.scaling_benchmark --workers 1,2,4,8 --check 0.8 --output scaling.json
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", help="comma separated worker counts", default="1,2,4")
+    parser.add_argument("--port", help="port of the started server", default=8016, type=int)
+    parser.add_argument("--users", help="users seeded in every worker", default=2000, type=int)
+    parser.add_argument("--rides", help="rides seeded in every worker", default=20000, type=int)
+    parser.add_argument("--clients", help="client processes, keep cores free for them", default=4, type=int)
+    parser.add_argument("--connections", help="connections per client process", default=16, type=int)
+    parser.add_argument("--seconds", help="duration of each measured run", default=10, type=float)
+    parser.add_argument("--warm-up-seconds", help="duration of the warm up run", default=2, type=float)
+    parser.add_argument("--timeout", help="request timeout in seconds", default=10, type=float)
+    parser.add_argument("--seed", help="random seed", default=42, type=int)
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--check", help="fail when the efficiency of a step is below this ratio", type=float)
+    args = vars(parser.parse_args())
+    args['workers'] = [int(workers) for workers in args['workers'].split(",")]
+    report = run(args)
+
+    if args['output']:
+        with open(args['output'], "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args['check'] is not None:
+        if max(args['workers']) + args['clients'] > report["cpu_count"]:
+            print(f'warning: {max(args["workers"])} workers and {args["clients"]} clients share '
+                  f'{report["cpu_count"]} cores, the scaling is bounded by the cores')
+        low = [step for step in report["steps"] if step["efficiency"] < args['check']]
+        if low:
+            print(f'scaling below {args["check"]:.0%} efficiency at {[step["workers"] for step in low]} workers')
+            sys.exit(1)
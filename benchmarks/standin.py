@@ -0,0 +1,323 @@
+# in-process stand-in for the mongodb collections used by the handlers, it
+# supports the query operators of the handlers and hash indexes on equality
+# fields so that the benchmarks can run without a mongodb server
+import copy
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+from bson import ObjectId
+from pymongo import ReturnDocument, InsertOne
+
+_MISSING = object()
+
+
+# function to check a value against an operator document, arrays match any element
+def _match_value(value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$ne":
+                if value == operand or (isinstance(value, list) and operand in value):
+                    return False
+            elif operator == "$in":
+                values = value if isinstance(value, list) else [value]
+                if not any(item in operand for item in values):
+                    return False
+            elif operator == "$gt":
+                if value is _MISSING or value is None or not value > operand:
+                    return False
+            elif operator == "$gte":
+                if value is _MISSING or value is None or not value >= operand:
+                    return False
+            elif operator == "$lt":
+                if value is _MISSING or value is None or not value < operand:
+                    return False
+            elif operator == "$lte":
+                if value is _MISSING or value is None or not value <= operand:
+                    return False
+            elif operator == "$exists":
+                if (value is not _MISSING) != operand:
+                    return False
+            else:
+                raise NotImplementedError(f"operator {operator} is not supported by the stand-in")
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+# function to evaluate the aggregation expressions used in $expr
+def _evaluate(document, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return document.get(expression[1:])
+    if isinstance(expression, dict):
+        (operator, operand), = expression.items()
+        if operator == "$size":
+            return len(_evaluate(document, operand))
+        if operator == "$lt":
+            return _evaluate(document, operand[0]) < _evaluate(document, operand[1])
+        if operator == "$in":
+            return _evaluate(document, operand[0]) in _evaluate(document, operand[1])
+        raise NotImplementedError(f"expression {operator} is not supported by the stand-in")
+    return expression
+
+
+# function to check a document against a query
+def matches(document, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(document, branch) for branch in condition):
+                return False
+        elif field == "$expr":
+            if not _evaluate(document, condition):
+                return False
+        elif not _match_value(document.get(field, _MISSING), condition):
+            return False
+    return True
+
+
+# function to copy a value of a stored document, the documents only nest one level
+def _copy(value):
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+# function to apply an inclusion or exclusion projection
+def project(document, projection):
+    if not projection:
+        return {field: _copy(value) for field, value in document.items()}
+    include = {field for field, flag in projection.items() if flag}
+    if include:
+        result = {field: _copy(document[field]) for field in include if field in document}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    return {field: _copy(value) for field, value in document.items() if projection.get(field, 1)}
+
+
+class Cursor:
+    def __init__(self, documents, projection=None):
+        self._documents = documents
+        self._projection = projection
+        self._sort = None
+        self._limit = None
+
+    def sort(self, key, direction=1):
+        self._sort = (key, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        documents = self._documents
+        if self._sort is not None:
+            key, direction = self._sort
+            documents = sorted(documents, key=lambda document: document[key], reverse=direction < 0)
+        if self._limit:
+            documents = documents[:self._limit]
+        return (project(document, self._projection) for document in documents)
+
+
+class Collection:
+    # fields with a hash index, a stand-in for the indexes of index_service
+    INDEXED_FIELDS = ("_id", "mail_id", "destination_id", "riders")
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._documents = {}
+        self._indexes = {field: defaultdict(set) for field in self.INDEXED_FIELDS}
+        self.calls = defaultdict(int)
+
+    def _keys(self, document, field):
+        value = document.get(field, _MISSING)
+        if value is _MISSING:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def _index(self, document):
+        for field, index in self._indexes.items():
+            for key in self._keys(document, field):
+                index[key].add(document["_id"])
+
+    def _unindex(self, document):
+        for field, index in self._indexes.items():
+            for key in self._keys(document, field):
+                index[key].discard(document["_id"])
+
+    # function to pick the candidate ids through a hash index, None for a full scan
+    def _candidates(self, query):
+        for field, condition in query.items():
+            if field in self._indexes and not isinstance(condition, dict):
+                return set(self._indexes[field].get(condition, ()))
+            if field in self._indexes and isinstance(condition, dict) and set(condition) == {"$in"}:
+                ids = set()
+                for value in condition["$in"]:
+                    ids |= self._indexes[field].get(value, set())
+                return ids
+        if "$or" in query:
+            ids = set()
+            for branch in query["$or"]:
+                branch_ids = self._candidates(branch)
+                if branch_ids is None:
+                    return None
+                ids |= branch_ids
+            return ids
+        if "$and" in query:
+            for branch in query["$and"]:
+                branch_ids = self._candidates(branch)
+                if branch_ids is not None:
+                    return branch_ids
+        return None
+
+    def _find(self, query):
+        ids = self._candidates(query or {})
+        # ObjectIds grow with the insertion order, like the natural order of mongodb
+        documents = self._documents.values() if ids is None else (self._documents[i] for i in sorted(ids))
+        return [document for document in documents if matches(document, query or {})]
+
+    def insert_one(self, document):
+        self.calls["insert_one"] += 1
+        with self._lock:
+            document.setdefault("_id", ObjectId())
+            stored = copy.deepcopy(document)
+            self._documents[stored["_id"]] = stored
+            self._index(stored)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    def insert_many(self, documents, ordered=True):
+        self.calls["insert_many"] += 1
+        inserted_ids = []
+        with self._lock:
+            for document in documents:
+                document.setdefault("_id", ObjectId())
+                stored = copy.deepcopy(document)
+                self._documents[stored["_id"]] = stored
+                self._index(stored)
+                inserted_ids.append(document["_id"])
+        return SimpleNamespace(inserted_ids=inserted_ids)
+
+    def find(self, query=None, projection=None):
+        self.calls["find"] += 1
+        with self._lock:
+            return Cursor(self._find(query), projection)
+
+    def find_one(self, query=None, projection=None):
+        self.calls["find_one"] += 1
+        with self._lock:
+            documents = self._find(query)
+            return project(documents[0], projection) if documents else None
+
+    def _update(self, document, update):
+        self._unindex(document)
+        for field, value in update.get("$set", {}).items():
+            document[field] = copy.deepcopy(value)
+        for field, value in update.get("$push", {}).items():
+            document.setdefault(field, []).append(value)
+        for field, value in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + value
+        for field in update.get("$unset", {}):
+            document.pop(field, None)
+        self._index(document)
+
+    def find_one_and_update(self, query, update, projection=None, return_document=ReturnDocument.BEFORE,
+                            upsert=False):
+        self.calls["find_one_and_update"] += 1
+        with self._lock:
+            documents = self._find(query)
+            if not documents:
+                if not upsert:
+                    return None
+                document = self._documents[self._upsert(query, update)]
+                return project(document, projection) if return_document == ReturnDocument.AFTER else None
+            document = documents[0]
+            before = project(document, projection)
+            self._update(document, update)
+            return project(document, projection) if return_document == ReturnDocument.AFTER else before
+
+    def update_one(self, query, update, upsert=False):
+        self.calls["update_one"] += 1
+        with self._lock:
+            documents = self._find(query)
+            upserted_id = None
+            if documents:
+                self._update(documents[0], update)
+            elif upsert:
+                upserted_id = self._upsert(query, update)
+            return SimpleNamespace(matched_count=len(documents[:1]), modified_count=len(documents[:1]),
+                                   upserted_id=upserted_id)
+
+    def _upsert(self, query, update):
+        # the new document starts from the equality fields of the filter
+        document = {field: value for field, value in query.items()
+                    if not field.startswith("$") and not isinstance(value, dict)}
+        document.setdefault("_id", ObjectId())
+        self._update(document, update)
+        self._documents[document["_id"]] = document
+        self._index(document)
+        return document["_id"]
+
+    def bulk_write(self, operations, ordered=True):
+        self.calls["bulk_write"] += 1
+        result = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nUpserted": 0}
+        with self._lock:
+            for operation in operations:
+                # the stand-in reads the write models of pymongo
+                if isinstance(operation, InsertOne):
+                    self.insert_one(operation._doc)
+                    result["nInserted"] += 1
+                    continue
+                documents = self._find(operation._filter)
+                if documents:
+                    self._update(documents[0], operation._doc)
+                    result["nMatched"] += 1
+                    result["nModified"] += 1
+                elif operation._upsert:
+                    self._upsert(operation._filter, operation._doc)
+                    result["nUpserted"] += 1
+        return SimpleNamespace(bulk_api_result=result, acknowledged=True, modified_count=result["nModified"],
+                               upserted_count=result["nUpserted"], inserted_count=result["nInserted"])
+
+    # the stand-in applies every write at once, whatever the write concern
+    def with_options(self, **kwargs):
+        return self
+
+    def delete_one(self, query):
+        self.calls["delete_one"] += 1
+        with self._lock:
+            documents = self._find(query)
+            if documents:
+                self._unindex(documents[0])
+                del self._documents[documents[0]["_id"]]
+            return SimpleNamespace(deleted_count=len(documents[:1]))
+
+    def count_documents(self, query):
+        with self._lock:
+            return len(self._find(query))
+
+    def create_index(self, *args, **kwargs):
+        return None
+
+    def create_indexes(self, indexes):
+        return []
+
+
+class Database:
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(name)
+        return self._collections[name]
+
+    # function to count the calls made to all the collections
+    def call_counts(self):
+        return {name: dict(collection.calls) for name, collection in self._collections.items()}
@@ -0,0 +1,26 @@
+# the api backed by the in-process stand-in instead of mongodb, for the load tests
+# usage: uvicorn benchmarks.standin_app:app
+# STANDIN_USERS and STANDIN_RIDES seed every worker with the same generated data, for read only load
+import os
+from main import get_application
+from app.core.config import get_app_settings
+from app.core.mongo import set_database
+from app.core.events import start_warm_up
+from benchmarks import standin
+from benchmarks.data_generator import DataGenerator
+
+app = get_application()
+
+
+@app.on_event("startup")
+async def startup_event():
+    # every worker gets its own stand-in database, empty unless seeding is asked for
+    db = standin.Database()
+    users = int(os.environ.get("STANDIN_USERS", 0))
+    rides = int(os.environ.get("STANDIN_RIDES", 0))
+    if users or rides:
+        DataGenerator(users=users, rides=rides, seed=int(os.environ.get("STANDIN_SEED", 42))).load(db)
+    app.state.db = db
+    set_database(db)
+    # the stand-in has no index catalog
+    await start_warm_up(app, db, get_app_settings(), skip=("indexes",))
@@ -1,11 +1,15 @@
 import argparse
-import uvicorn
-import os
 from fastapi import FastAPI
-from pymongo import MongoClient
+from starlette.responses import PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 from app.core.config import get_app_settings
 from app.routes.api_routes import router
+from app.routes import admin_routes
+from app.core.server import run_server
+from app.core.profiler import ProfilerMiddleware, SlowestProfiles
+from app.core.events import create_start_app_handler, create_stop_app_handler, get_warm_up
+from app.core.metrics import MetricsMiddleware, registry
+from app.core.responses import MongoJSONResponse
 
 
 def get_application() -> FastAPI:
@@ -20,6 +24,25 @@ def get_application() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # request count, latency and in-flight metrics per route
+    application.add_middleware(MetricsMiddleware)
+    # sampling profiler, only installed when enabled so that it costs nothing otherwise
+    if settings.profiler_enabled:
+        application.state.profiles = SlowestProfiles(settings.profiler_keep)
+        application.add_middleware(
+            ProfilerMiddleware,
+            store=application.state.profiles,
+            sample_rate=settings.profiler_sample_rate,
+            header=settings.profiler_header,
+            interval=settings.profiler_interval_ms / 1000,
+            token=settings.admin_token,
+        )
+        application.include_router(
+            router=admin_routes.router,
+            tags=["admin"],
+            prefix="/admin",
+            include_in_schema=False
+        )
     # error handlers
 
     # api routes
@@ -29,39 +52,46 @@ def get_application() -> FastAPI:
         prefix="/api"
     )
 
+    # prometheus metrics
+    application.add_route("/metrics", metrics, include_in_schema=False)
+
+    # readiness, once the startup warm-up is done
+    application.add_route("/ready", ready, include_in_schema=False)
+
     return application
 
 
-# app instance
-app = get_application()
+# route to expose the metrics in the prometheus text format
+async def metrics(request):
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
-@app.on_event("startup")
-async def startup_event():
-    # create mongodb connection
-    # read from env variables
-    mongo_host=os.getenv('MONGO_HOST')
-    mongo_port=os.getenv('MONGO_PORT')
-    print(f'mongo_host: {mongo_host}, mongo_port: {mongo_port}')
-    client = MongoClient(
-        f'mongodb://{mongo_host}:{mongo_port}/?directConnection=true&serverSelectionTimeoutMS=2000&appName=mongosh+2.2.6')
-    db = client['carpooldb']
-    app.state.db = db
+# route to report the readiness of the worker with the duration of each warm-up phase
+async def ready(request):
+    warm_up = get_warm_up(request.app)
+    return MongoJSONResponse(warm_up.report(), status_code=200 if warm_up.ready else 503)
+
+
+# app instance
+app = get_application()
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    # close mongodb connection
-    app.state.db.client.close()
+# warm up the worker before it reports ready, and release its resources on shutdown
+startup_event = create_start_app_handler(app, get_app_settings())
+shutdown_event = create_stop_app_handler(app)
+app.add_event_handler("startup", startup_event)
+app.add_event_handler("shutdown", shutdown_event)
 
 
 """
 usage:
 uvicorn main:app
+python main.py --workers 4
 """
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--host", help="application host", required=True, type=str)
-    parser.add_argument("--port", help="application port", required=True, type=int)
+    parser.add_argument("--host", help="application host", type=str)
+    parser.add_argument("--port", help="application port", type=int)
+    parser.add_argument("--workers", help="worker processes, one per cpu core by default", type=int)
     args = vars(parser.parse_args())
-    uvicorn.run(app, host=args['host'], port=args['port'])
+    run_server("main:app", host=args['host'], port=args['port'], workers=args['workers'])
@@ -1,8 +1,15 @@
 import sys
 import os
 import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo import ReturnDocument
 import pytest
+import numpy as np
 from unittest.mock import patch
 from unittest.mock import Mock
 
@@ -13,31 +20,113 @@ sys.path.append(parent_dir)
 from app.handlers.car_pool_service import (Ride, User,
     update_user_in_db, create_user_in_db, get_user_by_id, 
     delete_user_in_db, create_ride_in_db, get_ride_by_id,
-    find_rides_by_lat_lon, update_riders_in_db, connect_mongo
+    find_rides_by_lat_lon, update_riders_in_db, connect_mongo,
+    find_rides_near, geo_point, parse_ride_date, ride_search_filter, ride_history_filter,
+    get_user_cache, get_search_cache, update_ride_status_in_db, ride_join_filter,
+    iter_rides_by_id, get_place_cache, upsert_place_in_db, candidate_columns, match_candidates
+)
+
+from app.handlers import async_car_pool_service, car_pool_service
+from app.handlers.ride_index import RideIndex
+from app.core.config import get_app_settings
+from app.core.mongo import PoolStats, set_database, get_database
+from app.core.server import gunicorn_options, uvicorn_options, post_fork, worker_conflicts, run_server
+from app.core.events import warm_up_app, get_warm_up
+from app.handlers.car_pool_service import get_ride_candidates, invalidate_ride_buckets
+from app.handlers import write_behind
+from app.handlers.write_behind import WriteBehindQueue, WriteBehindQueueFull, queue_ride_status, close_status_queue
+from app.core.responses import MongoJSONResponse
+from app.core.cache import TTLCache
+from app.handlers.bulk_service import (bulk_upsert_users_in_db, recurring_dates,
+    create_recurring_rides_in_db, bulk_join_rides_in_db
+)
+from app.models.requestModels import JoinRequest, Place
+from app.handlers.destination_service import (DestinationDictionary, normalize_destination,
+    reset_destination_dictionary, set_destination_dictionary, intern_destination, resolve_destination,
+    suggest_destinations
+)
+from pymongo.errors import BulkWriteError
+from benchmarks.data_generator import DataGenerator
+from benchmarks import standin
+from benchmarks.load_test import StepStats
+from app.handlers.assignment_service import (UNASSIGNED, assign_greedy, assign_optimal,
+    assign_rides_in_db
+)
+from app.core.profiler import Profile, SlowestProfiles
+from app.core.metrics import Histogram, MongoCommandMetrics, MONGO_COMMAND_LATENCY
+from app.handlers.index_service import (INDEXES, ensure_indexes, index_drift, winning_plan_stages,
+    verify_query_plans
+)
+
+from app.handlers.dist_calc_service import (haversine, find_nearest,
+    haversine_vector, distance_matrix, find_nearest_many, rank_by_detour
 )
 
 
-from app.handlers.dist_calc_service import haversine, find_nearest
+# destinations used by the tests with mocked collections
+TEST_DESTINATIONS = [
+    {'_id': 1, 'name': 'test destination', 'label': 'Test Destination'},
+    {'_id': 2, 'name': 'office', 'label': 'Office'},
+]
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # every test starts with empty user and search caches
+    get_user_cache().clear()
+    get_search_cache().clear()
+    get_place_cache().clear()
+    # the destinations of the mocked rides are known without a db
+    set_destination_dictionary(DestinationDictionary().load(TEST_DESTINATIONS))
+    yield
+    get_user_cache().clear()
+    get_search_cache().clear()
+    get_place_cache().clear()
+    reset_destination_dictionary()
 
 
 # Test function
 def test_connect_mongo(mocker):
-    # Create a mock app with state and db attributes
+    # Create a mock db opened at startup
     mock_db = Mock()
-    mock_state = Mock()
-    mock_state.db = mock_db
-    mock_app = Mock()
-    mock_app.state = mock_state
-    
-    # Use mocker to patch the 'main.app' with our mock_app
-    mocker.patch('main.app', mock_app)
-    
+    mocker.patch('app.handlers.car_pool_service.get_database', return_value=mock_db)
+
     # Call the function to test
     result = connect_mongo()
-    
+
     # Check that the returned db is the mocked db
     assert result == mock_db
 
+    # Check that an injected db is used as it is
+    injected_db = Mock()
+    assert connect_mongo(injected_db) == injected_db
+
+
+def test_pool_stats():
+    # Create the pool listener
+    pool_stats = PoolStats()
+
+    # two connections created, one checked out and one waiting for a connection
+    pool_stats.connection_created(Mock())
+    pool_stats.connection_created(Mock())
+    pool_stats.connection_check_out_started(Mock())
+    pool_stats.connection_checked_out(Mock())
+    pool_stats.connection_check_out_started(Mock())
+
+    # Check the snapshot of the statistics
+    stats = pool_stats.snapshot()
+    assert stats['created'] == 2
+    assert stats['checked_out'] == 1
+    assert stats['waiting'] == 1
+
+    # check in the connection and fail the waiting check out
+    pool_stats.connection_checked_in(Mock())
+    pool_stats.connection_check_out_failed(Mock())
+    stats = pool_stats.snapshot()
+    assert stats['checked_out'] == 0
+    assert stats['waiting'] == 0
+    assert stats['check_out_failed'] == 1
+
 
 @patch('app.handlers.car_pool_service.connect_mongo')
 def test_create_user_in_db(mock_connect_mongo):
@@ -60,8 +149,10 @@ def test_create_user_in_db(mock_connect_mongo):
     # Call the create_user_in_db function
     result = create_user_in_db(user)
 
-    # Assert that the insert_one method was called with the user object
-    mock_collection.insert_one.assert_called_once_with(user.dict())
+    # Assert that the insert_one method was called with the user object and its location
+    mock_collection.insert_one.assert_called_once_with(
+        {**user.dict(), "location": {"type": "Point", "coordinates": [-122.5678, 37.1234]}}
+    )
 
     # Assert that the inserted_id is returned
     assert result == mock_collection.insert_one.return_value.inserted_id
@@ -91,7 +182,6 @@ def test_get_user_by_id(mock_connect_mongo):
 
     # Call the get_user_by_id function
     result = get_user_by_id('john.doe@example.com')
-    result = json.loads(result)
 
     # Assert that the find_one method was called with the correct arguments
     mock_collection.find_one.assert_called_once_with({"mail_id": 'john.doe@example.com'})
@@ -134,6 +224,7 @@ def test_update_user_in_db(mock_connect_mongo):
                     "address": '123 Main St',
                     "latitude": float('37.1234'),
                     "longitude": float('-122.5678'),
+                    "location": {"type": "Point", "coordinates": [-122.5678, 37.1234]},
                     "vehicle": []
                 }
         }
@@ -187,19 +278,20 @@ def test_create_ride_in_db(mock_get_user_by_id, mock_connect_mongo):
     result = create_ride_in_db(mail_id, date, destination, seats_offered, vehicle_type)
 
     # Assert that the get_user_by_id method was called with the correct arguments
-    mock_get_user_by_id.assert_called_once_with(mail_id)
+    mock_get_user_by_id.assert_called_once_with(mail_id, db=mock_db)
 
     # Assert that the insert_one method was called with the correct arguments
     mock_collection.insert_one.assert_called_once_with({
         'mail_id': mail_id,
         'latitude': mock_user['latitude'],
         'longitude': mock_user['longitude'],
-        'destination': destination,
+        'destination_id': 1,
         'seats_offered': seats_offered,
         'riders': [],
-        'date': date,
+        'date': datetime(2022, 1, 1),
         'status': 'scheduled',
-        'vehicle': vehicle_type
+        'vehicle': vehicle_type,
+        'location': {'type': 'Point', 'coordinates': [mock_user['longitude'], mock_user['latitude']]}
     })
 
     # Assert that the inserted_id is returned
@@ -232,7 +324,6 @@ def test_get_ride_by_id(mock_connect_mongo):
 
     # Call the get_ride_by_id function
     result = get_ride_by_id('test@gmail.com', 'scheduled')
-    result = json.loads(result)
     # Assert that the find method was called with the correct arguments
     mock_collection.find.assert_called_once_with({
         "$or": [
@@ -253,9 +344,10 @@ def test_get_ride_by_id(mock_connect_mongo):
 
 @patch('app.handlers.car_pool_service.connect_mongo')
 def test_find_rides_by_lat_lon(mock_connect_mongo):
-    # Mock the connect_mongo function
-    mock_db = mock_connect_mongo.return_value
-    mock_collection = mock_db.__getitem__.return_value
+    # separate mocks for the collections, the destination has no coordinates and no other destination is known
+    collections = {'users': Mock(), 'rides': Mock(), 'places': Mock(find_one=Mock(return_value=None)),
+                   'destinations': Mock(find_one=Mock(return_value=None))}
+    mock_connect_mongo.return_value.__getitem__ = Mock(side_effect=lambda name: collections[name])
 
     # Define the input values
     lat = 12.9715987
@@ -264,39 +356,45 @@ def test_find_rides_by_lat_lon(mock_connect_mongo):
     destination = 'Test Destination'
     date = '2022-01-01T00:00:00.000Z'
 
-    # Mock the collection.find method to return the expected rides
-    mock_collection.find.return_value = [
+    # Mock the collection.find method to return the rides of the destination, their dates are stored as datetimes
+    rides = [
         {
+            'mail_id': 'driver1@gmail.com',
             'latitude': 14.9715987,
             'longitude': 77.5945627,
             'seats_offered': 2,
             'riders': ['rider1'],
-            'date': '2022-01-01T00:00:00.000Z'
+            'destination_id': 1,
+            'date': datetime(2022, 1, 1)
         },
         {
+            'mail_id': 'driver2@gmail.com',
             'latitude': 13.9715987,
             'longitude': 79.5945627,
             'seats_offered': 1,
             'riders': ['rider2'],
-            'date': '2022-01-01T00:00:00.000Z'
+            'destination_id': 1,
+            'date': datetime(2022, 1, 1)
         }
     ]
+    collections['rides'].find.return_value = rides
+    collections['users'].find.return_value = [{'mail_id': 'driver1@gmail.com', 'address': '123 Main St'}]
 
     # Call the find_rides_by_lat_lon function
     result = find_rides_by_lat_lon(lat, lon, mail_id, destination, date)
-    result = json.loads(result)
 
-    expected_result = {
-            'latitude': 14.9715987,
-            'longitude': 77.5945627,
-            'ride': {'latitude': 14.9715987, 
-                    'longitude': 77.5945627, 
-                    'seats_offered': 2, 
-                    'riders': ['rider1'], 'date': '2022-01-01T00:00:00.000Z'
-                    }
-        }
+    # the nearest ride with a free seat, no other ride is within the radius, the second one is full
+    assert len(result) == 1
+    assert result[0]['latitude'] == 14.9715987
+    assert result[0]['longitude'] == 77.5945627
+    assert result[0]['ride']['mail_id'] == 'driver1@gmail.com'
+    assert result[0]['ride']['destination'] == 'Test Destination'
+    assert result[0]['address'] == '123 Main St'
+    assert result[0]['distance_away'] == pytest.approx(haversine(lat, lon, 14.9715987, 77.5945627))
+
+    # an unknown destination matches nothing
+    assert find_rides_by_lat_lon(lat, lon, mail_id, 'Nowhere', date) is None
 
-    assert result == expected_result
 
 @patch('app.handlers.car_pool_service.connect_mongo')
 def test_update_riders_in_db(mock_connect_mongo):
@@ -307,25 +405,1318 @@ def test_update_riders_in_db(mock_connect_mongo):
     # Define the input values
     ride_id = ObjectId()
     user_mail_id = 'test@gmail.com'
+    mock_collection.find_one_and_update.return_value = {
+        '_id': ride_id, 'riders': [user_mail_id], 'destination_id': 1, 'date': datetime(2022, 1, 1)
+    }
 
     # Call the update_riders_in_db function
-    result = update_riders_in_db(ride_id, user_mail_id)
-    result = result[0]
-    # Assert that the update_one method was called with the correct arguments
-    mock_collection.update_one.assert_called_once_with(
-        {"_id": ride_id},
+    updated_count, ride_info = update_riders_in_db(ride_id, user_mail_id)
+
+    # Assert that the seat is reserved with one conditional update
+    mock_collection.find_one_and_update.assert_called_once_with(
+        {
+            "_id": ride_id,
+            "status": "scheduled",
+            "mail_id": {"$ne": user_mail_id},
+            "riders": {"$ne": user_mail_id},
+            "$expr": {"$lt": [{"$size": "$riders"}, "$seats_offered"]}
+        },
         {
             "$push":
                 {
                     "riders": user_mail_id
                 }
+        },
+        return_document=ReturnDocument.AFTER
+    )
+    mock_collection.update_one.assert_not_called()
+    mock_collection.find.assert_not_called()
+
+    # Assert that the updated ride is returned
+    assert updated_count == 1
+    assert ride_info == [mock_collection.find_one_and_update.return_value]
+
+    # nothing matched, the ride is full or already joined
+    mock_collection.find_one_and_update.return_value = None
+    assert update_riders_in_db(ride_id, user_mail_id) == (0, [])
+
+
+def test_ride_join_filter():
+    # a scheduled ride with 3 seats, 2 of them taken
+    ride_id = ObjectId()
+    ride = {"_id": ride_id, "mail_id": "driver@gmail.com", "status": "scheduled", "seats_offered": 3,
+            "riders": ["rider1@gmail.com", "rider2@gmail.com"]}
+
+    # the filter matches a new rider only, the overbooking guard is the filter evaluated by mongodb
+    # in the update, the concurrency itself is checked against mongodb by the test below
+    assert standin.matches(ride, ride_join_filter(str(ride_id), "rider3@gmail.com"))
+    assert not standin.matches(ride, ride_join_filter(str(ride_id), "rider1@gmail.com"))
+    assert not standin.matches(ride, ride_join_filter(str(ride_id), "driver@gmail.com"))
+    assert not standin.matches({**ride, "status": "completed"}, ride_join_filter(str(ride_id), "rider3@gmail.com"))
+    assert not standin.matches({**ride, "riders": [*ride["riders"], "rider3@gmail.com"]},
+                               ride_join_filter(str(ride_id), "rider4@gmail.com"))
+    assert not standin.matches(ride, ride_join_filter(str(ObjectId()), "rider3@gmail.com"))
+
+
+def test_update_riders_in_db_joins_up_to_the_seats():
+    # one ride with 3 seats in the stand-in, 5 riders each trying to join twice
+    db = standin.Database()
+    ride_id = db['rides'].insert_one({"mail_id": "driver@gmail.com", "status": "scheduled", "destination_id": 1,
+                                      "date": datetime(2022, 1, 1), "seats_offered": 3, "riders": []}).inserted_id
+    results = [update_riders_in_db(str(ride_id), f"rider{i}@gmail.com", db=db)[0] for i in [0, 0, 1, 2, 3, 4]]
+
+    # the repeated join and the joins of a full ride are rejected
+    assert results == [1, 0, 1, 1, 0, 0]
+    assert db['rides'].find_one({"_id": ride_id})["riders"] == ["rider0@gmail.com", "rider1@gmail.com",
+                                                               "rider2@gmail.com"]
+
+
+@pytest.mark.skipif(not os.getenv('MONGO_TEST_URI'), reason="set MONGO_TEST_URI to run against mongodb")
+def test_update_riders_in_db_concurrent_joins_mongodb():
+    from pymongo import MongoClient
+
+    # one popular ride with 3 seats in a scratch collection
+    client = MongoClient(os.getenv('MONGO_TEST_URI'))
+    db = client['carpooldb_test']
+    ride_id = db['rides'].insert_one({
+        "mail_id": "driver@gmail.com",
+        "status": "scheduled",
+        "seats_offered": 3,
+        "riders": []
+    }).inserted_id
+
+    try:
+        # 50 riders, each trying to join twice, from many threads
+        mail_ids = [f"rider{i}@gmail.com" for i in range(50)] * 2
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = list(executor.map(lambda mail_id: update_riders_in_db(str(ride_id), mail_id, db=db), mail_ids))
+
+        # exactly the offered seats are taken, by distinct riders
+        riders = db['rides'].find_one({"_id": ride_id})["riders"]
+        assert sum(updated_count for updated_count, _ in results) == 3
+        assert len(riders) == 3
+        assert len(set(riders)) == 3
+    finally:
+        db['rides'].delete_one({"_id": ride_id})
+        client.close()
+
+
+def test_parse_ride_date():
+    # the api format, other ISO formats and offsets are stored as naive UTC datetimes
+    assert parse_ride_date('2022-01-01T09:30:00.000Z') == datetime(2022, 1, 1, 9, 30)
+    assert parse_ride_date('2022-01-01T09:30:00') == datetime(2022, 1, 1, 9, 30)
+    assert parse_ride_date('2022-01-01T15:00:00+05:30') == datetime(2022, 1, 1, 9, 30)
+    assert parse_ride_date(datetime(2022, 1, 1, 9, 30)) == datetime(2022, 1, 1, 9, 30)
+
+
+def test_ride_search_filter_uses_datetime_window(mocker):
+    # configure a 30 minutes search window
+    settings = Mock(ride_search_window_minutes=30)
+    mocker.patch('app.handlers.car_pool_service.get_app_settings', return_value=settings)
+
+    # Call the ride_search_filter function
+    query = ride_search_filter('test@gmail.com', 'Test Destination', '2022-01-01T09:30:00.000Z')
+
+    # the date range uses native datetimes
+    assert query['date'] == {'$gte': datetime(2022, 1, 1, 9), '$lte': datetime(2022, 1, 1, 10)}
+
+
+@patch('app.handlers.car_pool_service.connect_mongo')
+@patch('app.handlers.car_pool_service.get_user_addresses')
+def test_find_rides_near(mock_get_user_addresses, mock_connect_mongo):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+    mock_get_user_addresses.return_value = {'driver@gmail.com': '123 Main St'}
+
+    # Mock the aggregate method to return the rides sorted by distance
+    mock_collection.aggregate.return_value = [
+        {
+            'mail_id': 'driver@gmail.com',
+            'latitude': 12.9725987,
+            'longitude': 77.5945627,
+            'seats_offered': 2,
+            'riders': [],
+            'distance_away': 0.11
+        }
+    ]
+
+    # Call the find_rides_near function
+    result = find_rides_near(12.9715987, 77.5945627, 'test@gmail.com', 'Test Destination',
+                             '2022-01-01T00:00:00.000Z')
+
+    # Assert that $geoNear was the first stage with the point and max distance in meters
+    pipeline = mock_collection.aggregate.call_args[0][0]
+    geo_near = pipeline[0]['$geoNear']
+    assert geo_near['near'] == geo_point(12.9715987, 77.5945627)
+    assert geo_near['maxDistance'] == 5000
+    assert geo_near['query']['destination_id'] == 1
+    assert geo_near['query']['mail_id'] == {'$ne': 'test@gmail.com'}
+
+    # Assert the result has the same shape as find_nearest
+    assert result[0]['distance_away'] == 0.11
+    assert result[0]['address'] == '123 Main St'
+    assert 'distance_away' not in result[0]['ride']
+
+
+@pytest.mark.parametrize('candidates', [1, 50, 500])
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_find_rides_by_lat_lon_query_count(mock_connect_mongo, candidates):
+    # separate mocks for the users, rides and places collections, the destination has no coordinates
+    collections = {'users': Mock(), 'rides': Mock(), 'places': Mock(find_one=Mock(return_value=None))}
+    mock_connect_mongo.return_value.__getitem__ = Mock(side_effect=lambda name: collections[name])
+
+    # rides of different drivers around the user
+    rides = [
+        {
+            'mail_id': f'driver{i}@gmail.com',
+            'latitude': 12.9715987 + i * 0.001,
+            'longitude': 77.5945627,
+            'seats_offered': 2,
+            'riders': [],
+            'date': datetime(2022, 1, 1)
+        }
+        for i in range(candidates)
+    ]
+    collections['rides'].find.return_value = rides
+    collections['users'].find.return_value = [
+        {'mail_id': ride['mail_id'], 'address': f'address {i}'} for i, ride in enumerate(rides)
+    ]
+
+    # Call the find_rides_by_lat_lon function
+    result = find_rides_by_lat_lon(12.9715987, 77.5945627, 'test@gmail.com', 'Test Destination',
+                                   '2022-01-01T00:00:00.000Z')
+
+    # one query for the rides and one for the drivers, whatever the number of candidates
+    assert collections['rides'].find.call_count == 1
+    assert collections['users'].find.call_count == 1
+    assert collections['users'].find_one.call_count == 0
+    assert result[0]['address'] == 'address 0'
+
+
+@patch('app.handlers.car_pool_service.get_user_by_id')
+def test_async_service_runs_db_calls_concurrently(mock_get_user_by_id):
+    # each blocking db call takes 100 ms
+    def slow_get_user_by_id(mail_id):
+        time.sleep(0.1)
+        return mail_id
+    mock_get_user_by_id.side_effect = slow_get_user_by_id
+
+    async def run():
+        return await asyncio.gather(*[async_car_pool_service.get_user_by_id(f'user{i}') for i in range(10)])
+
+    # ten calls should overlap in the thread pool instead of running one after the other
+    start = time.perf_counter()
+    result = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    assert result == [f'user{i}' for i in range(10)]
+    assert elapsed < 0.5
+
+
+def test_get_ride_stream_reads_the_cursor_in_the_db_threads(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    # seven rides of the driver in the stand-in
+    db = standin.Database()
+    for day in range(7):
+        db['rides'].insert_one({'mail_id': 'driver@gmail.com', 'status': 'scheduled', 'destination_id': 1,
+                                'date': datetime(2030, 1, day + 1), 'seats_offered': 2, 'riders': []})
+    app = main.get_application()
+    app.state.db = db
+
+    # the cursor is read chunk by chunk by run_db, under the db limiter
+    chunks = []
+    run_db = async_car_pool_service.run_db
+
+    async def counted_run_db(func, *args, **kwargs):
+        chunks.append(func)
+        return await run_db(func, *args, **kwargs)
+
+    monkeypatch.setattr(async_car_pool_service, 'run_db', counted_run_db)
+    response = TestClient(app).get('/api/rides/driver@gmail.com/scheduled', params={'stream': True})
+    lines = response.content.splitlines()
+    assert len(lines) == 7
+    assert json.loads(lines[0])['is_rider'] is False
+    # one chunk of rides and the empty chunk which ends the stream
+    assert len(chunks) == 2
+
+    # a bad cursor is reported like on the paged path, before the stream starts
+    response = TestClient(app).get('/api/rides/driver@gmail.com/scheduled', params={'stream': True,
+                                                                                   'after': 'notanid'})
+    assert response.status_code == 200
+    assert response.json()['message'].startswith('An error occurred')
+
+
+def test_ensure_indexes_and_drift():
+    # separate mocks for every collection with indexes
+    collections = {name: Mock() for name in INDEXES}
+    mock_db = Mock()
+    mock_db.__getitem__ = Mock(side_effect=lambda name: collections[name])
+
+    # Call the ensure_indexes function
+    ensure_indexes(mock_db)
+    collections['users'].create_indexes.assert_called_once_with(INDEXES['users'])
+    collections['rides'].create_indexes.assert_called_once_with(INDEXES['rides'])
+
+    # users has every index, rides misses one, has a changed one and an extra one
+    collections['users'].index_information.return_value = {
+        '_id_': {'key': [('_id', 1)]},
+        'mail_id_unique': {'key': [('mail_id', 1)], 'unique': True},
+        'location_2dsphere': {'key': [('location', '2dsphere')]},
+    }
+    collections['rides'].index_information.return_value = {
+        '_id_': {'key': [('_id', 1)]},
+        'mail_id_status_id': {'key': [('mail_id', 1)]},
+        'riders_status_id': {'key': [('riders', 1), ('status', 1), ('_id', 1)]},
+        'location_2dsphere': {'key': [('location', '2dsphere')]},
+        'date_1': {'key': [('date', 1)]},
+    }
+    for name in ('destinations', 'places'):
+        collections[name].index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'name_unique': {'key': [('name', 1)], 'unique': True},
+        }
+
+    # Call the index_drift function
+    drift = index_drift(mock_db)
+
+    assert drift == {
+        'rides': {
+            'missing': ['destination_id_date_status_seats', 'date_status_seats'],
+            'changed': ['mail_id_status_id'],
+            'extra': ['date_1'],
+        }
+    }
+
+
+def test_winning_plan_stages():
+    # an $or query where one branch falls back to a collection scan
+    explain = {
+        'queryPlanner': {
+            'winningPlan': {
+                'stage': 'SUBPLAN',
+                'inputStage': {
+                    'stage': 'OR',
+                    'inputStages': [
+                        {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}},
+                        {'stage': 'COLLSCAN'},
+                    ]
+                }
+            }
         }
+    }
+
+    # Call the winning_plan_stages function
+    assert winning_plan_stages(explain) == ['SUBPLAN', 'OR', 'FETCH', 'IXSCAN', 'COLLSCAN']
+
+
+def test_verify_query_plans_flags_collscans_and_in_memory_sorts():
+    # the queries of every destination have no index, the other queries use one
+    def find(query):
+        cursor = Mock()
+        stages = ['COLLSCAN'] if 'destination_id' not in query and 'date' in query else ['FETCH', 'IXSCAN']
+        cursor.explain.return_value = {'queryPlanner': {'winningPlan': {'stage': stages[0], 'inputStage': {
+            'stage': stages[-1]}}}}
+        # the date sort of preload_hot_users is done in memory
+        cursor.sort.side_effect = lambda sort: Mock(explain=Mock(return_value={'queryPlanner': {'winningPlan': {
+            'stage': 'SORT', 'inputStage': {'stage': 'IXSCAN'}}}}))
+        return cursor
+
+    mock_db = Mock()
+    mock_db.__getitem__ = Mock(return_value=Mock(find=Mock(side_effect=find)))
+    failures = verify_query_plans(mock_db)
+    assert [failure['query'] for failure in failures] == ['sync_ride_index', 'preload_hot_users']
+    assert failures[1]['stages'] == ['SORT', 'IXSCAN']
+
+
+def test_mongo_json_response():
+    # a document with the bson types returned by mongodb
+    ride_id = ObjectId()
+    ride = {
+        '_id': ride_id,
+        'date': datetime(2022, 1, 1, 9, 30),
+        'riders': ['rider1'],
+        'seats_offered': 2
+    }
+
+    # render the response body in one pass
+    body = MongoJSONResponse([ride]).body
+
+    assert json.loads(body) == [{
+        '_id': str(ride_id),
+        'date': '2022-01-01T09:30:00+00:00',
+        'riders': ['rider1'],
+        'seats_offered': 2
+    }]
+
+
+def test_ttl_cache():
+    # a cache of 2 entries with a fake clock
+    now = [0.0]
+    cache = TTLCache(max_size=2, ttl_seconds=10, clock=lambda: now[0])
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # reading a makes b the least recently used
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+    # entries expire after the ttl
+    now[0] = 11
+    assert cache.get('a') is None
+
+    # deleted entries are counted as invalidations
+    cache.set('d', 4)
+    cache.delete('d')
+    assert cache.get('d') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 3
+    assert stats['evictions'] == 1
+    assert stats['expirations'] == 1
+    assert stats['invalidations'] == 1
+
+
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_get_user_by_id_cache(mock_connect_mongo):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+    mock_collection.find_one.return_value = {'mail_id': 'john.doe@example.com', 'address': '123 Main St'}
+
+    # the second read is served by the cache
+    assert get_user_by_id('john.doe@example.com')['address'] == '123 Main St'
+    assert get_user_by_id('john.doe@example.com')['address'] == '123 Main St'
+    assert mock_collection.find_one.call_count == 1
+
+    # updating the user invalidates the cache
+    user = User(
+        first_name='John',
+        last_name='Doe',
+        mail_id='john.doe@example.com',
+        mobile='1234567890',
+        address='456 Side St',
+        latitude='37.1234',
+        longitude='-122.5678',
+        vehicle=[]
     )
+    update_user_in_db(user, 'john.doe@example.com')
+    mock_collection.find_one.return_value = {'mail_id': 'john.doe@example.com', 'address': '456 Side St'}
+    assert get_user_by_id('john.doe@example.com')['address'] == '456 Side St'
+    assert mock_collection.find_one.call_count == 2
 
-    # Assert that the modified_count is returned
-    assert result == mock_collection.update_one.return_value.modified_count
+    # deleting the user invalidates the cache
+    delete_user_in_db('john.doe@example.com')
+    mock_collection.find_one.return_value = None
+    assert get_user_by_id('john.doe@example.com') is None
 
 
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_find_rides_by_lat_lon_search_cache(mock_connect_mongo):
+    # separate mocks for the users, rides and places collections, the destination has no coordinates
+    collections = {'users': Mock(), 'rides': Mock(), 'places': Mock(find_one=Mock(return_value=None))}
+    mock_connect_mongo.return_value.__getitem__ = Mock(side_effect=lambda name: collections[name])
+
+    # two rides in the 9 am bucket and one in the 10 am bucket of the same destination
+    ride_id = ObjectId()
+    rides = [
+        {'_id': ride_id, 'mail_id': 'driver1@gmail.com', 'latitude': 12.9725987, 'longitude': 77.5945627,
+         'seats_offered': 2, 'riders': [], 'destination_id': 2, 'date': datetime(2022, 1, 1, 9, 10)},
+        {'_id': ObjectId(), 'mail_id': 'driver2@gmail.com', 'latitude': 12.9735987, 'longitude': 77.5945627,
+         'seats_offered': 2, 'riders': [], 'destination_id': 2, 'date': datetime(2022, 1, 1, 9, 50)},
+        {'_id': ObjectId(), 'mail_id': 'driver3@gmail.com', 'latitude': 12.9745987, 'longitude': 77.5945627,
+         'seats_offered': 2, 'riders': [], 'destination_id': 2, 'date': datetime(2022, 1, 1, 10, 20)},
+    ]
+    collections['rides'].find.return_value = rides
+    collections['users'].find.return_value = []
+
+    def search(mail_id, date='2022-01-01T09:30:00.000Z'):
+        return find_rides_by_lat_lon(12.9715987, 77.5945627, mail_id, 'Office', date)
+
+    # the first search loads the buckets with one query, the next ones are served by the cache
+    assert len(search('rider1@gmail.com')) == 3
+    assert len(search('rider2@gmail.com')) == 3
+    assert len(search('driver1@gmail.com')) == 2
+    assert collections['rides'].find.call_count == 1
+
+    # a later search window only misses its new bucket
+    assert len(search('rider1@gmail.com', '2022-01-01T10:30:00.000Z')) == 2
+    assert collections['rides'].find.call_count == 2
+
+    # joining a ride invalidates its 9 am bucket only
+    collections['rides'].find_one_and_update.return_value = {**rides[0], 'riders': ['rider1@gmail.com']}
+    update_riders_in_db(str(ride_id), 'rider1@gmail.com')
+    search('rider2@gmail.com')
+    assert collections['rides'].find.call_count == 3
+    query = collections['rides'].find.call_args[0][0]
+    assert query['date'] == {'$gte': datetime(2022, 1, 1, 9), '$lte': datetime(2022, 1, 1, 9, 59, 59, 999999)}
+
+    # completing a ride invalidates its bucket too
+    collections['rides'].find_one_and_update.return_value = {**rides[0], 'status': 'scheduled'}
+    assert update_ride_status_in_db(str(ride_id), 'completed') == 1
+    search('rider2@gmail.com')
+    assert collections['rides'].find.call_count == 4
+
+    # offering a new ride invalidates the bucket of its date
+    collections['users'].find_one.return_value = {'mail_id': 'driver4@gmail.com', 'latitude': 1.0, 'longitude': 2.0}
+    create_ride_in_db('driver4@gmail.com', '2022-01-01T09:45:00.000Z', 'Office', 2, 'Car')
+    search('rider2@gmail.com')
+    assert collections['rides'].find.call_count == 5
+
+
+def test_ttl_cache_generation():
+    cache = TTLCache(max_size=2, ttl_seconds=10)
+
+    # a value loaded before an invalidation of its key is not stored
+    generation = cache.generation('a')
+    cache.delete('a')
+    assert not cache.set_if_generation('a', 1, generation)
+    assert cache.get('a') is None
+
+    # a value loaded after the invalidation is, the invalidations of other keys do not matter
+    generation = cache.generation('a')
+    cache.delete('b')
+    assert cache.set_if_generation('a', 2, generation)
+    assert cache.get('a') == 2
+
+    # with the generation of the whole cache, only the keys invalidated since are skipped
+    generation = cache.generation()
+    cache.delete('c')
+    assert cache.set_if_generation('a', 3, generation)
+    assert not cache.set_if_generation('c', 3, generation)
+    assert cache.stats()['stale_sets'] == 2
+
+
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_get_ride_candidates_skips_buckets_invalidated_during_the_load(mock_connect_mongo):
+    collections = {'users': Mock(), 'rides': Mock()}
+    mock_connect_mongo.return_value.__getitem__ = Mock(side_effect=lambda name: collections[name])
+    collections['users'].find.return_value = []
+    ride = {'_id': ObjectId(), 'mail_id': 'driver1@gmail.com', 'seats_offered': 2, 'riders': [],
+            'destination_id': 2, 'date': datetime(2022, 1, 1, 9, 10)}
+
+    # a ride of the bucket is written while the bucket is loaded, its write invalidates the bucket
+    def find(query, *args):
+        invalidate_ride_buckets(ride)
+        return [ride]
+
+    collections['rides'].find.side_effect = find
+    from_date, to_date = datetime(2022, 1, 1, 9), datetime(2022, 1, 1, 9, 30)
+    assert len(get_ride_candidates(2, from_date, to_date)) == 1
+
+    # the search got the rides it read, but the stale bucket was not cached
+    collections['rides'].find.side_effect = None
+    collections['rides'].find.return_value = [ride]
+    assert len(get_ride_candidates(2, from_date, to_date)) == 1
+    assert collections['rides'].find.call_count == 2
+    assert len(get_ride_candidates(2, from_date, to_date)) == 1
+    assert collections['rides'].find.call_count == 2
+
+
+@patch('app.handlers.bulk_service.connect_mongo')
+def test_bulk_upsert_users_in_db(mock_connect_mongo):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+
+    # five users written in chunks of two, the fourth user fails
+    users = [
+        User(first_name='John', last_name='Doe', mail_id=f'user{i}@example.com', mobile='1234567890',
+             address='123 Main St', latitude='37.1234', longitude='-122.5678', vehicle=[])
+        for i in range(5)
+    ]
+    mock_collection.bulk_write.side_effect = [
+        Mock(bulk_api_result={'nUpserted': 2, 'nModified': 0}),
+        BulkWriteError({'nUpserted': 0, 'nModified': 1,
+                        'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}]}),
+        Mock(bulk_api_result={'nUpserted': 1, 'nModified': 0}),
+    ]
+
+    # Call the bulk_upsert_users_in_db function
+    result = bulk_upsert_users_in_db(users, chunk_size=2)
+
+    # one unordered bulk write per chunk
+    assert mock_collection.bulk_write.call_count == 3
+    operations = mock_collection.bulk_write.call_args_list[0][0][0]
+    assert [operation._doc['$set']['mail_id'] for operation in operations] == ['user0@example.com', 'user1@example.com']
+    assert mock_collection.bulk_write.call_args_list[0][1] == {'ordered': False}
+
+    # the error index points at the failed user of the whole request
+    assert result == {
+        'upserted': 3,
+        'modified': 1,
+        'errors': [{'index': 3, 'code': 11000, 'message': 'duplicate key'}]
+    }
+
+
+def test_recurring_dates():
+    # five weekday commutes starting on friday 2022-01-07
+    dates = recurring_dates('2022-01-07T09:00:00.000Z', 5, weekdays_only=True)
+    assert [date.day for date in dates] == [7, 10, 11, 12, 13]
+
+    # weekly rides
+    dates = recurring_dates('2022-01-07T09:00:00.000Z', 3, interval_days=7)
+    assert dates == [datetime(2022, 1, 7, 9), datetime(2022, 1, 14, 9), datetime(2022, 1, 21, 9)]
+
+    # every other weekday from a saturday
+    dates = recurring_dates('2022-01-08T09:00:00.000Z', 3, interval_days=2, weekdays_only=True)
+    assert [date.day for date in dates] == [10, 12, 14]
+
+
+def test_recurring_dates_rejects_endless_offers():
+    # a saturday repeated every week never lands on a weekday
+    with pytest.raises(ValueError):
+        recurring_dates('2022-01-08T09:00:00.000Z', 3, interval_days=7, weekdays_only=True)
+    with pytest.raises(ValueError):
+        recurring_dates('2022-01-08T09:00:00.000Z', 3, interval_days=0)
+    with pytest.raises(ValueError):
+        recurring_dates('2022-01-07T09:00:00.000Z', get_app_settings().recurring_max_occurrences + 1)
+
+    # the request model refuses them before any handler runs
+    from pydantic import ValidationError
+    from app.models.requestModels import RecurringRide
+    offer = {'mail_id': 'a@b.c', 'date': '2022-01-08T09:00:00.000Z', 'destination': 'Office', 'seats_offered': 2,
+             'vehicle_type': 'Car', 'occurrences': 3}
+    for invalid in ({'interval_days': 0}, {'occurrences': 0}, {'occurrences': 100000}):
+        with pytest.raises(ValidationError):
+            RecurringRide(**{**offer, **invalid})
+
+
+@patch('app.handlers.bulk_service.get_user_by_id')
+@patch('app.handlers.bulk_service.connect_mongo')
+def test_create_recurring_rides_in_db(mock_connect_mongo, mock_get_user_by_id):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+    mock_get_user_by_id.return_value = {'latitude': 37.1234, 'longitude': -122.5678}
+    mock_collection.insert_many.side_effect = lambda documents, ordered: Mock(
+        inserted_ids=[f'id{i}' for i in range(len(documents))]
+    )
+
+    # Call the create_recurring_rides_in_db function
+    dates = recurring_dates('2022-01-03T09:00:00.000Z', 3)
+    result = create_recurring_rides_in_db('test@gmail.com', dates, 'Office', 2, 'Car', chunk_size=2)
+
+    # the user is fetched once and the rides are inserted in unordered chunks
+    mock_get_user_by_id.assert_called_once()
+    assert mock_collection.insert_many.call_count == 2
+    documents = mock_collection.insert_many.call_args_list[0][0][0]
+    assert [document['date'] for document in documents] == dates[:2]
+    assert len(result['inserted_ids']) == 3
+    assert result['errors'] == []
+
+
+@patch('app.handlers.bulk_service.connect_mongo')
+def test_bulk_join_rides_in_db(mock_connect_mongo):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+
+    # the first ride got both riders, the second ride was full
+    full_ride, open_ride = ObjectId(), ObjectId()
+    mock_collection.find.side_effect = [
+        [{'_id': open_ride, 'riders': []}, {'_id': full_ride, 'riders': ['rider0']}],
+        [{'_id': open_ride, 'riders': ['rider1', 'rider2'], 'destination_id': 2, 'date': datetime(2022, 1, 1)},
+         {'_id': full_ride, 'riders': ['rider0'], 'destination_id': 2, 'date': datetime(2022, 1, 1)}],
+    ]
+    joins = [
+        JoinRequest(ride_id=str(open_ride), mail_id='rider1'),
+        JoinRequest(ride_id=str(open_ride), mail_id='rider2'),
+        JoinRequest(ride_id=str(full_ride), mail_id='rider3'),
+    ]
+
+    # Call the bulk_join_rides_in_db function
+    result = bulk_join_rides_in_db(joins)
+
+    # every join keeps the seat checks and the rides are read before and after the write
+    operations = mock_collection.bulk_write.call_args[0][0]
+    assert [operation._filter for operation in operations] == [
+        ride_join_filter(str(open_ride), 'rider1'),
+        ride_join_filter(str(open_ride), 'rider2'),
+        ride_join_filter(str(full_ride), 'rider3'),
+    ]
+    assert mock_collection.find.call_count == 2
+    assert result == {'joined': [0, 1], 'rejected': [2], 'errors': []}
+
+
+def test_bulk_join_rides_reports_repeated_joins():
+    db = standin.Database()
+    ride_id = db['rides'].insert_one({'mail_id': 'driver', 'status': 'scheduled', 'seats_offered': 3,
+                                      'riders': ['r1'], 'destination_id': 1, 'date': datetime(2022, 1, 1)}).inserted_id
+
+    # r1 is already on the ride and r2 is asked twice, only the first r2 join is reported as joined
+    joins = [JoinRequest(ride_id=str(ride_id), mail_id=mail_id) for mail_id in ('r1', 'r2', 'r2')]
+    result = bulk_join_rides_in_db(joins, db=db)
+    assert result == {'joined': [1], 'rejected': [0, 2], 'errors': []}
+    assert db['rides'].find_one({'_id': ride_id})['riders'] == ['r1', 'r2']
+
+
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_get_ride_by_id_keyset_page(mock_connect_mongo):
+    # Mock the connect_mongo function
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+    cursor = mock_collection.find.return_value
+    cursor.sort.return_value = cursor
+    cursor.limit.return_value = iter([
+        {'_id': ObjectId(), 'date': datetime(2022, 1, 1), 'riders': ['test@gmail.com']},
+        {'_id': ObjectId(), 'date': datetime(2022, 1, 2), 'riders': []},
+    ])
+
+    # Call the get_ride_by_id function for the page after a ride
+    after = ObjectId()
+    result = get_ride_by_id('test@gmail.com', 'completed', after=str(after), limit=2, fields=['date'])
+
+    # the page continues after the given _id, ordered by _id, with the projection
+    mock_collection.find.assert_called_once_with(
+        {'$and': [ride_history_filter('test@gmail.com', 'completed'), {'_id': {'$gt': after}}]},
+        {'date': 1, 'riders': 1}
+    )
+    cursor.sort.assert_called_once_with('_id', 1)
+    cursor.limit.assert_called_once_with(2)
+
+    # riders is only read to compute is_rider
+    assert [ride['is_rider'] for ride in result] == [True, False]
+    assert all('riders' not in ride for ride in result)
+
+
+@patch('app.handlers.car_pool_service.connect_mongo')
+def test_iter_rides_by_id_streams_the_cursor(mock_connect_mongo):
+    # Mock the connect_mongo function with a cursor which can only be read once
+    mock_db = mock_connect_mongo.return_value
+    mock_collection = mock_db.__getitem__.return_value
+    mock_collection.find.return_value = ({'_id': i, 'riders': []} for i in range(100000))
+
+    # the rides are yielded one by one, nothing is read before they are consumed
+    rides = iter_rides_by_id('test@gmail.com', 'completed')
+    assert next(rides) == {'_id': 0, 'riders': [], 'is_rider': False}
+    assert next(rides)['_id'] == 1
+
+
+def test_benchmark_data_generator():
+    # Define a small city with 10 km radius
+    generator = DataGenerator(users=50, rides=200, city_radius_km=10, seed=1)
+    users = [user for chunk in generator.iter_users(chunk_size=20) for user in chunk]
+    rides = [ride for chunk in generator.iter_rides(chunk_size=64) for ride in chunk]
+
+    # the users and rides are spread over the city and the destinations
+    assert len(users) == 50 and len(rides) == 200
+    lat, lon = generator.center
+    assert all(haversine(lat, lon, ride['latitude'], ride['longitude']) <= 10.01 for ride in rides)
+    assert {ride['destination_id'] for ride in rides} <= {item['_id'] for item in generator.iter_destinations()}
+    assert {ride['mail_id'] for ride in rides} <= {user['mail_id'] for user in users}
+
+    # the same seed gives the same data
+    assert rides[0] == next(DataGenerator(users=50, rides=200, city_radius_km=10, seed=1).iter_rides(chunk_size=64))[0]
+
+
+def test_benchmark_standin_database():
+    # load a small data set in the stand-in
+    generator = DataGenerator(users=20, rides=100, seed=3)
+    db = generator.load(standin.Database())
+    ride = db['rides'].find_one({"destination_id": 1, "seats_offered": {"$gt": 1}})
+
+    # the handlers run unchanged on the stand-in
+    assert update_riders_in_db(str(ride['_id']), 'rider@bench.local', db=db)[0] == 1
+    assert update_riders_in_db(str(ride['_id']), 'rider@bench.local', db=db)[0] == 0
+    history = get_ride_by_id('rider@bench.local', 'scheduled', db=db)
+    assert [item['_id'] for item in history] == [ride['_id']]
+    assert history[0]['is_rider'] is True
+
+    found = find_rides_by_lat_lon(ride['latitude'], ride['longitude'], 'rider@bench.local', 'Office',
+                                  ride['date'].strftime('%Y-%m-%dT%H:%M:%S.%fZ'), db=db)
+    assert found[0]['ride']['_id'] == ride['_id']
+    assert found[0]['address'] is not None
+
+
+def test_load_test_step_report():
+    # 90 fast and 10 slow find requests, two of them failed
+    stats = StepStats()
+    for i in range(100):
+        stats.record('find', 0.004 if i < 90 else 0.3, ok=i not in (0, 99))
+
+    # Call the report function for a one second step
+    report = stats.report(1.0)
+
+    assert report['throughput_rps'] == 100
+    assert report['errors'] == 2
+    find = report['routes']['find']
+    assert find['error_rate'] == 0.02
+    assert find['p50_ms'] == pytest.approx(4)
+    assert find['histogram_ms']['<=5'] == 90
+    assert find['histogram_ms']['<=500'] == 10
+
+
+def test_histogram_render():
+    # Define a histogram with two buckets
+    histogram = Histogram('test_seconds', 'Test latency.', ('route',), buckets=(0.1, 1))
+    histogram.observe('/api/users/{mail_id}', value=0.05)
+    histogram.observe('/api/users/{mail_id}', value=0.5)
+    histogram.observe('/api/users/{mail_id}', value=5)
+
+    # the buckets are cumulative in the text format
+    lines = histogram.render()
+    assert 'test_seconds_bucket{route="/api/users/{mail_id}",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/api/users/{mail_id}",le="1"} 2' in lines
+    assert 'test_seconds_bucket{route="/api/users/{mail_id}",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/api/users/{mail_id}"} 3' in lines
+
+
+def test_mongo_command_metrics():
+    # a find command on the rides collection which took 2 ms
+    listener = MongoCommandMetrics()
+    listener.started(Mock(command_name='find', command={'find': 'rides'}, connection_id=1, request_id=7))
+    listener.succeeded(Mock(command_name='find', connection_id=1, request_id=7, duration_micros=2000))
+
+    lines = MONGO_COMMAND_LATENCY.render()
+    assert any(line.startswith('mongo_command_duration_seconds_count{collection="rides",command="find"}')
+               for line in lines)
+
+
+def test_metrics_endpoint(mocker):
+    from fastapi.testclient import TestClient
+    import main
+
+    # serve a user from a mocked db
+    mock_db = Mock()
+    mock_db.__getitem__ = Mock(return_value=Mock(find_one=Mock(return_value={'mail_id': 'a@b.c'})))
+    main.app.state.db = mock_db
+    client = TestClient(main.app)
+    client.get('/api/users/a@b.c')
+
+    # the request is counted under its route template
+    body = client.get('/metrics').text
+    assert 'http_requests_total{method="GET",route="/api/users/{mail_id}",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/users/{mail_id}",le="+Inf"}' in body
+    assert 'http_requests_in_flight{method="GET"}' in body
+
+
+def test_slowest_profiles_keeps_the_slowest():
+    # keep two profiles out of four
+    store = SlowestProfiles(2)
+    for duration in (0.3, 0.1, 0.5, 0.2):
+        profile = Profile('GET', '/api/users/a@b.c')
+        profile.duration = duration
+        profile.stacks = {'event-loop;handler (a.py:1)': 3}
+        store.add(profile)
+
+    profiles = store.list()
+    assert [profile.duration for profile in profiles] == [0.5, 0.3]
+    assert store.get(profiles[0].id).collapsed() == 'event-loop;handler (a.py:1) 3\n'
+
+
+def test_profiler_middleware_and_admin_routes(mocker):
+    from fastapi.testclient import TestClient
+    import main
+
+    # enable the profiler for requests carrying the header
+    settings = main.get_app_settings().copy(update={'profiler_enabled': True, 'admin_token': 'secret'})
+    mocker.patch('main.get_app_settings', return_value=settings)
+    mocker.patch('app.routes.admin_routes.get_app_settings', return_value=settings)
+    app = main.get_application()
+    mock_db = Mock()
+    mock_db.__getitem__ = Mock(return_value=Mock(find_one=Mock(return_value={'mail_id': 'a@b.c'})))
+    app.state.db = mock_db
+    client = TestClient(app)
+    client.get('/api/users/a@b.c')
+    client.get('/api/users/a@b.c', headers={'X-Profile': '1'})
+    client.get('/api/users/a@b.c', headers={'X-Profile': 'secret'})
+
+    # only the request with the admin token in the header is profiled, and only admins can read it
+    assert client.get('/admin/profiles').status_code == 403
+    profiles = client.get('/admin/profiles', headers={'X-Admin-Token': 'secret'}).json()
+    assert len(profiles) == 1
+    assert profiles[0]['route'] == '/api/users/{mail_id}'
+    response = client.get(f"/admin/profiles/{profiles[0]['id']}", headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+
+
+def test_assign_greedy_respects_seats():
+    # two riders close to ride 0 which has a single seat
+    distances = np.array([[1.0, 5.0], [2.0, 3.0], [np.inf, 4.0]])
+    assignment = assign_greedy(distances, [1, 2], candidates_per_rider=1)
+    assert assignment.tolist() == [0, 1, 1]
+
+    # pairs beyond the max distance stay unassigned
+    assignment = assign_greedy(distances, [1, 2], max_distance=3.5)
+    assert assignment.tolist() == [0, 1, UNASSIGNED]
+
+
+def test_assign_optimal_beats_greedy():
+    pytest.importorskip('scipy')
+    # greedy gives ride 0 to rider 0 and leaves rider 1 with a 10 km pickup
+    distances = np.array([[1.0, 2.0], [1.5, 10.0]])
+    assert assign_greedy(distances, [1, 1]).tolist() == [0, 1]
+    assert assign_optimal(distances, [1, 1]).tolist() == [1, 0]
+
+
+def test_assign_rides_in_db():
+    # assign the riders of a generated data set and join them
+    generator = DataGenerator(users=50, rides=20, destinations={'Office': 1.0}, seed=5)
+    db = generator.load(standin.Database())
+    ride = db['rides'].find_one({"destination_id": 1})
+    date = ride['date'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    mail_ids = [generator.mail_id(i) for i in range(50)] + ['unknown@bench.local']
+
+    result = assign_rides_in_db('Office', date, mail_ids, commit=True, db=db)
+    assert 'unknown@bench.local' in result['unassigned']
+    # the drivers of the assigned rides are not riders themselves
+    rides = {str(ride['_id']): ride for ride in db['rides'].find({})}
+    drivers = {rides[item['ride_id']]['mail_id'] for item in result['assigned']}
+    assert result['assigned'] and not drivers & {item['mail_id'] for item in result['assigned']}
+    assert len(result['joins']['joined']) == len(result['assigned'])
+    for ride in db['rides'].find({}):
+        assert len(ride['riders']) <= ride['seats_offered']
+
+
+def test_assign_rides_in_db_assigns_scheduled_rides_only(monkeypatch):
+    generator = DataGenerator(users=50, rides=20, destinations={'Office': 1.0}, seed=5)
+    db = generator.load(standin.Database())
+    ride = db['rides'].find_one({"destination_id": 1})
+    date = ride['date'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    mail_ids = [generator.mail_id(i) for i in range(50)]
+
+    # a started ride is not assignable, the join filter would reject its riders
+    db['rides'].update_one({"_id": ride['_id']}, {"$set": {"status": "started"}})
+    result = assign_rides_in_db('Office', date, mail_ids, db=db)
+    assert result['assigned']
+    assert str(ride['_id']) not in {item['ride_id'] for item in result['assigned']}
+
+    # a rejected join is reported as unassigned and not counted in the distance
+    def join(joins, db=None):
+        return {"joined": list(range(1, len(joins))), "rejected": [0], "errors": []}
+
+    monkeypatch.setattr('app.handlers.assignment_service.bulk_join_rides_in_db', join)
+    committed = assign_rides_in_db('Office', date, mail_ids, commit=True, db=db)
+    rejected = result['assigned'][0]
+    assert committed['assigned'] == result['assigned'][1:]
+    assert rejected['mail_id'] in committed['unassigned']
+    assert committed['total_distance_km'] == pytest.approx(result['total_distance_km'] - rejected['distance_away'])
+
+
+def test_rank_by_detour():
+    # the office is 10 km north, one driver 3 km west and one 4 km south who passes by the rider
+    office = (12.9716 + 10 / 111.2, 77.5946)
+    drivers = [
+        {'mail_id': 'west', 'latitude': 12.9716, 'longitude': 77.5946 - 3 / 108.4},
+        {'mail_id': 'south', 'latitude': 12.9716 - 4 / 111.2, 'longitude': 77.5946},
+    ]
+    result = rank_by_detour(12.9716, 77.5946, office[0], office[1], drivers, max_detour=10)
+    assert [driver['mail_id'] for driver in result] == ['south', 'west']
+    assert result[0]['distance_away'] > result[1]['distance_away']
+    assert result[0]['detour_km'] < 0.1 < 2 < result[1]['detour_km']
+
+    # with only the pickup distance weighted the nearest driver comes first
+    result = rank_by_detour(12.9716, 77.5946, office[0], office[1], drivers, detour_weight=0, pickup_weight=1,
+                            max_detour=10)
+    assert [driver['mail_id'] for driver in result] == ['west', 'south']
+
+
+def test_find_rides_by_lat_lon_ranks_by_detour():
+    # a destination with coordinates in the places table
+    generator = DataGenerator(users=30, rides=30, destinations={'Office': 1.0}, seed=7)
+    db = generator.load(standin.Database())
+    upsert_place_in_db(Place(name='Office', latitude=13.05, longitude=77.6), db=db)
+    ride = db['rides'].find_one({})
+
+    result = find_rides_by_lat_lon(12.95, 77.55, 'rider@bench.local', 'Office',
+                                   ride['date'].strftime('%Y-%m-%dT%H:%M:%S.%fZ'), db=db)
+    scores = [item['score'] for item in result]
+    assert scores == sorted(scores)
+    assert all('detour_km' in item for item in result)
+
+
+def test_get_place_cache(monkeypatch):
+    db = standin.Database()
+
+    # an unknown place is cached empty until a write of the place invalidates it
+    assert car_pool_service.get_place('Office', db=db) is None
+    assert car_pool_service.get_place('Office', db=db) is None
+    assert db.call_counts()['places']['find_one'] == 1
+    upsert_place_in_db(Place(name='Office', latitude=13.05, longitude=77.6), db=db)
+    assert car_pool_service.get_place('Office', db=db) == {'latitude': 13.05, 'longitude': 77.6}
+
+    # without the cache every lookup reads the places
+    monkeypatch.setattr(get_app_settings(), 'place_cache_enabled', False)
+    assert get_place_cache() is None
+    db['places'].update_one({'name': 'office'}, {'$set': {'latitude': 13.1}})
+    assert car_pool_service.get_place('Office', db=db)['latitude'] == 13.1
+    assert db.call_counts()['places']['find_one'] == 3
+
+
+def test_destination_dictionary_fuzzy_lookup():
+    # spellings of the same destination normalize to one name
+    assert normalize_destination('  Office ') == normalize_destination('OFFICE') == 'office'
+
+    dictionary = DestinationDictionary().load([
+        {'_id': 1, 'name': 'office'}, {'_id': 2, 'name': 'tech park'}, {'_id': 3, 'name': 'airport'},
+    ])
+    assert dictionary.search('hq office', limit=1)[0][0] == 1
+    assert dictionary.search('tech parc', limit=1)[0][0] == 2
+    assert dictionary.search('zzz', threshold=0.4) == []
+
+
+def test_intern_and_resolve_destination():
+    # an empty db, the dictionary is loaded from it
+    db = standin.Database()
+    reset_destination_dictionary()
+    assert intern_destination('Office ', db) == 1
+    assert intern_destination('office', db) == 1
+    assert intern_destination('Tech Park', db) == 2
+    assert db['destinations'].find_one({'_id': 1})['label'] == 'Office'
+
+    # other workers see the interned destinations through the db
+    reset_destination_dictionary()
+    assert resolve_destination('OFFICE', db) == 1
+    assert resolve_destination('Railway Station', db) is None
+
+    # a close spelling is not another name of the destination, it is only suggested
+    intern_destination('Building 1', db)
+    assert resolve_destination('HQ office', db) is None
+    assert resolve_destination('building 3', db) is None
+    assert suggest_destinations('building 3', db) == ['Building 1']
+    assert suggest_destinations('office', db) == []
+
+
+def test_ride_index_grid_search():
+    # rides 1, 2 and 30 km north of the user, in the 9 am bucket of destination 1
+    index = RideIndex(cell_km=1)
+    index.replace([], datetime(2030, 1, 7), datetime(2030, 1, 8))
+    for ride_id, km in ((1, 1), (2, 2), (3, 30)):
+        index.upsert({'_id': ride_id, 'destination_id': 1, 'date': datetime(2030, 1, 7, 9, 30),
+                      'latitude': 12.97 + km / 111.2, 'longitude': 77.59, 'status': 'scheduled'})
+
+    def ids(**kwargs):
+        found = index.candidates(1, datetime(2030, 1, 7, 9), datetime(2030, 1, 7, 10), 12.97, 77.59, **kwargs)
+        return sorted(candidate['ride']['_id'] for candidate in found)
+
+    # only the cells within the radius are read, and the search widens to the nearest ride
+    assert ids(radius_km=5) == [1, 2]
+    assert ids(radius_km=5, keep=lambda candidate: candidate['ride']['_id'] == 3) == [3]
+
+    # completing a ride removes it
+    index.update(1, {'status': 'completed'})
+    assert ids(radius_km=5) == [2]
+    assert len(index) == 2
+
+
+def test_ride_index_replays_writes_made_during_a_reload():
+    index = RideIndex(cell_km=1)
+    index.replace([], datetime(2030, 1, 7), datetime(2030, 1, 8))
+
+    def ride(ride_id, **fields):
+        return {'_id': ride_id, 'destination_id': 1, 'date': datetime(2030, 1, 7, 9, 30), 'latitude': 12.97,
+                'longitude': 77.59, 'status': 'scheduled', 'riders': [], **fields}
+
+    # the reload query read rides 1 and 2, then ride 3 is offered, 1 is joined and 2 is completed
+    index.begin_reload()
+    assert index.tracks_writes()
+    loaded = [{'ride': ride(1), 'address': 'a'}, {'ride': ride(2), 'address': 'b'}]
+    index.upsert(ride(3), 'c')
+    index.update(1, {'riders': ['rider']})
+    index.upsert(ride(2, status='completed'))
+    index.replace(loaded, datetime(2030, 1, 7), datetime(2030, 1, 8))
+
+    # the swapped index has the writes the query missed
+    found = {candidate['ride']['_id']: candidate
+             for candidate in index.candidates(1, datetime(2030, 1, 7, 9), datetime(2030, 1, 7, 10))}
+    assert sorted(found) == [1, 3]
+    assert found[1]['ride']['riders'] == ['rider']
+    assert found[1]['address'] == 'a'
+    assert found[3]['address'] == 'c'
+
+
+def test_get_synced_ride_index_reloads_in_the_background(monkeypatch):
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'ride_index_enabled', True)
+    monkeypatch.setattr(car_pool_service, '_ride_index', None)
+    db = standin.Database()
+    reload_started, release = threading.Event(), threading.Event()
+
+    def load(*args, **kwargs):
+        reload_started.set()
+        release.wait(5)
+        return []
+
+    monkeypatch.setattr(car_pool_service, 'load_ride_candidates', load)
+    # the first search does not wait for the load, the index covers nothing until it is done
+    index = car_pool_service.get_synced_ride_index(db)
+    assert reload_started.wait(5)
+    assert not index.covers(datetime.utcnow(), datetime.utcnow())
+    # a single reload runs at a time
+    assert car_pool_service.start_ride_index_sync(db) is None
+    release.set()
+    car_pool_service._ride_index_sync.join(5)
+    assert index.loaded_at is not None
+
+
+def test_find_rides_by_lat_lon_ride_index(monkeypatch):
+    # rides of tomorrow, held by the ride index
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'ride_index_enabled', True)
+    monkeypatch.setattr(settings, 'ride_index_horizon_hours', 72)
+    monkeypatch.setattr(car_pool_service, '_ride_index', None)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    generator = DataGenerator(users=100, rides=400, day=today + timedelta(days=1), seed=11)
+    db = generator.load(standin.Database())
+    users = list(db['users'].find({}))[:20]
+
+    def search(user):
+        return find_rides_by_lat_lon(user['latitude'], user['longitude'], user['mail_id'], 'office',
+                                     (today + timedelta(days=1, hours=9)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'), db=db)
+
+    # the index gives the same nearest ride and the same rides within radius as the mongodb search
+    car_pool_service.sync_ride_index(db)
+    from_index = [search(user) for user in users]
+    assert len(car_pool_service.get_ride_index()) > 0
+    monkeypatch.setattr(settings, 'ride_index_enabled', False)
+    from_db = [search(user) for user in users]
+    for index_rides, db_rides in zip(from_index, from_db):
+        assert index_rides[0]['ride']['_id'] == db_rides[0]['ride']['_id']
+        assert {ride['ride']['_id'] for ride in index_rides} == {ride['ride']['_id'] for ride in db_rides}
+
+    # the writes keep the index current
+    monkeypatch.setattr(settings, 'ride_index_enabled', True)
+    ride = from_index[0][0]['ride']
+    update_riders_in_db(str(ride['_id']), 'rider@bench.local', db=db)
+    found = car_pool_service.get_ride_index().candidates(ride['destination_id'], ride['date'], ride['date'])
+    assert 'rider@bench.local' in next(item['ride']['riders'] for item in found if item['ride']['_id'] == ride['_id'])
+
+
+def test_match_candidates_columns():
+    # the user's own ride and a full ride are not bookable
+    candidates = [
+        {'ride': {'_id': i, 'mail_id': f'driver{i}', 'latitude': 12.97 + i * 0.01, 'longitude': 77.59,
+                  'seats_offered': 2, 'riders': []}, 'address': f'address {i}'}
+        for i in range(5)
+    ]
+    candidates[0]['ride']['mail_id'] = 'rider'
+    candidates[1]['ride']['riders'] = ['a', 'b']
+    keep, lats, lons = candidate_columns(candidates, 'rider')
+    assert keep.tolist() == [2, 3, 4]
+    assert lats.tolist() == [12.99, 13.0, 13.01]
+
+    # only the returned rides are built, with the ride documents shared and not copied
+    result = match_candidates(12.97, 77.59, 'rider', candidates)
+    assert [item['ride']['_id'] for item in result] == [2, 3, 4]
+    assert result[0]['ride'] is candidates[2]['ride']
+    assert result[0]['address'] == 'address 2'
+    assert result[0]['distance_away'] == pytest.approx(haversine(12.97, 77.59, 12.99, 77.59))
+
+
+def test_server_options(monkeypatch):
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'server_workers', 0)
+    monkeypatch.setattr(settings, 'server_limit_concurrency', 500)
+
+    # one worker per core by default, the server settings become the gunicorn and uvicorn options
+    options = gunicorn_options(settings, port=9000)
+    assert options['workers'] == (os.cpu_count() or 1)
+    assert options['bind'] == f'{settings.server_host}:9000'
+    assert options['preload_app'] is True
+    assert options['backlog'] == settings.server_backlog
+    assert options['keepalive'] == settings.server_keep_alive_seconds
+    assert gunicorn_options(settings, workers=3)['workers'] == 3
+    assert uvicorn_options(settings) == {'loop': 'uvloop', 'http': 'httptools', 'limit_concurrency': 500}
+
+
+def test_server_refuses_workers_with_memory_caches(monkeypatch):
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'cache_backend', 'memory')
+    monkeypatch.setattr(settings, 'user_cache_enabled', True)
+    monkeypatch.setattr(settings, 'search_cache_enabled', True)
+    monkeypatch.setattr(settings, 'place_cache_enabled', True)
+
+    # each worker would keep its own caches, invalidated by its own writes only
+    assert len(worker_conflicts(settings)) == 3
+    with pytest.raises(RuntimeError, match='can not run 2 workers'):
+        run_server(workers=2, settings=settings)
+
+    # shared caches, or none, are fine
+    monkeypatch.setattr(settings, 'cache_backend', 'redis')
+    assert worker_conflicts(settings) == []
+    monkeypatch.setattr(settings, 'cache_backend', 'memory')
+    monkeypatch.setattr(settings, 'user_cache_enabled', False)
+    monkeypatch.setattr(settings, 'search_cache_enabled', False)
+    monkeypatch.setattr(settings, 'place_cache_enabled', False)
+    assert worker_conflicts(settings) == []
+
+    # the ride index of a worker misses the writes of the others without the change stream
+    monkeypatch.setattr(settings, 'ride_index_enabled', True)
+    monkeypatch.setattr(settings, 'ride_index_change_stream', False)
+    assert len(worker_conflicts(settings)) == 1
+    monkeypatch.setattr(settings, 'ride_index_change_stream', True)
+    assert worker_conflicts(settings) == []
+
+
+def test_server_post_fork_drops_database():
+    # a forked worker never uses the database of the master, it connects in its startup event
+    set_database(standin.Database())
+    post_fork(None, None)
+    with pytest.raises(RuntimeError):
+        get_database()
+
+
+def test_warm_up_preloads_rides_and_users(monkeypatch):
+    import main
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'ride_index_enabled', False)
+
+    # rides of the next two hours, in the stand-in
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    db = DataGenerator(users=50, rides=200, day=now + timedelta(hours=1), peak_hour=0,
+                       peak_spread_hours=0.5).load(standin.Database())
+    app = main.get_application()
+    warm_up_app(app, db, settings, skip=('indexes',))
+
+    warm_up = get_warm_up(app)
+    assert warm_up.ready
+    assert list(warm_up.phases) == ['destinations', 'rides', 'users', 'serializers', 'matching']
+    assert get_user_cache().stats()['size'] == 50
+
+    # the searches of the preloaded hours are answered without querying the rides
+    calls = db.call_counts()['rides'].get('find', 0)
+    assert get_ride_candidates(1, now, now + timedelta(hours=2), db=db)
+    assert db.call_counts()['rides'].get('find', 0) == calls
+
+
+def test_start_app_connects_off_the_event_loop(monkeypatch):
+    import main
+    from app.core import events
+    app = main.get_application()
+    threads = []
+    monkeypatch.setattr(events, 'create_mongo_client',
+                        lambda settings, event_listeners: {'carpool': standin.Database()})
+    monkeypatch.setattr(events, '_connect', lambda client, settings: threads.append(threading.current_thread()))
+
+    async def start_warm_up(app, db, settings):
+        pass
+
+    monkeypatch.setattr(events, 'start_warm_up', start_warm_up)
+    monkeypatch.setattr(get_app_settings(), 'mongo_db', 'carpool')
+    # the pings of the connect phase do not block the event loop
+    asyncio.run(events.create_start_app_handler(app, get_app_settings())())
+    assert threads and threads[0] is not threading.main_thread()
+    assert 'connect' in get_warm_up(app).phases
+    set_database(None)
+
+
+def test_ready_route():
+    from fastapi.testclient import TestClient
+    import main
+
+    # not ready until the warm-up is done
+    app = main.get_application()
+    client = TestClient(app)
+    assert client.get('/ready').status_code == 503
+    get_warm_up(app).run_phase('indexes', lambda: None)
+    get_warm_up(app).ready = True
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.json()['ready'] is True
+    assert 'indexes' in response.json()['phases_ms']
+
+
+def test_write_behind_queue_merges_and_batches():
+    batches = []
+    queue = WriteBehindQueue(lambda batch: batches.append(batch) or {}, batch_size=2, flush_interval=60)
+
+    # repeated updates of a ride are merged, the last one wins and the callers share the write
+    first = queue.put('ride1', 'scheduled')
+    assert queue.put('ride1', 'started') is first
+    queue.put('ride2', 'started')
+    assert first.result(timeout=5) is True
+    queue.put('ride3', 'completed')
+    queue.close()
+
+    # a full batch is written at once, the rest on close
+    assert batches == [{'ride1': 'started', 'ride2': 'started'}, {'ride3': 'completed'}]
+    assert queue.stats()['merged'] == 1
+    assert queue.stats()['written'] == 3
+    with pytest.raises(RuntimeError):
+        queue.put('ride4', 'started')
+
+
+def test_write_behind_queue_backpressure():
+    started = threading.Event()
+    release = threading.Event()
+
+    def write(batch):
+        started.set()
+        release.wait(5)
+        return {key: 'write failed' for key in batch if key == 'ride3'}
+
+    # the flusher is busy with the first ride, two more fill the queue
+    queue = WriteBehindQueue(write, batch_size=1, flush_interval=0, max_pending=2, put_timeout=0.05)
+    queue.put('ride1', 'started')
+    assert started.wait(5)
+    queue.put('ride2', 'started')
+    failing = queue.put('ride3', 'started')
+    with pytest.raises(WriteBehindQueueFull):
+        queue.put('ride4', 'started')
+    # a pending ride is still merged when the queue is full
+    queue.put('ride2', 'completed')
+
+    release.set()
+    queue.close()
+    with pytest.raises(RuntimeError):
+        failing.result(timeout=5)
+    assert queue.stats()['failed'] == 1
+
+
+def test_queue_ride_status_bulk_writes(monkeypatch):
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'write_behind_enabled', True)
+    monkeypatch.setattr(settings, 'write_behind_flush_interval_ms', 10)
+    monkeypatch.setattr(write_behind, '_status_queue', None)
+    db = DataGenerator(users=10, rides=20).load(standin.Database())
+    ride_ids = [str(ride['_id']) for ride in db['rides'].find({})]
+
+    # acknowledged updates are written when the call returns, the others once the queue is drained
+    assert queue_ride_status(ride_ids[0], 'started', db=db) == 1
+    assert db['rides'].find_one({'_id': ObjectId(ride_ids[0])})['status'] == 'started'
+    for ride_id in ride_ids[1:]:
+        queue_ride_status(ride_id, 'started', 'fire_and_forget', db=db)
+        queue_ride_status(ride_id, 'completed', 'fire_and_forget', db=db)
+    stats = close_status_queue()
+
+    assert stats['written'] == len(ride_ids)
+    assert stats['merged'] == len(ride_ids) - 1
+    assert all(ride['status'] == 'completed' for ride in db['rides'].find({'_id': {'$ne': ObjectId(ride_ids[0])}}))
+    assert db.call_counts()['rides'].get('find_one_and_update', 0) == 0
+    with pytest.raises(ValueError):
+        monkeypatch.setattr(write_behind, '_status_queue', None)
+        queue_ride_status(ride_ids[0], 'started', 'eventually', db=db)
+    close_status_queue()
+
+
+def test_async_queue_ride_status_does_not_hold_db_threads(monkeypatch):
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, 'write_behind_enabled', True)
+    monkeypatch.setattr(settings, 'write_behind_flush_interval_ms', 200)
+    monkeypatch.setattr(settings, 'db_threads', 4)
+    monkeypatch.setattr(async_car_pool_service, '_limiter', None)
+    monkeypatch.setattr(write_behind, '_status_queue', None)
+    db = DataGenerator(users=10, rides=40).load(standin.Database())
+    ride_ids = [str(ride['_id']) for ride in db['rides'].find({})]
+
+    # a burst of acknowledged updates, ten times the db threads, waits for the flush without holding them
+    async def run():
+        return await asyncio.gather(*[async_car_pool_service.queue_ride_status(ride_id, 'started', db=db)
+                                      for ride_id in ride_ids])
+
+    assert asyncio.run(run()) == [1] * len(ride_ids)
+    stats = close_status_queue()
+    assert stats['batches'] == 1
+    assert stats['written'] == len(ride_ids)
+    assert all(ride['status'] == 'started' for ride in db['rides'].find({}))
+    monkeypatch.setattr(async_car_pool_service, '_limiter', None)
+
 
 def test_haversine():
     # Test case 1: Distance between two same points should be 0
@@ -360,14 +1751,67 @@ def test_find_nearest():
     # Call the find_nearest function
     result = find_nearest(lat, lon, users)
 
-    # Define the expected result
-    expected_result = {
+    # the nearest user on top with its distance, no other user is within the radius
+    assert result == [{
         "latitude": 14.9715987,
-        "longitude": 77.5945627
-    }
+        "longitude": 77.5945627,
+        "distance_away": pytest.approx(haversine(lat, lon, 14.9715987, 77.5945627))
+    }]
 
-    # Assert that the result is equal to the expected result
-    assert result == expected_result
+
+def test_haversine_vector():
+    # vectorized distances should match the scalar haversine
+    lats = [12.9715987, 13.9715987, 11.9715987]
+    lons = [77.5945627, 79.5945627, 96.5945627]
+    result = haversine_vector(12.9715987, 77.5945627, lats, lons)
+    for lat, lon, distance in zip(lats, lons, result):
+        assert distance == pytest.approx(haversine(12.9715987, 77.5945627, lat, lon))
+
+
+def test_distance_matrix():
+    # Define the input values
+    origins_lat = [12.9715987, 13.9715987]
+    origins_lon = [77.5945627, 79.5945627]
+    lats = [12.9715987, 11.9715987, 14.9715987]
+    lons = [77.5945627, 96.5945627, 77.5945627]
+
+    # Call the distance_matrix function
+    result = distance_matrix(origins_lat, origins_lon, lats, lons)
+
+    # Assert the shape and every cell against the scalar haversine
+    assert result.shape == (2, 3)
+    for i in range(2):
+        for j in range(3):
+            assert result[i][j] == pytest.approx(haversine(origins_lat[i], origins_lon[i], lats[j], lons[j]))
+
+
+def test_find_nearest_within_radius():
+    # Define the input values, two users within 5 km and one far away
+    lat = 12.9715987
+    lon = 77.5945627
+    users = [
+        {"latitude": 12.9915987, "longitude": 77.5945627},
+        {"latitude": 13.9715987, "longitude": 79.5945627},
+        {"latitude": 12.9725987, "longitude": 77.5945627},
+    ]
+
+    # Call the find_nearest function
+    result = find_nearest(lat, lon, users)
+
+    # nearest user is on top followed by the users within 5 km
+    assert [(user["latitude"], user["longitude"]) for user in result] == [
+        (12.9725987, 77.5945627),
+        (12.9915987, 77.5945627),
+    ]
+    assert result[0]["distance_away"] == pytest.approx(haversine(lat, lon, 12.9725987, 77.5945627))
+
+    # the input users should not be modified
+    assert "distance_away" not in users[0]
+
+    # many origins should give the same result as one call per origin
+    many = find_nearest_many([(lat, lon), (13.9715987, 79.5945627)], users)
+    assert many[0] == result
+    assert many[1] == find_nearest(13.9715987, 79.5945627, users)
 
 
 if __name__ == '__main__':